@@ -0,0 +1,203 @@
+"""
+arbitration.py
+
+Who controls the lamp, and how fast each client may talk to it.
+
+An Arbiter holds the control owner behind a single lock and asks a policy how
+it changes hands:
+
+    SingleOwner    the first client to send a command or ask for control keeps
+                   it until it lets go or stops pinging
+    AdminOverride  SingleOwner, plus /admin/take_control grabs control at once
+                   (from any client, or only the admins listed)
+    Timeslice      AdminOverride, and clients asking for control while someone
+                   has it queue up; the owner then gets timeslice seconds
+                   before control moves on to the next in line
+
+It also keeps a token bucket per source IP. The OSC server checks allow()
+before it decodes a datagram, so a flooding client costs a dict lookup per
+packet and can't crowd out the owner's commands.
+"""
+import threading
+import time
+
+# Messages per second per client, and how many may come in one burst. A
+# TouchOSC page with a few sliders moving at once sends about 200 a second.
+RATE = 300
+BURST = 300
+TIMESLICE = 60
+
+
+class SingleOwner(object):
+
+    def __init__(self):
+        self.owner = None
+
+    def command(self, address, now):
+        if self.owner is None:
+            self.owner = address
+        return self.owner == address
+
+    def request(self, address, now, is_present):
+        if self.owner is None or self.owner == address or not is_present(self.owner):
+            self.owner = address
+            return True
+        return False
+
+    def release(self, address, now):
+        if self.owner == address:
+            self.owner = None
+
+    def take(self, address, now):
+        return False
+
+    def gone(self, address, now):
+        self.release(address, now)
+
+    def reset(self, owner, now):
+        self.owner = owner
+
+    def expire(self, now):
+        """
+            Returns True if the owner changed.
+        """
+        return False
+
+
+class AdminOverride(SingleOwner):
+
+    def __init__(self, admins=None):
+        SingleOwner.__init__(self)
+        self.admins = set(admins) if admins else None
+
+    def take(self, address, now):
+        if self.admins is not None and address not in self.admins:
+            return False
+        self.owner = address
+        return True
+
+
+class Timeslice(AdminOverride):
+
+    def __init__(self, admins=None, timeslice=TIMESLICE):
+        AdminOverride.__init__(self, admins)
+        self.timeslice = timeslice
+        self.waiting = []
+        self.slice_ends = None
+
+    def hand_over(self, now):
+        self.owner = self.waiting.pop(0) if self.waiting else None
+        self.slice_ends = now + self.timeslice if self.waiting else None
+
+    def request(self, address, now, is_present):
+        if AdminOverride.request(self, address, now, is_present):
+            if address in self.waiting:
+                self.waiting.remove(address)
+            if self.waiting and self.slice_ends is None:
+                self.slice_ends = now + self.timeslice
+            return True
+        if address not in self.waiting:
+            self.waiting.append(address)
+        if self.slice_ends is None:
+            self.slice_ends = now + self.timeslice
+        return False
+
+    def release(self, address, now):
+        if address in self.waiting:
+            self.waiting.remove(address)
+        elif self.owner == address:
+            self.hand_over(now)
+
+    def reset(self, owner, now):
+        # Nobody left waiting, they may be long gone
+        AdminOverride.reset(self, owner, now)
+        self.waiting = []
+        self.slice_ends = None
+
+    def expire(self, now):
+        if self.slice_ends is None or now < self.slice_ends:
+            return False
+        self.hand_over(now)
+        return True
+
+
+POLICIES = {
+    'single': SingleOwner,
+    'admin': AdminOverride,
+    'timeslice': Timeslice,
+}
+
+
+def make_policy(name='admin', admins=None):
+    if name == 'single':
+        return SingleOwner()
+    return POLICIES[name](admins)
+
+
+class Arbiter(object):
+
+    def __init__(self, policy=None, rate=RATE, burst=BURST):
+        self.policy = policy if policy is not None else AdminOverride()
+        self.rate = rate
+        self.burst = burst
+        self.lock = threading.Lock()
+        # address: [tokens, last refill]
+        self.buckets = {}
+        self.rejected = 0
+
+    @property
+    def owner(self):
+        return self.policy.owner
+
+    def allow(self, address):
+        """
+            Take a token from address's bucket. False means drop the message.
+        """
+        now = time.time()
+        with self.lock:
+            bucket = self.buckets.get(address)
+            if bucket is None:
+                bucket = self.buckets[address] = [self.burst, now]
+            tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            if tokens < 1:
+                bucket[0] = tokens
+                self.rejected += 1
+                return False
+            bucket[0] = tokens - 1
+            return True
+
+    def command(self, address):
+        """
+            Whether a command from address should be applied.
+        """
+        with self.lock:
+            return self.policy.command(address, time.time())
+
+    def request(self, address, is_present):
+        with self.lock:
+            return self.policy.request(address, time.time(), is_present)
+
+    def release(self, address):
+        with self.lock:
+            self.policy.release(address, time.time())
+
+    def take(self, address):
+        with self.lock:
+            return self.policy.take(address, time.time())
+
+    def gone(self, address):
+        with self.lock:
+            self.buckets.pop(address, None)
+            self.policy.gone(address, time.time())
+
+    def expire(self):
+        with self.lock:
+            return self.policy.expire(time.time())
+
+    def reset(self, owner=None):
+        """
+            Hand control to owner, or nobody, whatever the policy says.
+        """
+        with self.lock:
+            self.policy.reset(owner, time.time())
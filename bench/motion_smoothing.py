@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+bench/motion_smoothing.py
+
+Pan and tilt as the lamp sees them, with and without the motion smoother.
+
+Drives a Lighthouse on recording fake Enttecs the way a thumb drives the
+TouchOSC pan and tilt sliders: a sweep across the sky, --rate messages a
+second, each position a few degrees off the line. A frame hook after the
+smoother samples the pan and tilt channels every frame. Reports how often
+they changed, the biggest jump in one frame, and the jerk, the RMS of the
+frame to frame change in step size, for both runs. Both start settled at the
+start of the sweep. Smoothed pan still jumps over the dead zones in one frame,
+which shows in its biggest step.
+
+    python bench/motion_smoothing.py --seconds 3 --jitter 3
+"""
+import argparse
+import math
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dmx import open_recording_device
+from lighthouse import Lighthouse
+from universe import UniverseManager
+
+# Long enough for the smoother to cross the sky
+SETTLE = 2
+
+
+class Sampler(object):
+
+    def __init__(self, fixture, universe):
+        self.fixture = fixture
+        self.universe = universe
+        self.pan = []
+        self.tilt = []
+
+    def __call__(self, now):
+        self.pan.append(self.universe.getChannel(self.fixture.channel_pan_location))
+        self.tilt.append(self.universe.getChannel(self.fixture.channel_tilt))
+
+
+def describe(values):
+    steps = [b - a for a, b in zip(values, values[1:])]
+    jerks = [b - a for a, b in zip(steps, steps[1:])]
+    changes = sum(1 for step in steps if step)
+    biggest = max([abs(step) for step in steps] or [0])
+    rms = math.sqrt(sum(j * j for j in jerks) / float(len(jerks) or 1))
+    return changes, biggest, rms
+
+
+def run(smoothing, args):
+    random.seed(args.seed)
+    lighthouse = Lighthouse(frame_rate=args.frame_rate, smoothing=smoothing,
+                            universes=UniverseManager(open_recording_device))
+    fixture, universe = lighthouse.outputs[0]
+    # From the start of the sweep, not from where homing left the lamp
+    lighthouse.set_pan_position(20)
+    lighthouse.set_tilt(10)
+    time.sleep(SETTLE)
+    sampler = Sampler(fixture, universe)
+    lighthouse.dmx.add_frame_hook(sampler)
+
+    messages = int(args.seconds * args.rate)
+    for index in range(messages):
+        along = index / float(messages)
+        lighthouse.set_pan_position(int(20 + 300 * along + random.uniform(-args.jitter, args.jitter)))
+        lighthouse.set_tilt(int(10 + 60 * along + random.uniform(-args.jitter, args.jitter)))
+        time.sleep(1.0 / args.rate)
+    # Let the smoother catch up with the last position
+    time.sleep(1)
+    lighthouse.dmx.disconnect()
+    return sampler
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--rate', type=float, default=60, help='slider messages per second')
+    parser.add_argument('--jitter', type=float, default=3, help='degrees either way')
+    parser.add_argument('--frame-rate', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print '%.0f s of slider at %.0f messages/s, +-%.0f degrees, %d fps' % (
+        args.seconds, args.rate, args.jitter, args.frame_rate)
+    print '%-10s %-5s %8s %10s %10s' % ('', '', 'changes', 'max step', 'jerk rms')
+    for smoothing in (False, True):
+        sampler = run(smoothing, args)
+        label = 'smoothed' if smoothing else 'direct'
+        for name, values in (('pan', sampler.pan), ('tilt', sampler.tilt)):
+            print '%-10s %-5s %8d %10d %10.2f' % ((label, name) + describe(values))
+            label = ''
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""
+bench/network_dmx.py
+
+Art-Net and sACN receive throughput, headless on any box.
+
+For each protocol, a separate process sends --universes full universes at
+--rate Hz to 127.0.0.1 through netdmx.NetworkPort outputs, every frame with
+new values. This process receives them with a netdmx.Receiver on an
+EventLoop into universes on recording fake Enttecs, flushing them at 40 fps
+like the render loop would. Reports packets sent and applied, sequence and
+other drops, the time to parse and apply one packet and the receiver's CPU.
+
+    python bench/network_dmx.py --universes 8 --rate 44 --seconds 5
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import netdmx
+from dmx import RecordingDmx
+from event_loop import EventLoop
+from metrics import Histogram
+from universe import Universe
+
+FLUSH_RATE = 40
+
+
+def send(protocol, port, universes, rate, seconds, sent):
+    network = netdmx.NetworkPort('%s:127.0.0.1:%d' % (protocol, port))
+    outputs = [network.output(universe) for universe in range(universes)]
+    frame = bytearray(netdmx.SLOTS)
+    period = 1.0 / rate
+    start = next_tick = time.time()
+    count = 0
+    while time.time() - start < seconds:
+        for output in outputs:
+            frame[:] = bytearray([(count + output.sequence) & 0xff]) * netdmx.SLOTS
+            output.set_data(frame)
+            output.render()
+            count += 1
+        next_tick += period
+        delay = next_tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    sent.value = sum(output.packets_sent for output in outputs)
+    network.disconnect()
+
+
+def run(protocol, args):
+    universes = [Universe(RecordingDmx(), 'bench', number) for number in range(args.universes)]
+    receiver = netdmx.open_receiver(protocol, universes, address='127.0.0.1', port=0,
+                                    multicast=False)
+    timings = Histogram()
+    receive = receiver.receive
+
+    def timed_receive(length, address, now):
+        start = time.time()
+        try:
+            return receive(length, address, now)
+        finally:
+            timings.record(int((time.time() - start) * 1000000))
+    receiver.receive = timed_receive
+
+    loop = EventLoop()
+    loop.add_reader(receiver.sock, receiver.handle)
+    flush_timer = loop.call_every(1.0 / FLUSH_RATE,
+        lambda: [universe.flush() for universe in universes])
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+
+    sent = multiprocessing.Value('i', 0)
+    sender = multiprocessing.Process(target=send, args=(
+        protocol, receiver.sock.getsockname()[1], args.universes, args.rate, args.seconds, sent))
+    times_before = os.times()
+    start = time.time()
+    sender.start()
+    sender.join()
+    time.sleep(.2)
+    elapsed = time.time() - start
+    times_after = os.times()
+    flush_timer.cancel()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    receiver.close()
+
+    stats = receiver.stats()
+    summary = timings.summary()
+    cpu = (times_after[0] - times_before[0]) + (times_after[1] - times_before[1])
+    frames = sum(len(universe.device.frames) for universe in universes)
+    print
+    print protocol
+    print 'packets sent/applied %d / %d' % (sent.value, stats['applied'])
+    print 'dropped              out of order %d, outranked %d, ignored %d, lost %d' % (
+        stats['out_of_order'], stats['outranked'], stats['ignored'], sent.value - stats['packets'])
+    print 'receive us/packet    p50 %d  p90 %d  p99 %d  max %d' % (
+        summary['p50_us'], summary['p90_us'], summary['p99_us'], summary['max_us'])
+    print 'frames flushed       %d' % frames
+    print 'receiver CPU         %.1f%% of one core' % (100 * cpu / elapsed)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--universes', type=int, default=8)
+    parser.add_argument('--rate', type=float, default=44)
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--protocol', choices=[netdmx.ARTNET, netdmx.SACN])
+    args = parser.parse_args()
+
+    print '%d universes at %.0f Hz for %.0f s' % (args.universes, args.rate, args.seconds)
+    for protocol in [args.protocol] if args.protocol else [netdmx.ARTNET, netdmx.SACN]:
+        run(protocol, args)
+
+
+if __name__ == '__main__':
+    main()
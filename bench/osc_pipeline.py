@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+"""
+bench/osc_pipeline.py
+
+Load test for the OSC to DMX pipeline, headless on any Linux box.
+
+Starts LighthouseOSCCallbacks on a spare localhost port with dmx.RecordingDmx
+devices, then a separate process plays a swarm of TouchOSC clients sweeping the
+pan, tilt and brightness sliders and pinging once a second. Reports the time
+from a brightness message leaving the client to the first DMX frame showing
+it (or a newer value, since values are coalesced), frame rate, received
+versus applied messages, CPU use and thread count.
+
+    python bench/osc_pipeline.py --clients 8 --rate 30 --seconds 10
+"""
+import argparse
+import bisect
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OSC
+
+import oscrecv
+from dmx import open_recording_device
+from universe import UniverseManager
+
+BENCH_PORT = 18000
+# A frame showing any of the next LOOKAHEAD brightness values counts, as the
+# server may have skipped straight past the one sent.
+LOOKAHEAD = 50
+
+
+def swarm(port, clients, rate, seconds, distinct_ips, results):
+    senders = []
+    for i in range(clients):
+        client = OSC.OSCClient()
+        if distinct_ips:
+            client.socket.bind(('127.0.0.%d' % (10 + i), 0))
+        client.connect(('127.0.0.1', port))
+        senders.append(client)
+
+    sent = []
+    sequence = 0
+    period = 1.0 / rate
+    start = next_tick = time.time()
+    next_ping = start
+    while time.time() - start < seconds:
+        now = time.time()
+        ping = now >= next_ping
+        if ping:
+            next_ping += 1
+        for i, client in enumerate(senders):
+            if ping:
+                client.send(OSC.OSCMessage('/ping'))
+            for path, value in (
+                    ('/staticLight/pan', (sequence * 3 + i) % 361),
+                    ('/staticLight/tilt', (sequence + i) % 70)):
+                msg = OSC.OSCMessage(path)
+                msg.append(float(value))
+                client.send(msg)
+            value = sequence % 101
+            msg = OSC.OSCMessage('/staticLight/brightness')
+            msg.append(float(value))
+            sent.append((time.time(), value))
+            client.send(msg)
+            sequence += 1
+        next_tick += period
+        delay = next_tick - time.time()
+        if delay > 0:
+            time.sleep(delay)
+    results.put(sent)
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def latencies(sent, frames, encode):
+    frame_times = [t for t, _ in frames]
+    result = []
+    missing = 0
+    for k, (sent_time, _) in enumerate(sent):
+        wanted = set(encode(value) for _, value in sent[k:k + LOOKAHEAD])
+        index = bisect.bisect_left(frame_times, sent_time)
+        while index < len(frames) and frames[index][1] not in wanted:
+            index += 1
+        if index == len(frames):
+            missing += 1
+        else:
+            result.append(frame_times[index] - sent_time)
+    result.sort()
+    return result, missing
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=30, help='messages per slider per second per client')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    parser.add_argument('--distinct-ips', action='store_true',
+        help='send from 127.0.0.10+ so only the first client has control')
+    args = parser.parse_args()
+
+    universes = UniverseManager(open_device=open_recording_device)
+    light = oscrecv.LighthouseOSCCallbacks(oscrecv.LIGHT_FUNCTIONS,
+        recv_port=args.port, universes=universes)
+    fixture, universe = light.outputs[0]
+    device = universe.device
+    server = threading.Thread(target=light.serve_forever)
+    server.start()
+
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=swarm,
+        args=(args.port, args.clients, args.rate, args.seconds, args.distinct_ips, results))
+    times_before = os.times()
+    frames_before = len(device.frames)
+    started = time.time()
+    process.start()
+    time.sleep(args.seconds / 2)
+    threads = threading.active_count()
+    sent = results.get()
+    process.join()
+    # Let the last messages reach the lamp
+    time.sleep(0.25)
+    elapsed = time.time() - started
+    times_after = os.times()
+
+    light.close()
+    server.join()
+    light.motion.close()
+    light.dmx.disconnect()
+
+    channel = fixture.channel_brightness
+    frames = [(t, ord(frame[channel])) for t, frame in device.frames[frames_before:]]
+    result, missing = latencies(sent, frames, fixture.calibration.brightness)
+    cpu = (times_after[0] - times_before[0]) + (times_after[1] - times_before[1])
+    inbox = light.inbox.stats()
+    received = sum(count for count, _ in inbox.values())
+    applied = sum(count for _, count in inbox.values())
+
+    print
+    print 'clients %d, %.0f msg/s per slider each, %.1f s' % (args.clients, args.rate, args.seconds)
+    print 'brightness messages  %d sent, %d never seen in a frame' % (len(sent), missing)
+    print 'latency ms           p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(
+        1000 * x for x in (percentile(result, .5), percentile(result, .9),
+                           percentile(result, .99), percentile(result, 1)))
+    print 'frames               %d, %.1f per second' % (len(frames), len(frames) / elapsed)
+    print 'render loop          %s' % light.dmx.stats()
+    print 'OSC messages         %d received, %d applied, %d merged' % (received, applied, received - applied)
+    print 'rate limited         %d datagrams dropped' % light.arbiter.rejected
+    print 'server CPU           %.1f%% of one core' % (100 * cpu / elapsed)
+    print 'server threads       %d' % threads
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+"""
+bench/output_jitter.py
+
+Frame interval jitter of DMX output, in process and from an output process.
+
+Runs LighthouseOSCCallbacks on recording fake Enttecs twice, each time in a
+fresh process: once rendering from its own RenderLoop thread, once through an
+output_process.OutputProcess. Both times the bench/osc_pipeline.py swarm of
+TouchOSC clients sweeps the sliders, and --busy threads burn the control
+process's GIL in pure Python, the way a slow handler or console would.
+
+A frame hook in the control process counts frames into channel 512, so every
+frame it makes differs from the last, and the fake Enttec notes when each
+count reaches it. Reports, under load:
+
+    delivered   how far the intervals between counts reaching the device
+                strayed from 25 ms per frame counted, and counts that never
+                reached it: what the lamp sees
+    control     the same for the ticks of the control process's render loop,
+                which runs the frame hooks and makes each frame
+    output      the output process's own ticks
+
+    python bench/output_jitter.py --clients 4 --busy 2 --seconds 10
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import oscrecv
+from dmx import RecordingDmx
+from metrics import Histogram
+from osc_pipeline import swarm
+from output_process import OutputProcess
+from universe import UniverseManager
+
+BENCH_PORT = 18004
+MARKER_CHANNEL = 512
+
+
+class Marker(object):
+    """
+        Frame hook counting frames into MARKER_CHANNEL.
+    """
+
+    def __init__(self, universe):
+        self.universe = universe
+        self.count = 0
+
+    def __call__(self, now):
+        self.count = (self.count + 1) & 0xff
+        self.universe.setChannel(MARKER_CHANNEL, self.count)
+
+
+class DeliveryDmx(RecordingDmx):
+    """
+        Fake Enttec timing the frame counts that reach it, from
+        measure_from.value on, and reporting them to results when closed.
+    """
+
+    def __init__(self, port, period, measure_from, results):
+        RecordingDmx.__init__(self, port)
+        self.period = period
+        self.measure_from = measure_from
+        self.results = results
+        self.jitter = Histogram()
+        self.last = None
+        self.lost = 0
+
+    def render(self, render_till=None):
+        now = time.time()
+        count = self.buffer[MARKER_CHANNEL]
+        if self.last is not None and count == self.last[1]:
+            return
+        if self.last is not None and now >= self.measure_from.value > 0:
+            frames = (count - self.last[1]) & 0xff
+            self.lost += frames - 1
+            self.jitter.record(int(abs(now - self.last[0] - frames * self.period) * 1000000))
+        self.last = (now, count)
+
+    def disconnect(self):
+        self.results.put((self.jitter.summary(), self.lost))
+
+
+def busy(seconds):
+    end = time.time() + seconds
+    total = 0
+    while time.time() < end:
+        for i in xrange(1000):
+            total += i * i
+    return total
+
+
+def run_mode(isolated, args, results):
+    measure_from = multiprocessing.Value('d', 0)
+    delivered = multiprocessing.Queue()
+
+    def open_device(port, baud=None):
+        return DeliveryDmx(port, 1.0 / oscrecv.DMX_FRAME_RATE, measure_from, delivered)
+    output = None
+    if isolated:
+        output = OutputProcess(oscrecv.DMX_FRAME_RATE, open_device)
+        output.start()
+        universes = UniverseManager(output.open_device)
+    else:
+        universes = UniverseManager(open_device)
+    light = oscrecv.LighthouseOSCCallbacks(oscrecv.LIGHT_FUNCTIONS,
+        recv_port=args.port, universes=universes)
+    light.dmx.add_frame_hook(Marker(light.outputs[0][1]))
+    server = threading.Thread(target=light.serve_forever)
+    server.start()
+
+    sent = multiprocessing.Queue()
+    clients = multiprocessing.Process(target=swarm,
+        args=(args.port, args.clients, args.rate, args.seconds, False, sent))
+    burners = [threading.Thread(target=busy, args=(args.seconds,)) for _ in range(args.busy)]
+    # Only count frames under load
+    light.dmx.jitter = Histogram()
+    measure_from.value = time.time()
+    clients.start()
+    for burner in burners:
+        burner.start()
+    sent.get()
+    clients.join()
+    for burner in burners:
+        burner.join()
+    # The output process publishes its stats once a second
+    time.sleep(1.1)
+
+    control = light.dmx.stats()
+    light.loop.call_soon_threadsafe(light.close)
+    server.join()
+    light.motion.close()
+    light.dmx.disconnect()
+    child = None
+    if output is not None:
+        output.stop()
+        child = output.stats()
+    results.put((delivered.get(), control, child))
+
+
+def print_jitter(name, jitter, counts):
+    print '    %-10s jitter p50 %5.2f  p90 %5.2f  p99 %5.2f  max %6.2f ms   %s' % (
+        name, jitter['p50_us'] / 1000.0, jitter['p90_us'] / 1000.0, jitter['p99_us'] / 1000.0,
+        jitter['max_us'] / 1000.0, counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=30, help='messages per slider per second per client')
+    parser.add_argument('--busy', type=int, default=2, help='GIL burning threads in the control process')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    args = parser.parse_args()
+
+    report = []
+    for isolated in (False, True):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_mode, args=(isolated, args, results))
+        process.start()
+        report.append((isolated, results.get()))
+        process.join()
+
+    print
+    print '%d clients at %.0f messages/s per slider, %d busy threads, %.0f s' % (
+        args.clients, args.rate, args.busy, args.seconds)
+    for isolated, ((delivered, lost), control, child) in report:
+        print 'output process' if isolated else 'in process'
+        print_jitter('delivered', delivered, 'frames lost %d' % lost)
+        print_jitter('control', control['jitter'], 'frames sent %d, dropped %d' % (
+            control['sent'], control['dropped']))
+        if child is not None:
+            print_jitter('output', child['jitter'], 'frames sent %d, dropped %d' % (
+                child['sent'], child['dropped']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+"""
+bench/poofer_latency.py
+
+Button press to byte on the wire for the fire page, headless on any box.
+
+Starts a PooferServer with a poofer.FakeSerial on a spare localhost port and
+presses fire set buttons from an OSC client, one every --interval seconds,
+with no delay. Each press is matched to the serial write that opened its
+poofers. Reports that end to end time, plus the server's own report of how
+late writes were against their due time, including the scheduled closes.
+
+    python bench/poofer_latency.py --presses 200
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import OSC
+
+import poofer
+
+BENCH_PORT = 18002
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--presses', type=int, default=200)
+    parser.add_argument('--interval', type=float, default=.02)
+    parser.add_argument('--duration', type=float, default=.1)
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    args = parser.parse_args()
+
+    serial = poofer.FakeSerial()
+    server = poofer.PooferServer(serial, address='127.0.0.1', recv_port=args.port)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    client = OSC.OSCClient()
+    client.connect(('127.0.0.1', args.port))
+    msg = OSC.OSCMessage('/fire/duration')
+    msg.append(args.duration, typehint='f')
+    client.send(msg)
+    time.sleep(.1)
+
+    sent = []
+    for press in range(args.presses):
+        msg = OSC.OSCMessage('/fire/set/%d' % (press % len(poofer.FIRE_SETS)))
+        msg.append(1)
+        sent.append(time.time())
+        client.send(msg)
+        time.sleep(args.interval)
+    time.sleep(args.duration + .1)
+    server.loop.call_soon_threadsafe(server.close)
+    thread.join()
+
+    opens = [t for t, data in serial.writes if any(c.isupper() for c in data)]
+    latencies = [1000 * (wire - press) for press, wire in zip(sent, opens)]
+    print
+    print 'presses %d, one every %.0f ms' % (args.presses, 1000 * args.interval)
+    print 'press to wire ms     p50 %.2f  p90 %.2f  p99 %.2f  max %.2f' % tuple(
+        percentile(latencies, fraction) for fraction in (.5, .9, .99, 1))
+    print server.poofers.report()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+"""
+bench/startup.py
+
+Cold start of oscrecv.py, from a fresh interpreter to the first DMX frame.
+
+Each run starts a new python process that imports the modules oscrecv needs,
+builds LighthouseOSCCallbacks with dmx.RecordingDmx devices and waits for the
+first frame, timing each phase. Reports the median of each phase over the runs
+and which heavy optional modules (netifaces, dbus, the HTTP server) had been
+loaded by the first frame; none of them should be.
+
+    python bench/startup.py --runs 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCH_PORT = 18001
+HEAVY_MODULES = ['netifaces', 'dbus', 'avahi', 'BaseHTTPServer', 'yaml']
+PHASES = ['interpreter', 'import OSC', 'import lighthouse', 'import oscrecv',
+          'init', 'first frame', 'total']
+
+
+def child(port, spawned):
+    phases = [('interpreter', time.time() - spawned)]
+    sys.path.append(REPO)
+
+    start = time.time()
+    import OSC
+    phases.append(('import OSC', time.time() - start))
+
+    start = time.time()
+    import lighthouse
+    phases.append(('import lighthouse', time.time() - start))
+
+    start = time.time()
+    import oscrecv
+    from dmx import open_recording_device
+    from universe import UniverseManager
+    phases.append(('import oscrecv', time.time() - start))
+
+    start = time.time()
+    light = oscrecv.LighthouseOSCCallbacks(oscrecv.LIGHT_FUNCTIONS, recv_port=port,
+        universes=UniverseManager(open_device=open_recording_device))
+    phases.append(('init', time.time() - start))
+
+    start = time.time()
+    light.dmx.first_frame.wait()
+    phases.append(('first frame', time.time() - start))
+    phases.append(('total', time.time() - spawned))
+
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    # stdout carries the result, keep the server's chatter out of it
+    sys.__stdout__.write(json.dumps({'phases': dict(phases), 'loaded': loaded}) + '\n')
+    sys.__stdout__.flush()
+    light.motion.close()
+    light.close()
+    light.dmx.disconnect()
+
+
+def run(port):
+    spawned = time.time()
+    output = subprocess.check_output(
+        [sys.executable, os.path.abspath(__file__), '--child', '--port', str(port),
+         '--spawned', repr(spawned)],
+        stderr=open(os.devnull, 'w'))
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    parser.add_argument('--child', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--spawned', type=float, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        sys.stdout = open(os.devnull, 'w')
+        child(args.port, args.spawned)
+        return
+
+    results = [run(args.port) for _ in range(args.runs)]
+    print 'runs', args.runs, '(median ms)'
+    for phase in PHASES:
+        print '%-20s %8.1f' % (phase, 1000 * median([r['phases'][phase] for r in results]))
+    loaded = sorted(set(name for r in results for name in r['loaded']))
+    print '%-20s %s' % ('heavy modules loaded', ', '.join(loaded) or 'none')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+"""
+bench/web_panel.py
+
+Does a crowd of web panel spectators slow the DMX path?
+
+Runs LighthouseOSCCallbacks on recording fake Enttecs twice, each time in a
+fresh process, with the bench/osc_pipeline.py swarm of TouchOSC clients
+sweeping the sliders so the state changes every tick: once without the web
+panel, once with it and --spectators browsers connected from another process.
+One in --stalled of them never reads, the way a phone gone to sleep wouldn't.
+A diff is about ten bytes, so to see the per-browser backpressure within a
+run, the panel's kernel send buffer and backlog limit are lowered to
+--send-buffer, by default the kernel's minimum, and --max-backlog. Even so a
+stalled spectator takes about 30 s to back up. Reports how far the render loop's
+frame intervals strayed from the 25 ms period, frames sent, OSC messages
+applied, and what the panel streamed and skipped.
+
+    python bench/web_panel.py --spectators 500 --stalled 10 --seconds 40
+"""
+import argparse
+import base64
+import multiprocessing
+import os
+import select
+import socket
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import oscrecv
+import webpanel
+from dmx import open_recording_device
+from metrics import Histogram
+from osc_pipeline import swarm
+from universe import UniverseManager
+
+BENCH_PORT = 18006
+WEB_PORT = 18086
+# The kernel's minimum, so a stalled spectator fills it within the run
+STALLED_RECEIVE_BUFFER = 1
+
+
+def connect(port, stalled):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    if stalled:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, STALLED_RECEIVE_BUFFER)
+    sock.connect(('127.0.0.1', port))
+    sock.sendall('GET /ws HTTP/1.1\r\nHost: bench\r\nUpgrade: websocket\r\nConnection: Upgrade\r\n'
+                 'Sec-WebSocket-Key: %s\r\nSec-WebSocket-Version: 13\r\n\r\n' %
+                 base64.b64encode(os.urandom(16)))
+    return sock
+
+
+def spectate(port, spectators, stalled_every, seconds, ready, results):
+    readers = []
+    stalled = []
+    for i in range(spectators):
+        if stalled_every and i % stalled_every == 0:
+            stalled.append(connect(port, True))
+        else:
+            readers.append(connect(port, False))
+    ready.set()
+    received = 0
+    end = time.time() + seconds
+    while time.time() < end:
+        readable, _, _ = select.select(readers, [], [], .1)
+        for sock in readable:
+            data = sock.recv(65536)
+            if not data:
+                readers.remove(sock)
+            received += len(data)
+    results.put((len(readers), len(stalled), received))
+    for sock in readers + stalled:
+        sock.close()
+
+
+def run_mode(spectators, args, results):
+    light = oscrecv.LighthouseOSCCallbacks(oscrecv.LIGHT_FUNCTIONS, recv_port=args.port,
+        universes=UniverseManager(open_recording_device))
+    if spectators:
+        webpanel.SEND_BUFFER = args.send_buffer
+        webpanel.MAX_BACKLOG = args.max_backlog
+        light.open_web_panel(args.web_port)
+    server = threading.Thread(target=light.serve_forever)
+    server.start()
+
+    viewers = None
+    watched = multiprocessing.Queue()
+    if spectators:
+        ready = multiprocessing.Event()
+        viewers = multiprocessing.Process(target=spectate, args=(
+            args.web_port, spectators, args.stalled, args.seconds + 1, ready, watched))
+        viewers.start()
+        ready.wait()
+        # Let the panel finish the handshakes
+        time.sleep(1)
+
+    sent = multiprocessing.Queue()
+    clients = multiprocessing.Process(target=swarm,
+        args=(args.port, args.clients, args.rate, args.seconds, False, sent))
+    # Only count frames under load
+    light.dmx.jitter = Histogram()
+    times_before = os.times()
+    clients.start()
+    sent.get()
+    clients.join()
+    times_after = os.times()
+    cpu = (times_after[0] - times_before[0]) + (times_after[1] - times_before[1])
+
+    stats = light.dmx.stats()
+    web = light.web_panel.stats() if light.web_panel is not None else None
+    spectated = None
+    if viewers is not None:
+        spectated = watched.get()
+        viewers.join()
+    light.loop.call_soon_threadsafe(light.close)
+    server.join()
+    light.motion.close()
+    light.dmx.disconnect()
+    results.put((stats, light.inbox.stats(), cpu / args.seconds, web, spectated))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--spectators', type=int, default=500)
+    parser.add_argument('--stalled', type=int, default=10, help='one in this many spectators never reads')
+    parser.add_argument('--send-buffer', type=int, default=1,
+                        help='kernel send buffer per browser, webpanel.SEND_BUFFER')
+    parser.add_argument('--max-backlog', type=int, default=256,
+                        help='bytes backed up before a browser is skipped, webpanel.MAX_BACKLOG')
+    parser.add_argument('--clients', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=30, help='messages per slider per second per client')
+    parser.add_argument('--seconds', type=float, default=40)
+    parser.add_argument('--port', type=int, default=BENCH_PORT)
+    parser.add_argument('--web-port', type=int, default=WEB_PORT)
+    args = parser.parse_args()
+
+    report = []
+    for spectators in (0, args.spectators):
+        results = multiprocessing.Queue()
+        process = multiprocessing.Process(target=run_mode, args=(spectators, args, results))
+        process.start()
+        report.append((spectators, results.get()))
+        process.join()
+
+    print
+    print '%d clients at %.0f messages/s per slider, %.0f s' % (args.clients, args.rate, args.seconds)
+    for spectators, (stats, messages, cpu, web, spectated) in report:
+        jitter = stats['jitter']
+        applied = sum(applied for _, applied in messages.values())
+        print '%-16s jitter p50 %5.2f  p90 %5.2f  p99 %5.2f  max %6.2f ms   frames sent %d, dropped %d' % (
+            '%d spectators' % spectators if web else 'no web panel', jitter['p50_us'] / 1000.0,
+            jitter['p90_us'] / 1000.0, jitter['p99_us'] / 1000.0, jitter['max_us'] / 1000.0,
+            stats['sent'], stats['dropped'])
+        print '%-16s OSC messages applied %d, server CPU %.0f%% of one core' % ('', applied, 100 * cpu)
+        if web:
+            reading, stalled, received = spectated
+            print '%-16s web panel %d websockets, %d ticks, %d diffs sent, %d skipped, %d bytes backed up' % (
+                '', web['websockets'], web['streamed'], web['sent'], web['skipped'], web['backlog'])
+            print '%-16s %d reading spectators got %d bytes, %d stalled' % ('', reading, received, stalled)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,198 @@
+"""
+calibration.py
+
+Precomputed DMX lookup tables for the lamp's control channels.
+
+The util.py conversions do float math, and the pan dead zones are scanned on
+every message. A Calibration runs them once for every whole-unit input in each
+channel's domain, dead zones and tilt limits included, and keeps the results in
+bytearrays so each conversion is a single indexed lookup. Call rebuild() when
+the dead zones or tilt limits change.
+
+Run this module directly to check the tables against the formulas.
+"""
+from util import (
+    brightness_percent_to_dmx,
+    degrees_to_dmx,
+    percent_to_dmx,
+    tilt_to_dmx,
+)
+
+PERCENT_MIN = 0
+PERCENT_MAX = 100
+PAN_MIN = 0
+PAN_MAX = 360
+
+
+def reposition_from_pan_deadzone(position_degrees, dead_zones):
+    """
+        Move a pan position out of the dead zone it falls in, to whichever
+        edge is nearer. dead_zones is a sorted list of (lower, upper) degrees.
+    """
+    for lower_bound, upper_bound in dead_zones:
+        if position_degrees < lower_bound:
+            break
+        if lower_bound <= position_degrees <= upper_bound:
+            if (position_degrees - lower_bound) < (upper_bound - position_degrees):
+                return max(lower_bound - 1, dead_zones[0][1]+1)
+            else:
+                return upper_bound + 1
+    if position_degrees > dead_zones[-1][1]:
+        return dead_zones[-1][0]-1
+    return position_degrees
+
+
+def reposition_from_tilt_deadzone(tilt_degrees, tilt_limit_low, tilt_limit_high):
+    tilt_degrees = max(tilt_limit_low, tilt_degrees)
+    tilt_degrees = min(tilt_limit_high, tilt_degrees)
+    return tilt_degrees
+
+
+def clamp(value, low, high):
+    return max(low, min(high, int(value)))
+
+
+def pan_arcs(dead_zones):
+    """
+        The (lower, upper) runs of whole degrees outside the dead zones.
+    """
+    arcs = []
+    for x in range(PAN_MIN, PAN_MAX + 1):
+        if reposition_from_pan_deadzone(x, dead_zones) != x:
+            continue
+        if arcs and arcs[-1][1] == x - 1:
+            arcs[-1] = (arcs[-1][0], x)
+        else:
+            arcs.append((x, x))
+    return arcs
+
+
+class Calibration(object):
+    """
+        Lookup tables from whole-unit inputs to DMX values.
+
+        Inputs outside a table's domain are clamped to it, and fractional inputs
+        are truncated the same way oscrecv truncates OSC arguments.
+
+        Pan positions can also be measured along the track, the usable arcs
+        between the dead zones laid end to end, so that moving along it steps
+        over the dead zones instead of stopping in them.
+    """
+
+    def __init__(self, pan_dead_zones, tilt_limit_low, tilt_limit_high):
+        self.rebuild(pan_dead_zones, tilt_limit_low, tilt_limit_high)
+
+    def rebuild(self, pan_dead_zones, tilt_limit_low, tilt_limit_high):
+        self.pan_dead_zones = list(pan_dead_zones)
+        self.tilt_limit_low = tilt_limit_low
+        self.tilt_limit_high = tilt_limit_high
+
+        self.percent_table = bytearray(
+            percent_to_dmx(x) for x in range(PERCENT_MIN, PERCENT_MAX + 1))
+        self.brightness_table = bytearray(
+            brightness_percent_to_dmx(x) for x in range(PERCENT_MIN, PERCENT_MAX + 1))
+        self.pan_table = bytearray(
+            clamp(degrees_to_dmx(reposition_from_pan_deadzone(x, self.pan_dead_zones)), 0, 255)
+            for x in range(PAN_MIN, PAN_MAX + 1))
+        self.tilt_table = bytearray(
+            clamp(tilt_to_dmx(x), 0, 255)
+            for x in range(tilt_limit_low, tilt_limit_high + 1))
+        # pan_from_dmx, tilt_from_dmx and brightness_from_dmx, by DMX value as
+        # they are asked for
+        self.pan_from_dmx_cache = {}
+        self.tilt_from_dmx_cache = {}
+        self.brightness_from_dmx_cache = {}
+
+        self.pan_arcs = pan_arcs(self.pan_dead_zones) or [(PAN_MIN, PAN_MAX)]
+        self.track_offsets = []
+        offset = 0
+        for lower, upper in self.pan_arcs:
+            self.track_offsets.append(offset)
+            # One degree of track between arcs, the jump over a dead zone
+            offset += upper - lower + 1
+        self.track_length = offset - 1
+
+    def percent(self, int_percent):
+        return self.percent_table[clamp(int_percent, PERCENT_MIN, PERCENT_MAX)]
+
+    def brightness(self, int_percent):
+        return self.brightness_table[clamp(int_percent, PERCENT_MIN, PERCENT_MAX)]
+
+    def pan(self, position_degrees):
+        return self.pan_table[clamp(position_degrees, PAN_MIN, PAN_MAX)]
+
+    def tilt(self, tilt_degrees):
+        low = self.tilt_limit_low
+        return self.tilt_table[clamp(tilt_degrees, low, self.tilt_limit_high) - low]
+
+    def pan_to_track(self, position_degrees):
+        position = reposition_from_pan_deadzone(
+            max(PAN_MIN, min(PAN_MAX, position_degrees)), self.pan_dead_zones)
+        for (lower, upper), offset in zip(self.pan_arcs, self.track_offsets):
+            if position <= upper:
+                return offset + max(0, position - lower)
+        lower, upper = self.pan_arcs[-1]
+        return self.track_offsets[-1] + upper - lower
+
+    def track_to_pan(self, track_position):
+        for (lower, upper), offset in zip(self.pan_arcs, self.track_offsets):
+            if track_position <= offset + upper - lower:
+                return lower + max(0, track_position - offset)
+        return self.pan_arcs[-1][1]
+
+    def pan_from_dmx(self, value):
+        """
+            The usable pan position nearest to a pan channel value.
+        """
+        position = self.pan_from_dmx_cache.get(value)
+        if position is None:
+            position = self.pan_from_dmx_cache[value] = min((abs(self.pan_table[x] - value), x)
+                for lower, upper in self.pan_arcs for x in range(lower, upper + 1))[1]
+        return position
+
+    def tilt_from_dmx(self, value):
+        degrees = self.tilt_from_dmx_cache.get(value)
+        if degrees is None:
+            index = min((abs(tilt - value), index) for index, tilt in enumerate(self.tilt_table))[1]
+            degrees = self.tilt_from_dmx_cache[value] = index + self.tilt_limit_low
+        return degrees
+
+    def brightness_from_dmx(self, value):
+        """
+            The brightness percent nearest to a brightness channel value,
+            which runs backwards on this lamp.
+        """
+        percent = self.brightness_from_dmx_cache.get(value)
+        if percent is None:
+            percent = self.brightness_from_dmx_cache[value] = min(
+                (abs(dmx - value), x) for x, dmx in enumerate(self.brightness_table))[1] + PERCENT_MIN
+        return percent
+
+
+def test():
+    import fixture
+
+    profile = fixture.load_profile()
+    dead_zones = fixture.pan_dead_zones(profile)
+    tilt_low, tilt_high = profile['tilt_limits']
+    calibration = Calibration(dead_zones, tilt_low, tilt_high)
+    for x in range(PERCENT_MIN, PERCENT_MAX + 1):
+        assert calibration.percent(x) == percent_to_dmx(x), x
+        assert calibration.brightness(x) == brightness_percent_to_dmx(x), x
+    for x in range(PAN_MIN, PAN_MAX + 1):
+        expected = degrees_to_dmx(reposition_from_pan_deadzone(x, dead_zones))
+        assert calibration.pan(x) == expected, x
+    for x in range(-360, 361):
+        expected = tilt_to_dmx(reposition_from_tilt_deadzone(x, tilt_low, tilt_high))
+        assert calibration.tilt(x) == expected, x
+    for x in range(PAN_MIN, PAN_MAX + 1):
+        track = calibration.pan_to_track(x)
+        position = calibration.track_to_pan(track)
+        assert any(lower <= position <= upper for lower, upper in calibration.pan_arcs), x
+        repositioned = reposition_from_pan_deadzone(x, dead_zones)
+        assert position == repositioned or not PAN_MIN <= repositioned <= PAN_MAX, x
+    print 'Calibration tables match the util.py formulas.'
+
+
+if __name__ == "__main__":
+    test()
@@ -1,32 +1,206 @@
 import os
-from enttec_usb_dmx_pro import EnttecUsbDmxPro
-from util import get_default_port
+import threading
+import time
+from enttec import EnttecDmx
+import netdmx
 
 def colorize_output(*s):
     RED = '\033[93m'
     return '\033[95m'+RED+' '.join([str(x) for x in s])+'\033[0m'
 
-if os.path.exists(get_default_port()):
-    Dmx = EnttecUsbDmxPro.EnttecUsbDmxPro
-else:
-    class Dmx(object):
-        def __init__(self):
-            print colorize_output('Enttec port device', get_default_port(), 'not found. Starting fake DMX...')
-            
-        def setPort(self, port, baud=None):
-            print colorize_output('setting port...', port)
+# How often the supervisor looks for the widget coming and going
+POLL_INTERVAL = .1
+# Backoff between failed opens once the port is back
+MIN_BACKOFF = .05
+MAX_BACKOFF = 2
 
-        def connect(self):
-            print colorize_output('connecting...')
+def connect_enttec(port, baud):
+    device = EnttecDmx()
+    device.setPort(port, baud=baud)
+    device.connect()
+    return device
 
-        def setChannel(self, channel, value, autoRender=True):
-            print colorize_output('setting channel', channel, value, autoRender)
+class SupervisedDmx(object):
+    """
+        Dmx surface over an Enttec widget that may drop off the USB bus.
 
-        def render(self, render_till=None):
-            print colorize_output('rendering...', render_till if render_till is not None else '')
+        Channel values are kept here, so commands keep being accepted while the
+        widget is away. A supervisor thread polls for the port and for write
+        errors, reopens it with backoff when it comes back and pushes the whole
+        universe to it again.
+    """
+    def __init__(self, port, baud=250000, connect_device=connect_enttec):
+        self.port = port
+        self.baud = baud
+        self.connect_device = connect_device
+        self.buffer = bytearray(513)
+        self.lock = threading.Lock()
+        self.device = None
+        # Lost devices, closed from the supervisor thread
+        self.lost_devices = []
+        self.reconnects = 0
+        self.die = False
+        self.wake = threading.Event()
+        self.thread = None
 
-        def blackOut(self):
-            print colorize_output('Blacking out...')
+    def setPort(self, port, baud=250000):
+        self.port = port
+        self.baud = baud
 
-        def disconnect(self):
-            print colorize_output('disconecting...')
+    def connect(self):
+        try:
+            found = self.reconnect()
+        except (IOError, OSError) as e:
+            found = False
+            print colorize_output('Opening', self.port, 'failed -', e)
+        if not found:
+            print colorize_output('Enttec port device', self.port, 'not found. Waiting for it...')
+        self.thread = threading.Thread(target=self.supervise, name='SupervisedDmx %s' % self.port)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def connected(self):
+        return self.device is not None
+
+    def setChannel(self, channel, value, autoRender=True):
+        self.buffer[channel] = value
+        device = self.device
+        if device is not None:
+            device.setChannel(channel, value, autoRender=False)
+        if autoRender:
+            self.render()
+
+    def render(self, render_till=None):
+        device = self.device
+        if device is None:
+            return
+        try:
+            device.render()
+        except (IOError, OSError) as e:
+            self.lost(device, e)
+
+    def blackOut(self):
+        self.buffer[:] = bytearray(len(self.buffer))
+        device = self.device
+        if device is None:
+            return
+        try:
+            device.blackOut()
+        except (IOError, OSError) as e:
+            self.lost(device, e)
+
+    def lost(self, device, error):
+        with self.lock:
+            if self.device is not device:
+                return
+            self.device = None
+            self.lost_devices.append(device)
+        print colorize_output('Lost Enttec on', self.port, '-', error)
+        self.wake.set()
+
+    def reconnect(self):
+        if not os.path.exists(self.port):
+            return False
+        device = self.connect_device(self.port, self.baud)
+        # Taken first so that no setChannel is missed while pushing
+        with self.lock:
+            self.device = device
+        for channel in range(1, len(self.buffer)):
+            device.setChannel(channel, self.buffer[channel], autoRender=False)
+        device.render()
+        return True
+
+    def supervise(self):
+        backoff = MIN_BACKOFF
+        retry_at = 0
+        while True:
+            self.wake.wait(POLL_INTERVAL)
+            self.wake.clear()
+            if self.die:
+                return
+            with self.lock:
+                lost, self.lost_devices = self.lost_devices, []
+            for device in lost:
+                device.disconnect()
+
+            device = self.device
+            if device is not None:
+                error = getattr(device, 'error', None)
+                if error is None and not os.path.exists(self.port):
+                    error = 'port went away'
+                if error is not None:
+                    self.lost(device, error)
+                continue
+
+            if time.time() < retry_at:
+                continue
+            try:
+                if not self.reconnect():
+                    continue
+            except (IOError, OSError) as e:
+                print colorize_output('Reopening', self.port, 'failed, retrying in', backoff, 's -', e)
+                retry_at = time.time() + backoff
+                backoff = min(backoff * 2, MAX_BACKOFF)
+                continue
+            backoff = MIN_BACKOFF
+            self.reconnects += 1
+            print colorize_output('Enttec on', self.port, 'reconnected.')
+
+    def stats(self):
+        return {'connected': self.connected(), 'reconnects': self.reconnects}
+
+    def disconnect(self):
+        self.die = True
+        self.wake.set()
+        if self.thread is not None:
+            self.thread.join()
+        device = self.device
+        self.device = None
+        for device in self.lost_devices + ([device] if device is not None else []):
+            device.disconnect()
+
+def open_device(port, baud=250000):
+    """
+        Connect to the Enttec widget on port, and keep reconnecting to it
+        whenever it comes back after dropping off the bus. artnet: and sacn:
+        ports open a netdmx.NetworkPort instead.
+    """
+    if netdmx.is_network_port(port):
+        return netdmx.open_port(port)
+    device = SupervisedDmx(port, baud)
+    device.connect()
+    return device
+
+class RecordingDmx(object):
+    """
+        Silent fake device that keeps every rendered frame with its timestamp,
+        for benchmarks. frames is a list of (time.time(), bytes) pairs.
+    """
+    def __init__(self, port=None):
+        self.port = port
+        self.buffer = bytearray(513)
+        self.frames = []
+
+    def setPort(self, port, baud=None):
+        self.port = port
+
+    def connect(self):
+        pass
+
+    def setChannel(self, channel, value, autoRender=True):
+        self.buffer[channel] = value
+        if autoRender:
+            self.render()
+
+    def render(self, render_till=None):
+        self.frames.append((time.time(), bytes(self.buffer)))
+
+    def blackOut(self):
+        self.buffer[:] = bytearray(513)
+        self.render()
+
+    def disconnect(self):
+        pass
+
+def open_recording_device(port, baud=250000):
+    return RecordingDmx(port)
@@ -0,0 +1,142 @@
+"""
+enttec.py
+
+Output for the Enttec DMX USB Pro, with the Dmx surface of the
+enttec_usb_dmx_pro submodule (setPort/connect/setChannel/render/blackOut/
+disconnect).
+
+The "Output Only Send DMX" packet is
+
+    0x7E, label 6, length lsb, length msb, start code 0, 512 slots, 0xE7
+
+and is built once. setChannel writes straight into its data slots; render()
+copies them into a one-frame mailbox and returns, and a writer thread sends
+the newest frame to the serial port. At 250 kbaud a frame takes about 23ms
+on the wire, so if renders come faster than the widget takes them the frames
+nobody got to are dropped rather than queued behind each other.
+"""
+import threading
+
+START_OF_MESSAGE = 0x7E
+END_OF_MESSAGE = 0xE7
+SEND_DMX_LABEL = 6
+SLOTS = 512
+# Start code plus the slots
+DATA_LENGTH = SLOTS + 1
+HEADER_LENGTH = 4
+PACKET_LENGTH = HEADER_LENGTH + DATA_LENGTH + 1
+# Slot n of the universe is byte DATA_OFFSET + n; n = 0 is the start code.
+DATA_OFFSET = HEADER_LENGTH
+DATA = slice(DATA_OFFSET + 1, DATA_OFFSET + DATA_LENGTH)
+
+
+def send_dmx_packet():
+    packet = bytearray(PACKET_LENGTH)
+    packet[0] = START_OF_MESSAGE
+    packet[1] = SEND_DMX_LABEL
+    packet[2] = DATA_LENGTH & 0xFF
+    packet[3] = DATA_LENGTH >> 8
+    packet[-1] = END_OF_MESSAGE
+    return packet
+
+
+class EnttecDmx(object):
+
+    def __init__(self, port=None, baud=250000):
+        self.port = port
+        self.baud = baud
+        self.serial = None
+        # Written by setChannel
+        self.staging = send_dmx_packet()
+        self.staging_view = memoryview(self.staging)
+        # Newest rendered frame, waiting for the writer
+        self.pending = send_dmx_packet()
+        self.pending_view = memoryview(self.pending)
+        # Frame being written
+        self.writing = send_dmx_packet()
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.fresh = False
+        self.die = False
+        self.rendered = 0
+        self.written = 0
+        self.dropped = 0
+        # Set by the writer when the port fails, e.g. the widget was unplugged
+        self.error = None
+        self.thread = None
+
+    def setPort(self, port, baud=250000):
+        self.port = port
+        self.baud = baud
+
+    def connect(self):
+        import serial
+        self.serial = serial.Serial(self.port, self.baud)
+        self.die = False
+        self.thread = threading.Thread(target=self.run, name='EnttecDmx %s' % self.port)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def setChannel(self, channel, value, autoRender=True):
+        if not 1 <= channel <= SLOTS:
+            raise ValueError('DMX channel %s out of range' % channel)
+        self.staging[DATA_OFFSET + channel] = value
+        if autoRender:
+            self.render()
+
+    def render(self, render_till=None):
+        if self.error is not None:
+            raise IOError('Enttec on %s failed: %s' % (self.port, self.error))
+        with self.lock:
+            if self.fresh:
+                self.dropped += 1
+            self.pending_view[DATA] = self.staging_view[DATA]
+            self.fresh = True
+            self.rendered += 1
+            self.wake.notify()
+
+    def blackOut(self):
+        self.staging_view[DATA] = bytearray(SLOTS)
+        self.render()
+
+    def run(self):
+        while True:
+            with self.lock:
+                while not self.fresh and not self.die:
+                    self.wake.wait()
+                if not self.fresh:
+                    return
+                self.pending, self.writing = self.writing, self.pending
+                self.pending_view = memoryview(self.pending)
+                self.fresh = False
+            try:
+                self.serial.write(self.writing)
+            except (IOError, OSError) as e:
+                # serial.SerialException is an IOError
+                self.error = e
+                return
+            self.written += 1
+
+    def stats(self):
+        return {
+            'rendered': self.rendered,
+            'written': self.written,
+            'dropped': self.dropped,
+        }
+
+    def disconnect(self):
+        """
+            Send the last frame rendered, then close the port.
+        """
+        if self.thread is not None:
+            with self.lock:
+                self.die = True
+                self.wake.notify()
+            self.thread.join()
+            self.thread = None
+        if self.serial is not None:
+            try:
+                self.serial.close()
+            except (IOError, OSError):
+                pass
+            self.serial = None
@@ -0,0 +1,179 @@
+"""
+event_loop.py
+
+A small single-threaded select() event loop.
+
+oscrecv used to spawn a thread per OSC datagram plus two polling threads for
+pings and idle checks. Instead, the OSC socket and those periodic jobs all run
+from one EventLoop: readable sockets are handled as they arrive and timers fire
+from a heap in due-time order. Other threads can hand work to the loop with
+call_soon_threadsafe().
+"""
+import collections
+import errno
+import fcntl
+import heapq
+import itertools
+import os
+import select
+import threading
+import time
+import traceback
+
+
+class Timer(object):
+    """
+        Handle for a scheduled callback. cancel() stops it, including every
+        later repetition of a call_every timer.
+    """
+
+    def __init__(self, when, interval, callback, args):
+        self.when = when
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class EventLoop(object):
+
+    def __init__(self):
+        self.timers = []
+        self.counter = itertools.count()
+        self.readers = {}
+        self.writers = {}
+        self.ready = collections.deque()
+        self.running = False
+        self.thread_ident = None
+        # Written to by other threads to wake the loop out of select()
+        self.wake_read, self.wake_write = os.pipe()
+        for fd in (self.wake_read, self.wake_write):
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.add_reader(self.wake_read, self.drain_wakeups)
+
+    def call_later(self, delay, callback, *args):
+        return self.call_at(time.time() + delay, callback, *args)
+
+    def call_at(self, when, callback, *args):
+        timer = Timer(when, None, callback, args)
+        self.push(timer)
+        return timer
+
+    def call_every(self, interval, callback, *args):
+        """
+            Run callback every interval seconds, starting one interval from now.
+            Late runs don't queue up; missed slots are skipped.
+        """
+        timer = Timer(time.time() + interval, interval, callback, args)
+        self.push(timer)
+        return timer
+
+    def call_soon_threadsafe(self, callback, *args):
+        self.ready.append((callback, args))
+        if threading.current_thread().ident != self.thread_ident:
+            self.wakeup()
+
+    def push(self, timer):
+        if self.thread_ident is not None and \
+                threading.current_thread().ident != self.thread_ident:
+            # The heap belongs to the loop thread
+            self.call_soon_threadsafe(self.push, timer)
+            return
+        heapq.heappush(self.timers, (timer.when, next(self.counter), timer))
+
+    def wakeup(self):
+        try:
+            os.write(self.wake_write, b'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+    def drain_wakeups(self):
+        os.read(self.wake_read, 4096)
+
+    def add_reader(self, fileobj, callback, *args):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.readers[fd] = (callback, args)
+
+    def remove_reader(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.readers.pop(fd, None)
+
+    def add_writer(self, fileobj, callback, *args):
+        """
+            callback(*args) whenever fileobj can take more data, until removed.
+        """
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.writers[fd] = (callback, args)
+
+    def remove_writer(self, fileobj):
+        fd = fileobj if isinstance(fileobj, int) else fileobj.fileno()
+        self.writers.pop(fd, None)
+
+    def run_forever(self):
+        self.running = True
+        self.thread_ident = threading.current_thread().ident
+        try:
+            while self.running:
+                self.run_once()
+        finally:
+            self.thread_ident = None
+
+    def run_once(self):
+        timeout = None
+        if self.ready:
+            timeout = 0
+        elif self.timers:
+            timeout = max(0, self.timers[0][0] - time.time())
+
+        try:
+            readable, writable, _ = select.select(list(self.readers), list(self.writers), [], timeout)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            readable = writable = []
+        for fd in readable:
+            if fd in self.readers:
+                callback, args = self.readers[fd]
+                self.run_callback(callback, args)
+        for fd in writable:
+            if fd in self.writers:
+                callback, args = self.writers[fd]
+                self.run_callback(callback, args)
+
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+            _, _, timer = heapq.heappop(self.timers)
+            if timer.cancelled:
+                continue
+            if timer.interval is not None:
+                timer.when += timer.interval
+                if timer.when <= now:
+                    missed = int((now - timer.when) / timer.interval) + 1
+                    timer.when += missed * timer.interval
+                heapq.heappush(self.timers, (timer.when, next(self.counter), timer))
+            self.run_callback(timer.callback, timer.args)
+
+        for _ in range(len(self.ready)):
+            callback, args = self.ready.popleft()
+            self.run_callback(callback, args)
+
+    def run_callback(self, callback, args):
+        # Like SocketServer's handle_error, one failing callback shouldn't
+        # take the whole loop down.
+        try:
+            callback(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def stop(self):
+        self.running = False
+        if threading.current_thread().ident != self.thread_ident:
+            self.wakeup()
+
+    def close(self):
+        os.close(self.wake_read)
+        os.close(self.wake_write)
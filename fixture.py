@@ -0,0 +1,195 @@
+"""
+fixture.py
+
+Declarative fixture profiles.
+
+A profile is a JSON (or, with PyYAML installed, YAML) file in fixtures/ that
+describes a DMX fixture's channel map, magic values, pan dead zones and tilt
+limits. Channel numbers are the ones from the fixture's manual, i.e. with the
+fixture patched at DMX address 1. Fixture compiles a profile for one start
+address into absolute channel numbers and lookup-table encoders.
+"""
+import json
+import os
+
+from util import degrees_to_dmx, percent_to_dmx, tilt_to_dmx
+
+from calibration import Calibration
+
+UNIVERSE_SIZE = 512
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+DEFAULT_PROFILE = os.path.join(FIXTURE_DIR, 'space_cannon_ii.json')
+
+CHANNELS = (
+    'master_control',
+    'brightness',
+    'strobe',
+    'pan_location',
+    'tilt',
+    'pan_movement',
+    'speed',
+)
+
+VALUES = (
+    'master_lamp_off',
+    'master_lamp_on',
+    'pan_goto_pos',
+    'pan_cw',
+    'pan_ccw',
+)
+
+
+def load_profile(path=DEFAULT_PROFILE):
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml
+            profile = yaml.safe_load(f)
+        else:
+            profile = json.load(f)
+    for name in profile['channels']:
+        if name not in CHANNELS:
+            raise ValueError('%s: unknown channel %r' % (path, name))
+    for name in VALUES:
+        if name not in profile['values']:
+            raise ValueError('%s: missing value %r' % (path, name))
+    return profile
+
+
+def pan_dead_zones(profile):
+    # A zone at 0 only covers 0->size, so profiles list 360 as well to cover
+    # the other half of it.
+    size = profile['pan_dead_zones']['size']
+    return [(max(0, x-size), min(360, x+size))
+        for x in profile['pan_dead_zones']['locations']]
+
+
+class Fixture(object):
+    """
+        One fixture patched at start_address of a universe on a DMX port.
+        A port of None means util.get_default_port().
+
+        Channels the profile doesn't have are None and their writes are skipped.
+        Call compile() again after the profile changes.
+    """
+    __slots__ = ('name', 'start_address', 'port', 'universe', 'calibration', 'channels') + \
+        tuple('channel_' + name for name in CHANNELS) + VALUES
+
+    def __init__(self, profile, start_address=1, port=None, universe=0):
+        self.start_address = start_address
+        self.port = port
+        self.universe = universe
+        self.calibration = None
+        self.compile(profile)
+
+    def compile(self, profile):
+        self.name = profile['name']
+        if not 1 <= self.start_address <= UNIVERSE_SIZE:
+            raise ValueError('%s: address %s out of range 1-%d' %
+                (self.name, self.start_address, UNIVERSE_SIZE))
+        self.channels = []
+        for name in CHANNELS:
+            channel = profile['channels'].get(name)
+            if channel is not None:
+                channel += self.start_address - 1
+                if not 1 <= channel <= UNIVERSE_SIZE:
+                    raise ValueError('%s at address %s: channel %s out of range' %
+                        (self.name, self.start_address, name))
+                self.channels.append(channel)
+            setattr(self, 'channel_' + name, channel)
+        for name in VALUES:
+            setattr(self, name, profile['values'][name])
+
+        tilt_low, tilt_high = profile['tilt_limits']
+        if self.calibration is None:
+            self.calibration = Calibration(pan_dead_zones(profile), tilt_low, tilt_high)
+        else:
+            self.calibration.rebuild(pan_dead_zones(profile), tilt_low, tilt_high)
+
+    def home(self, dmx):
+        """
+            Lamp off, pointing at 180 degrees, horizontal and at 25% speed.
+        """
+        self.set_lamp(dmx, 0)
+        if self.channel_pan_location is not None:
+            dmx.setChannel(self.channel_pan_location, degrees_to_dmx(180), autoRender=False)
+        if self.channel_tilt is not None:
+            dmx.setChannel(self.channel_tilt, tilt_to_dmx(0), autoRender=False)
+        if self.channel_speed is not None:
+            dmx.setChannel(self.channel_speed, percent_to_dmx(25), autoRender=False)
+
+    def set_lamp(self, dmx, percent):
+        if self.channel_master_control is not None:
+            dmx.setChannel(self.channel_master_control,
+                self.master_lamp_off if percent == 0 else self.master_lamp_on, autoRender=False)
+        if percent == 0:
+            return
+        if self.channel_brightness is not None:
+            dmx.setChannel(self.channel_brightness, self.calibration.brightness(percent), autoRender=False)
+
+    def set_pan_position(self, dmx, position_degrees):
+        self.set_rotation_direction(dmx, None)
+        self.set_pan_location(dmx, position_degrees)
+
+    def set_pan_location(self, dmx, position_degrees):
+        """
+            Only the location, which the lamp goes to when it isn't rotating.
+        """
+        if self.channel_pan_location is not None:
+            dmx.setChannel(self.channel_pan_location, self.calibration.pan(position_degrees), autoRender=False)
+
+    def set_movement(self, dmx, clockwise, speed_percent):
+        self.set_rotation_direction(dmx, clockwise)
+        self.set_speed(dmx, speed_percent)
+
+    def set_rotation_direction(self, dmx, clockwise):
+        """
+            clockwise of None stops rotating and goes to the pan location.
+        """
+        if self.channel_pan_movement is not None:
+            if clockwise is None:
+                movement = self.pan_goto_pos
+            else:
+                movement = self.pan_cw if clockwise else self.pan_ccw
+            dmx.setChannel(self.channel_pan_movement, movement, autoRender=False)
+
+    def set_speed(self, dmx, speed_percent):
+        if self.channel_speed is not None:
+            dmx.setChannel(self.channel_speed, self.calibration.percent(speed_percent), autoRender=False)
+
+    def set_tilt(self, dmx, tilt_degrees):
+        if self.channel_tilt is not None:
+            dmx.setChannel(self.channel_tilt, self.calibration.tilt(tilt_degrees), autoRender=False)
+
+    def set_strobe(self, dmx, strobe_percent):
+        if self.channel_strobe is not None:
+            dmx.setChannel(self.channel_strobe, self.calibration.percent(strobe_percent), autoRender=False)
+
+
+def patch(fixtures):
+    """
+        Build Fixtures from (profile_path, start_address[, port[, universe]])
+        tuples, loading each profile once. Overlaps are checked when the
+        fixtures are placed on a universe.UniverseManager.
+    """
+    profiles = {}
+    result = []
+    for entry in fixtures:
+        path = entry[0]
+        if path not in profiles:
+            profiles[path] = load_profile(path)
+        result.append(Fixture(profiles[path], *entry[1:]))
+    return result
+
+
+def load_patch(path):
+    """
+        Read a patch file: a JSON list of objects with "profile" (a path
+        relative to fixtures/), "address", and optional "port" and "universe".
+        An Enttec port has only universe 0; network ports have any.
+    """
+    with open(path) as f:
+        entries = json.load(f)
+    return patch([
+        (os.path.join(FIXTURE_DIR, entry['profile']), entry['address'],
+         entry.get('port'), entry.get('universe', 0))
+        for entry in entries])
@@ -0,0 +1,61 @@
+"""
+inbox.py
+
+Latest-value-wins coalescing of OSC commands.
+
+Dragging a TouchOSC slider sends dozens of messages a second for the same
+address, but only the newest position matters. Commands are posted to a
+CoalescingInbox as they arrive and applied once per frame by drain(). A
+continuous address keeps only its newest pending value, moved to the end of
+the queue; discrete addresses keep every message in arrival order.
+"""
+import collections
+import itertools
+import threading
+import traceback
+
+
+class CoalescingInbox(object):
+
+    def __init__(self, discrete_addresses=()):
+        self.discrete_addresses = set(discrete_addresses)
+        self.pending = collections.OrderedDict()
+        self.counter = itertools.count()
+        self.lock = threading.Lock()
+        self.received = collections.defaultdict(int)
+        self.applied = collections.defaultdict(int)
+
+    def post(self, address, function, args):
+        if address in self.discrete_addresses:
+            key = (address, next(self.counter))
+        else:
+            key = address
+        with self.lock:
+            self.received[address] += 1
+            self.pending.pop(key, None)
+            self.pending[key] = (address, function, args)
+
+    def drain(self):
+        """
+            Apply everything pending, in order. Returns how many were applied.
+        """
+        with self.lock:
+            if not self.pending:
+                return 0
+            pending = self.pending
+            self.pending = collections.OrderedDict()
+        for address, function, args in pending.itervalues():
+            self.applied[address] += 1
+            try:
+                function(*args)
+            except Exception:
+                traceback.print_exc()
+        return len(pending)
+
+    def stats(self):
+        """
+            {address: (received, applied)}
+        """
+        with self.lock:
+            return dict((address, (count, self.applied[address]))
+                for address, count in self.received.iteritems())
@@ -0,0 +1,480 @@
+"""
+journal.py
+
+Session journal: what the tablets sent and what the lamp did.
+
+A Journal appends every OSC datagram oscrecv receives, before rate limiting
+or routing, web panel commands as the OSC datagrams they stand for, from the
+browser's address, and the channels that changed in each DMX frame to a
+binary file.
+Records are queued in memory and written by a background thread every
+FLUSH_INTERVAL, so neither the event loop nor the render thread touches the
+disk. If the writer falls more than MAX_PENDING bytes behind, records are
+dropped and counted rather than held. Files rotate to path.1 .. path.N like
+the metrics log, and each session starts a new one.
+
+Every file starts with MAGIC, and the first frame after a file is opened
+records the universes, a keyframe of each and the rest of the look, so it
+can be read and replayed on its own. Changes to a universe before its
+keyframe are skipped. Then each record is
+
+    uint16 payload length, char kind, float64 time, payload
+
+    'U'  uint8 index, uint16 universe, port name       a universe
+    'K'  uint8 index, start code and 512 channel values a whole universe
+    'L'  16 byte owner, bool idle, 32 byte show,        who had control, the
+         float64 show start time                        idle flag and the show
+    'O'  4 byte IPv4 address, uint16 port, datagram     an OSC datagram
+    'D'  uint8 index, then uint16 channel, uint8 value  changed channels
+         for every change
+
+Read one back, or feed its OSC traffic to a fresh server on recording fake
+Enttecs, at the recorded pace or with --speed 0 as fast as possible. The
+server starts from the journal's first look, on the session's patch file if
+it had one, and without the web panel, metrics, network DMX or routes the
+environment may turn on:
+
+    python journal.py dump /tmp/lighthouse.journal
+    python journal.py replay /tmp/lighthouse.journal --speed 1 --patch patch.json
+"""
+import itertools
+import os
+import socket
+import struct
+import threading
+import time
+
+from state import Snapshot
+
+DEFAULT_PATH = os.path.join(os.environ.get('TMPDIR', '/tmp'), 'lighthouse.journal')
+MAGIC = 'LHJRNL2\n'
+MAX_BYTES = 1024 * 1024
+BACKUPS = 4
+FLUSH_INTERVAL = .5
+MAX_PENDING = 256 * 1024
+
+RECORD = struct.Struct('<Hcd')
+SOURCE = struct.Struct('<4sH')
+UNIVERSE = struct.Struct('<BH')
+INDEX = struct.Struct('<B')
+CHANGE = struct.Struct('<HB')
+LOOK = struct.Struct('<16s?32sd')
+
+REPLAY_PORT = 18020
+# Before comparing, the replayed universes have to stay put this long, with
+# the motion smoother at rest, or the timeout pass
+REPLAY_QUIET = .5
+REPLAY_SETTLE_TIMEOUT = 10
+# Extras oscrecv turns on from the environment, off for a replay so it can't
+# bind the live server's ports or send to its nodes
+REPLAY_UNSET = ('LIGHTHOUSE_WEB_PORT', 'LIGHTHOUSE_METRICS', 'LIGHTHOUSE_METRICS_LOG',
+                'LIGHTHOUSE_DMX_INPUT', 'LIGHTHOUSE_DMX_MIRROR', 'LIGHTHOUSE_ROUTES')
+
+
+def record(kind, now, payload):
+    return RECORD.pack(len(payload), kind, now) + payload
+
+
+class JournalWriter(object):
+    """
+        Writes queued records to a rotating file from its own thread.
+        new_file() is called whenever it starts one.
+    """
+
+    def __init__(self, path, new_file, max_bytes=MAX_BYTES, backups=BACKUPS,
+                 flush_interval=FLUSH_INTERVAL, max_pending=MAX_PENDING):
+        self.path = path
+        self.new_file = new_file
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = []
+        self.pending_bytes = 0
+        self.file = None
+        self.written = 0
+        self.dropped = 0
+        self.die = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='JournalWriter')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def append(self, data):
+        with self.lock:
+            if self.pending_bytes + len(data) > self.max_pending:
+                self.dropped += 1
+                return
+            self.pending.append(data)
+            self.pending_bytes += len(data)
+
+    def run(self):
+        while not self.die:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.write_pending()
+            except (IOError, OSError) as e:
+                print 'Journal write to', self.path, 'failed:', e
+        self.write_pending()
+
+    def write_pending(self):
+        with self.lock:
+            data, self.pending = self.pending, []
+            self.pending_bytes = 0
+        if not data:
+            return
+        if self.file is None:
+            self.open()
+        data = ''.join(data)
+        self.file.write(data)
+        self.file.flush()
+        self.written += len(data)
+        if self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def open(self):
+        # A new session never appends to the last one's file
+        if os.path.exists(self.path) and os.path.getsize(self.path):
+            self.shift()
+        self.start_file()
+
+    def start_file(self):
+        self.file = open(self.path, 'wb')
+        self.file.write(MAGIC)
+        self.new_file()
+
+    def shift(self):
+        for index in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, index + 1))
+        os.rename(self.path, self.path + '.1')
+
+    def rotate(self):
+        self.file.close()
+        self.shift()
+        self.start_file()
+
+    def close(self):
+        self.die = True
+        self.wake.set()
+        self.thread.join()
+        if self.file is not None:
+            self.file.close()
+
+
+class Journal(object):
+    """
+        Records OSC datagrams with osc(), and DMX changes as a RenderLoop
+        frame hook once it watches some universes.
+    """
+
+    def __init__(self, path=DEFAULT_PATH, **writer_options):
+        self.universes = []
+        self.describe = None
+        self.last_buffers = []
+        self.osc_records = 0
+        self.dmx_records = 0
+        self.keyframe_due = True
+        self.writer = JournalWriter(path, self.new_file, **writer_options)
+
+    def watch(self, universes, describe=None):
+        """
+            describe() returns (owner, idle, show, show_started) for the look
+            recorded with each keyframe, see state.StateSaver.
+        """
+        self.universes = list(universes)
+        self.describe = describe
+        self.last_buffers = [bytearray(universe.buffer) for universe in self.universes]
+        self.keyframe_due = True
+
+    def new_file(self):
+        # From the writer thread, the render thread writes the keyframes
+        self.keyframe_due = True
+
+    def keyframe(self, now):
+        for index, universe in enumerate(self.universes):
+            self.last_buffers[index][:] = universe.buffer
+            self.writer.append(record('U', now, UNIVERSE.pack(index, universe.universe) +
+                                      str(universe.port).encode('utf-8')))
+            self.writer.append(record('K', now, INDEX.pack(index) + str(self.last_buffers[index])))
+        if self.describe is not None:
+            owner, idle, show, show_started = self.describe()
+            self.writer.append(record('L', now, LOOK.pack(str(owner or ''), idle,
+                (show or u'').encode('utf-8'), show_started or 0)))
+
+    def osc(self, address, packet, now=None):
+        """
+            address is the (ip, port) the datagram came from.
+        """
+        try:
+            source = SOURCE.pack(socket.inet_aton(address[0]), address[1])
+        except socket.error:
+            source = SOURCE.pack('\0\0\0\0', address[1])
+        self.writer.append(record('O', now if now is not None else time.time(), source + packet))
+        self.osc_records += 1
+
+    def __call__(self, now):
+        if self.keyframe_due:
+            self.keyframe_due = False
+            self.keyframe(now)
+            return
+        for index, universe in enumerate(self.universes):
+            buffer = universe.buffer
+            last = self.last_buffers[index]
+            if buffer == last:
+                continue
+            changes = [CHANGE.pack(channel, value)
+                for channel, (value, old) in enumerate(itertools.izip(buffer, last))
+                if value != old]
+            last[:] = buffer
+            self.writer.append(record('D', now, INDEX.pack(index) + ''.join(changes)))
+            self.dmx_records += 1
+
+    def stats(self):
+        return {
+            'osc': self.osc_records,
+            'dmx': self.dmx_records,
+            'bytes': self.writer.written,
+            'dropped': self.writer.dropped,
+        }
+
+    def close(self):
+        self.writer.close()
+
+
+def read_journal(path):
+    """
+        Yield (time, kind, source, value) from a journal file:
+            ('osc', (ip, port), datagram)
+            ('frame', (port, universe), bytearray of all channels)
+            ('look', None, (owner, idle, show, show_started))
+        with a frame for every keyframe and DMX change.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if not data.startswith(MAGIC):
+        raise ValueError('%s is not a journal' % path)
+    universes = {}
+    buffers = {}
+    offset = len(MAGIC)
+    while offset + RECORD.size <= len(data):
+        length, kind, when = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        payload = data[offset:offset + length]
+        offset += length
+        if len(payload) < length:
+            # Cut short by a crash or a pull mid-write
+            return
+        if kind == 'U':
+            index, universe = UNIVERSE.unpack_from(payload)
+            universes[index] = (payload[UNIVERSE.size:].decode('utf-8'), universe)
+            buffers.pop(index, None)
+        elif kind == 'K':
+            index, = INDEX.unpack_from(payload)
+            buffers[index] = bytearray(payload[INDEX.size:])
+            yield when, 'frame', universes[index], bytearray(buffers[index])
+        elif kind == 'O':
+            address, port = SOURCE.unpack_from(payload)
+            yield when, 'osc', (socket.inet_ntoa(address), port), payload[SOURCE.size:]
+        elif kind == 'L':
+            owner, idle, show, show_started = LOOK.unpack(payload)
+            yield when, 'look', None, (owner.rstrip('\0') or None, idle,
+                show.rstrip('\0') or None, show_started)
+        elif kind == 'D':
+            index, = INDEX.unpack_from(payload)
+            buffer = buffers.get(index)
+            if buffer is None:
+                continue
+            for position in range(INDEX.size, length, CHANGE.size):
+                channel, value = CHANGE.unpack_from(payload, position)
+                buffer[channel] = value
+            yield when, 'frame', universes[index], bytearray(buffer)
+        else:
+            raise ValueError('%s: bad record at byte %d' % (path, offset - length - RECORD.size))
+
+
+def dump(path):
+    from OSC import decodeOSC
+    last = {}
+    for when, kind, source, value in read_journal(path):
+        stamp = time.strftime('%H:%M:%S', time.localtime(when)) + ('%.3f' % (when % 1))[1:]
+        if kind == 'osc':
+            try:
+                message = decodeOSC(value)
+            except Exception:
+                message = repr(value)
+            print stamp, 'osc  ', '%s:%d' % source, message
+        elif kind == 'look':
+            print stamp, 'look ', 'owner %s, idle %s, show %s' % value[:3]
+        else:
+            previous = last.get(source)
+            changes = [(channel, v) for channel, v in enumerate(value)
+                if previous is None or previous[channel] != v]
+            last[source] = value
+            if previous is None:
+                print stamp, 'frame', '%s/%d' % source, 'keyframe'
+            else:
+                print stamp, 'frame', '%s/%d' % source, ' '.join('%d=%d' % change for change in changes)
+
+
+def wait_settled(server, quiet=REPLAY_QUIET, timeout=REPLAY_SETTLE_TIMEOUT):
+    """
+        Wait for server's universes to stop changing, so an eased pan or tilt
+        is compared where it ends up. Returns False on timeout.
+    """
+    universes = server.universes.universes.values()
+    deadline = time.time() + timeout
+    last = None
+    still_since = time.time()
+    while time.time() < deadline:
+        buffers = [str(universe.buffer) for universe in universes]
+        moving = server.smoother is not None and server.smoother.moving
+        if buffers != last or moving:
+            last = buffers
+            still_since = time.time()
+        elif time.time() - still_since >= quiet:
+            return True
+        time.sleep(.05)
+    return False
+
+
+def replay_address(addresses, ip):
+    """
+        The 127.0.0.x address a replay sends ip's datagrams from.
+    """
+    return addresses.setdefault(ip, '127.0.0.%d' % (11 + len(addresses)))
+
+
+def first_look(records, first, addresses):
+    """
+        A state.Snapshot of the look records start with, the first keyframe
+        of each universe and the first look record, or None without one.
+        Its show start is moved so the show is where it was at time first
+        when the replay starts, and its owner is the owner's replay address.
+    """
+    universes = {}
+    look = None
+    for when, kind, source, value in records:
+        if kind == 'frame' and source not in universes:
+            universes[source] = value[1:]
+        elif kind == 'look' and look is None:
+            look = when, value
+    if look is None:
+        return None
+    when, (owner, idle, show, show_started) = look
+    if owner is not None:
+        owner = replay_address(addresses, owner)
+    if show is not None:
+        show_started = time.time() - (first - show_started)
+    return Snapshot(when, owner, idle, show, show_started, universes)
+
+
+class ReplayState(object):
+    """
+        The state.StateFile a replay server starts from: it loads a journal's
+        first look and saves nothing.
+    """
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+
+    def load(self):
+        return self.snapshot
+
+    def save(self, owner, idle, show, show_started, universes):
+        pass
+
+
+def replay(paths, speed=1.0, port=REPLAY_PORT, patch=None):
+    """
+        Send the OSC datagrams of journal files to a fresh server on recording
+        fake Enttecs, each client from its own 127.0.0.x address, and compare
+        its universes with the recorded ones at the end. patch is the
+        session's patch file, if it had one.
+    """
+    for name in REPLAY_UNSET:
+        os.environ.pop(name, None)
+    import oscrecv
+    from dmx import open_recording_device
+    from fixture import Fixture, load_patch, load_profile
+    from universe import UniverseManager
+
+    records = [entry for path in paths for entry in read_journal(path)]
+    datagrams = [(when, source, value) for when, kind, source, value in records if kind == 'osc']
+    recorded = {}
+    for when, kind, source, value in records:
+        if kind == 'frame':
+            recorded[source] = value
+    first = datagrams[0][0] if datagrams else 0
+    addresses = {}
+    for when, source, packet in datagrams:
+        replay_address(addresses, source[0])
+
+    fixtures = None
+    if patch:
+        fixtures = load_patch(patch)
+    elif len(recorded) == 1:
+        # The default lamp, on the port it was recorded from
+        (recorded_port, universe), = recorded.keys()
+        fixtures = [Fixture(load_profile(), port=recorded_port, universe=universe)]
+    server = oscrecv.LighthouseOSCCallbacks(oscrecv.LIGHT_FUNCTIONS, fixtures, recv_port=port,
+        universes=UniverseManager(open_recording_device),
+        state=ReplayState(first_look(records, first, addresses)))
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+
+    senders = {}
+    start = time.time()
+    for when, source, packet in datagrams:
+        sock = senders.get(source[0])
+        if sock is None:
+            sock = senders[source[0]] = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind((addresses[source[0]], 0))
+        if speed:
+            delay = start + (when - first) / speed - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        sock.sendto(packet, ('127.0.0.1', port))
+    elapsed = time.time() - start
+    if not wait_settled(server):
+        print 'The universes were still changing after %d s, comparing them anyway' % REPLAY_SETTLE_TIMEOUT
+
+    print
+    print 'replayed %d datagrams from %d clients in %.2f s, %.0f a second' % (
+        len(datagrams), len(senders), elapsed, len(datagrams) / max(elapsed, 1e-6))
+    print 'OSC messages (received, applied):', server.inbox.stats()
+    print 'rate limited:', server.arbiter.rejected
+    for key, universe in sorted(server.universes.universes.items()):
+        expected = recorded.get(key)
+        if expected is None:
+            print '%s universe %d: not in the journal, was the session patched differently?' % key
+            continue
+        differences = [(channel, universe.buffer[channel], expected[channel])
+            for channel in range(len(expected)) if universe.buffer[channel] != expected[channel]]
+        print '%s universe %d: %s' % (key + ('matches the journal' if not differences else
+            ', '.join('channel %d is %d, recorded %d' % difference for difference in differences),))
+
+    server.loop.call_soon_threadsafe(server.close)
+    thread.join()
+    server.dmx.disconnect()
+    for sock in senders.values():
+        sock.close()
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description='Read or replay a session journal.')
+    parser.add_argument('command', choices=['dump', 'replay'])
+    parser.add_argument('paths', nargs='+', help='journal files, oldest first')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='replay pace, 1 as recorded, 0 as fast as possible')
+    parser.add_argument('--port', type=int, default=REPLAY_PORT)
+    parser.add_argument('--patch', help="the session's LIGHTHOUSE_PATCH file, if it had one")
+    args = parser.parse_args()
+    if args.command == 'dump':
+        for path in args.paths:
+            dump(path)
+    else:
+        replay(args.paths, args.speed, args.port, args.patch)
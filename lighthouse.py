@@ -1,83 +1,119 @@
 import time
 
-from util import (
-    brightness_percent_to_dmx,
-    degrees_to_dmx,
-    get_default_port,
-    percent_to_dmx,
-    tilt_to_dmx,
-)
+from util import get_default_port
 
-from dmx import Dmx
+from fixture import Fixture, load_profile
+from motion import MotionController
+from render_loop import RenderLoop
+import show
+from smoothing import MotionSmoother
+from state import StateSaver
+from universe import UniverseManager
 
-CHANNEL_MASTER_CONTROL = 4
-MASTER_LAMP_OFF = 100
-MASTER_LAMP_ON = 255
+# Speed must be < 50% to safely change direction
+DIRECTION_CHANGE_DELAY = 1
+IDLE_SETTLE_DELAY = .5
+SHUTDOWN_DELAY = 2
+# Longest shutdown_light waits for its steps before turning the lamp off itself
+SHUTDOWN_TIMEOUT = 10
 
-CHANNEL_BRIGHTNESS = 6
-# simple 0-255 scale
+class Lighthouse(object):
 
-CHANNEL_PAN_LOCATION = 8
+    def __init__(self, frame_rate=None, fixtures=None, universes=None, state=None,
+                 smoothing=True):
+        """
+            With a frame_rate, set_* calls only update the universe buffers and
+            a RenderLoop sends at most frame_rate frames per second. Without
+            one, every call renders straight to the devices.
 
-CHANNEL_PAN_MOVMENT = 12
-PAN_GOTO_POS = 0
-PAN_CW = 128
-PAN_CCW = 250
+            fixtures is a list of fixture.Fixture, each on its own port and
+            universe, all driven together and flushed in the same pass.
+            Defaults to one Space Cannon at address 1 of the default port.
 
-CHANNEL_SPEED = 15
-# Speed must be < 50% to safely change direction
+            universes is the UniverseManager to patch them onto, for example
+            one opening dmx.RecordingDmx devices for benchmarks.
 
-CHANNEL_TILT = 10
-TILT_LOW = 0
-TILT_VERTICAL = 128
-TILT_LOW_CONTROLBOX_SIDE = 255
-TILT_LOW_DEGREES = -120
-TILT_VERTICAL_DEGREES = 0
-
-CHANNEL_STROBE = 7
-STROBE_MIN = 25
-
-PAN_DEAD_ZONE_LOCATIONS = [0, 60, 120, 180, 240, 300, 360]
-# 0 only goes from 0->deadzonesize so we include 360 to cover the half of the deadzone side
-PAN_DEAD_ZONE_SIZE = 10
-PAN_DEAD_ZONES = [(max(0,x-PAN_DEAD_ZONE_SIZE), min(360, x+PAN_DEAD_ZONE_SIZE)) for x in PAN_DEAD_ZONE_LOCATIONS]
-
-TILT_LIMIT_LOW = -5
-TILT_LIMIT_HIGH = 70
-
-def reposition_from_pan_deadzone(position_degrees):
-    for lower_bound, upper_bound in PAN_DEAD_ZONES:
-        if position_degrees < lower_bound:
-            break
-        if lower_bound <= position_degrees <= upper_bound:
-            if (position_degrees - lower_bound) < (upper_bound - position_degrees):
-                return max(lower_bound - 1, PAN_DEAD_ZONES[0][1]+1)
-            else:
-                return upper_bound + 1
-    if position_degrees > PAN_DEAD_ZONES[-1][1]:
-        return True, PAN_DEAD_ZONES[-1][0]-1
-    return position_degrees
+            state is a state.StateFile. The universes saved in it are restored
+            instead of homing the lamp; call restore_state(self.restored) once
+            the shows are loaded for the rest of it.
 
-def reposition_from_tilt_deadzone(tilt_degrees):
-    tilt_degrees = max(TILT_LIMIT_LOW, tilt_degrees)
-    tilt_degrees = min(TILT_LIMIT_HIGH, tilt_degrees)
-    return tilt_degrees
+            With a frame_rate and smoothing, pan and tilt commands set targets
+            a smoothing.MotionSmoother eases the lamp to, frame by frame.
+        """
+        self.brightness = 0
+        self.port = get_default_port()
+        if fixtures is None:
+            fixtures = [Fixture(load_profile(), port=self.port)]
 
-class Lighthouse(object):
+        self.universes = universes if universes is not None else UniverseManager()
+        self.outputs = self.universes.patch(fixtures)
+        self.dmx = self.universes
+        self.player = None
+        self.smoother = None
+        self.shows = {}
+        self.motion = MotionController()
+        self.state = state
+        self.restored = state.load() if state is not None else None
+        if not self.restore_universes(self.restored):
+            for fixture, universe in self.outputs:
+                fixture.home(universe)
+        if frame_rate:
+            self.dmx = RenderLoop(self.universes, frame_rate)
+            self.player = show.ShowPlayer()
+            self.dmx.add_frame_hook(self.player)
+            if smoothing:
+                # Starts from the homed or restored channels
+                self.smoother = MotionSmoother(self.outputs)
+                self.dmx.add_frame_hook(self.smoother)
+            self.dmx.start()
+        self.dmx.render()
 
-    def __init__(self):
-        self.brightness = 0
+    def restore_universes(self, snapshot):
+        """
+            Put back the channels of a state.Snapshot for the patched universes.
+            Returns False if it had none of them.
+        """
+        if snapshot is None:
+            return False
+        restored = False
+        for _, universe in self.outputs:
+            channels = snapshot.universes.get((universe.port, universe.universe))
+            if channels is not None:
+                universe.apply_changes(enumerate(channels, 1))
+                restored = True
+        return restored
 
-        self.dmx = Dmx() #EnttecUsbDmxPro.EnttecUsbDmxPro()
-        self.port = get_default_port()
-        self.dmx.setPort(self.port, baud=250000)
-        self.dmx.connect()
-        # print 'EntTec serial number:', self.dmx.getWidgetSerialNumber()
-        # self.dmx.setDebug('SerialBuffer', True)
-        self.dmx.setChannel(CHANNEL_MASTER_CONTROL, MASTER_LAMP_OFF, autoRender=False)
-        self.dmx.setChannel(CHANNEL_PAN_LOCATION, degrees_to_dmx(180), autoRender=False)  # pan location
-        self.dmx.setChannel(CHANNEL_TILT, tilt_to_dmx(0), autoRender=False)  # tilt to 0 degrees (horizontal)
-        self.dmx.setChannel(CHANNEL_SPEED, percent_to_dmx(25), autoRender=False) # set speed
+    def describe_state(self):
+        """
+            (owner, idle, show, show_started) to save, see state.StateSaver.
+        """
+        name = self.player.playing()
+        return (None, False, name, self.player.start_time if name else 0)
+
+    def restore_state(self, snapshot):
+        """
+            Carry on with the show that was playing, from where it would be now,
+            and save the state from every frame on.
+        """
+        if snapshot is not None and snapshot.show in self.shows:
+            self.play_show(snapshot.show, time.time() - snapshot.show_started)
+        if self.state is not None and self.player is not None:
+            self.dmx.add_frame_hook(StateSaver(self.state, self.patched_universes(),
+                                               self.describe_state))
+
+    def patched_universes(self):
+        return sorted(set(universe for _, universe in self.outputs),
+            key=lambda universe: (universe.port, universe.universe))
+
+    def network_input(self):
+        """
+            A console on the network wrote the universes, see netdmx.Receiver.
+            Stop whatever else would write over it and send the frame.
+        """
+        self.motion.cancel()
+        self.stop_show()
+        if self.smoother is not None:
+            self.smoother.hold()
         self.dmx.render()
 
     def set_lamp(self, int_brightness):
@@ -85,13 +121,10 @@ class Lighthouse(object):
         Brightness is a percentage, 0-100%
 
         """
+        self.stop_show()
         self.brightness = int_brightness
-        if self.brightness == 0:
-            self.dmx.setChannel(CHANNEL_MASTER_CONTROL, MASTER_LAMP_OFF, autoRender=False)
-            self.dmx.render()
-            return
-        self.dmx.setChannel(CHANNEL_MASTER_CONTROL, MASTER_LAMP_ON, autoRender=False)
-        self.dmx.setChannel(CHANNEL_BRIGHTNESS, brightness_percent_to_dmx(self.brightness), autoRender=False)
+        for fixture, universe in self.outputs:
+            fixture.set_lamp(universe, self.brightness)
         self.dmx.render()
 
     def set_pan_position(self, position_degrees):
@@ -100,25 +133,39 @@ class Lighthouse(object):
         """
         # Disable rotation
         # TODO - determine magic value that must be sent to stop rotating
-        self.dmx.setChannel(CHANNEL_PAN_MOVMENT, 0, autoRender=False)
-
-        position_degrees = reposition_from_pan_deadzone(position_degrees)
-        self.dmx.setChannel(CHANNEL_PAN_LOCATION, degrees_to_dmx(position_degrees), autoRender=False)
+        self.motion.cancel()
+        self.stop_show()
+        # Dead zones are already applied by the fixtures' lookup tables
+        for fixture, universe in self.outputs:
+            if self.smoother is not None:
+                fixture.set_rotation_direction(universe, None)
+            else:
+                fixture.set_pan_position(universe, position_degrees)
+        if self.smoother is not None:
+            self.smoother.set_pan(position_degrees)
         self.dmx.render()
 
     def set_rotation(self, clockwise, speed=100):
         """
             Set rotation and speed
-            TODO - assert speed < 50% if already moving
+
+            Speed is dropped to 0 straight away and the direction change and
+            new speed are applied DIRECTION_CHANGE_DELAY later by the motion
+            controller, so this returns immediately. A later movement command
+            replaces the pending steps.
         """
-        self.dmx.setChannel(CHANNEL_SPEED, percent_to_dmx(0), autoRender=False)
-        self.dmx.render()
-        time.sleep(1)
-        if clockwise:
-            self.dmx.setChannel(CHANNEL_PAN_MOVMENT, PAN_CW, autoRender=False)
-        else:
-            self.dmx.setChannel(CHANNEL_PAN_MOVMENT, PAN_CCW, autoRender=False)
-        self.dmx.setChannel(CHANNEL_SPEED, percent_to_dmx(speed), autoRender=False)
+        self.stop_show()
+        self.motion.replace(self.rotation_steps(clockwise, speed))
+
+    def rotation_steps(self, clockwise, speed, delay=0):
+        return [
+            (delay, self.write_speed, (0,)),
+            (delay + DIRECTION_CHANGE_DELAY, self.write_movement, (clockwise, speed)),
+        ]
+
+    def write_movement(self, clockwise, speed_percent):
+        for fixture, universe in self.outputs:
+            fixture.set_movement(universe, clockwise, speed_percent)
         self.dmx.render()
 
     def set_tilt(self, tilt_degrees):
@@ -128,37 +175,90 @@ class Lighthouse(object):
             0 is horizontal, 90 is vertical, 90+ is rotation in the other direction.
             The lowest it can go is -30 degrees.
         """
-        tilt_degrees = reposition_from_tilt_deadzone(tilt_degrees)
-        self.dmx.setChannel(CHANNEL_TILT, tilt_to_dmx(tilt_degrees), autoRender=False)
+        self.stop_show()
+        # Tilt limits are already applied by the fixtures' lookup tables
+        if self.smoother is not None:
+            self.smoother.set_tilt(tilt_degrees)
+        else:
+            for fixture, universe in self.outputs:
+                fixture.set_tilt(universe, tilt_degrees)
         self.dmx.render()
 
     def set_speed(self, speed_percent):
         """
             Set the speed in percent of dmx, range untested on actual lamp
         """
-        self.dmx.setChannel(CHANNEL_SPEED, percent_to_dmx(speed_percent), autoRender=False)
+        self.motion.cancel()
+        self.stop_show()
+        self.write_speed(speed_percent)
+
+    def write_speed(self, speed_percent):
+        for fixture, universe in self.outputs:
+            fixture.set_speed(universe, speed_percent)
         self.dmx.render()
 
     def set_strobe(self, strobe_percent):
         """
             Set the strobe percent of dmx, untested on actual lamp
         """
-        self.dmx.setChannel(CHANNEL_STROBE, percent_to_dmx(strobe_percent), autoRender=False)
+        self.stop_show()
+        for fixture, universe in self.outputs:
+            fixture.set_strobe(universe, strobe_percent)
         self.dmx.render()
 
+    def load_shows(self, directory=show.SHOW_DIR):
+        """
+            Compile every show in directory for this lighthouse's fixtures.
+            Shows need a frame_rate.
+        """
+        for name, definition in show.load_shows(directory).iteritems():
+            self.shows[name] = show.compile_show(definition, self.outputs, self.dmx.frame_rate)
+
+    def play_show(self, name, seconds=0):
+        """
+            Start a show, seconds in. Any set_* command stops it.
+        """
+        if self.player is None:
+            raise RuntimeError('Shows need a Lighthouse with a frame_rate')
+        self.motion.cancel()
+        if self.smoother is not None:
+            self.smoother.hold()
+        self.player.play(self.shows[name], seconds)
+
+    def seek_show(self, seconds):
+        if self.player is not None:
+            self.player.seek(seconds)
+
+    def stop_show(self, ignored=None):
+        if self.player is not None:
+            self.player.stop()
+
     def set_idle(self, ignored):
-        self.set_speed(0)
+        if 'idle' in self.shows:
+            self.play_show('idle')
+            return
+        self.motion.cancel()
+        self.write_speed(0)
         self.set_lamp(95)
         self.set_strobe(0)
         self.set_tilt(5)
-        time.sleep(.5)
-        self.set_rotation(True, speed=50)
+        self.motion.schedule(self.rotation_steps(True, 50, delay=IDLE_SETTLE_DELAY))
 
     def shutdown_light(self):
         """
             It is important to stop the light, turn off the lamp and disconnect.
+
+            Unlike the other commands this blocks until the lamp has stopped.
         """
-        self.set_rotation(True, speed=0)
-        self.set_lamp(0)
-        time.sleep(2)
-        self.dmx.disconnect()
+        steps = self.rotation_steps(True, 0)
+        steps += [
+            (DIRECTION_CHANGE_DELAY, self.set_lamp, (0,)),
+            (DIRECTION_CHANGE_DELAY + SHUTDOWN_DELAY, self.dmx.disconnect, ()),
+        ]
+        self.motion.replace(steps)
+        if not self.motion.wait(SHUTDOWN_TIMEOUT):
+            print 'Lamp still stopping after %d s, turning it off now' % SHUTDOWN_TIMEOUT
+            self.motion.cancel()
+            self.set_lamp(0)
+            self.dmx.disconnect()
+        self.motion.close(SHUTDOWN_TIMEOUT)
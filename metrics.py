@@ -0,0 +1,303 @@
+"""
+metrics.py
+
+Low-overhead counters and latency histograms for the OSC to DMX path.
+
+Metrics(enabled=False) instruments nothing, so a disabled build costs nothing
+on the hot path: instrument() only wraps a method when metrics are on. When on,
+every wrapped call is counted and its duration recorded in a Histogram with
+log-linear buckets (HDR style, about 6% resolution from 1us to minutes).
+
+Snapshots are served as JSON over HTTP on localhost, sent in reply to an OSC
+/metrics query, and appended to a rotating binary log that can be pulled off
+the board and read back with
+
+    python metrics.py dump /var/log/lighthouse/metrics.bin
+"""
+import json
+import os
+import struct
+import sys
+import threading
+import time
+
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Enough buckets for about 10 minutes in microseconds
+BUCKETS = SUB_BUCKETS * 30
+
+HTTP_PORT = 9659
+LOG_INTERVAL = 60
+LOG_MAX_BYTES = 256 * 1024
+LOG_BACKUPS = 4
+
+# Binary log records. Each file starts with a names record so it can be read
+# on its own:
+#   'N' uint16 count, then per name uint8 length + utf-8 bytes
+#   'S' float64 time, uint16 count, then per metric
+#       uint16 name index, uint64 count, uint32 p50, p90, p99, max (us)
+RECORD = struct.Struct('<cH')
+SNAPSHOT_TIME = struct.Struct('<d')
+SNAPSHOT_ENTRY = struct.Struct('<HQIIII')
+
+
+def bucket_index(value):
+    if value < 2 * SUB_BUCKETS:
+        return value
+    shift = value.bit_length() - SUB_BUCKET_BITS - 1
+    return min(BUCKETS - 1, (shift << SUB_BUCKET_BITS) + (value >> shift))
+
+
+def bucket_value(index):
+    if index < 2 * SUB_BUCKETS:
+        return index
+    shift = (index >> SUB_BUCKET_BITS) - 1
+    return (index - (shift << SUB_BUCKET_BITS)) << shift
+
+
+class Histogram(object):
+    """
+        Counts of microsecond values. Updates aren't locked: under the GIL an
+        increment is very rarely lost, which is fine for diagnostics.
+    """
+
+    def __init__(self):
+        self.counts = [0] * BUCKETS
+        self.count = 0
+        self.max = 0
+
+    def record(self, microseconds):
+        self.counts[bucket_index(microseconds)] += 1
+        self.count += 1
+        if microseconds > self.max:
+            self.max = microseconds
+
+    def percentile(self, fraction):
+        if not self.count:
+            return 0
+        wanted = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if count and seen >= wanted:
+                return bucket_value(index)
+        return self.max
+
+    def copy(self):
+        histogram = Histogram()
+        histogram.counts = list(self.counts)
+        histogram.count = self.count
+        histogram.max = self.max
+        return histogram
+
+    def since(self, earlier):
+        """
+            The values recorded since earlier, a copy of this histogram. The
+            max is exact if it is new, otherwise its bucket's value.
+        """
+        histogram = Histogram()
+        histogram.counts = [now - then for now, then in zip(self.counts, earlier.counts)]
+        histogram.count = self.count - earlier.count
+        if self.max > earlier.max:
+            histogram.max = self.max
+        else:
+            used = [index for index, count in enumerate(histogram.counts) if count > 0]
+            histogram.max = bucket_value(used[-1]) if used else 0
+        return histogram
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'p50_us': self.percentile(.5),
+            'p90_us': self.percentile(.9),
+            'p99_us': self.percentile(.99),
+            'max_us': self.max,
+        }
+
+
+class Metrics(object):
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.histograms = {}
+        self.gauges = {}
+
+    def histogram(self, name):
+        if name not in self.histograms:
+            self.histograms[name] = Histogram()
+        return self.histograms[name]
+
+    def timed(self, name, function):
+        """
+            Wrap function so each call is timed into histogram name.
+        """
+        histogram = self.histogram(name)
+        clock = time.time
+
+        def timed_function(*args, **kwargs):
+            start = clock()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                histogram.record(int((clock() - start) * 1000000))
+        return timed_function
+
+    def instrument(self, obj, attribute, name):
+        """
+            Replace obj.attribute with a timed version, if enabled.
+        """
+        if self.enabled:
+            setattr(obj, attribute, self.timed(name, getattr(obj, attribute)))
+
+    def add_gauge(self, name, function):
+        """
+            function() returns a JSON-able value included in every snapshot.
+        """
+        if self.enabled:
+            self.gauges[name] = function
+
+    def snapshot(self):
+        result = dict((name, histogram.summary())
+            for name, histogram in self.histograms.items())
+        for name, function in self.gauges.items():
+            result[name] = function()
+        return result
+
+    def serve_http(self, port=HTTP_PORT, address='127.0.0.1'):
+        """
+            GET /metrics returns the snapshot as JSON, from a daemon thread.
+        """
+        if not self.enabled:
+            return None
+        import BaseHTTPServer
+        metrics = self
+
+        class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_error(404)
+                    return
+                body = json.dumps(metrics.snapshot(), sort_keys=True)
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        httpd = BaseHTTPServer.HTTPServer((address, port), MetricsRequestHandler)
+        thread = threading.Thread(target=httpd.serve_forever, name='MetricsHTTP')
+        thread.daemon = True
+        thread.start()
+        return httpd
+
+
+class MetricsLog(object):
+    """
+        Appends histogram summaries to path, rotating to path.1 .. path.N like
+        logging.handlers.RotatingFileHandler. Each record covers the values
+        recorded since the one before, so a bad minute stands out.
+    """
+
+    def __init__(self, metrics, path, max_bytes=LOG_MAX_BYTES, backups=LOG_BACKUPS):
+        self.metrics = metrics
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.names = []
+        self.file = None
+        # Copies of the histograms as of the last record
+        self.last = {}
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0 or not self.names:
+            self.write_names()
+
+    def write_names(self):
+        self.names = sorted(self.metrics.histograms)
+        data = [RECORD.pack('N', len(self.names))]
+        for name in self.names:
+            encoded = name.encode('utf-8')
+            data.append(struct.pack('<B', len(encoded)) + encoded)
+        self.file.write(''.join(data))
+
+    def rotate(self):
+        self.file.close()
+        for index in range(self.backups - 1, 0, -1):
+            source = '%s.%d' % (self.path, index)
+            if os.path.exists(source):
+                os.rename(source, '%s.%d' % (self.path, index + 1))
+        os.rename(self.path, self.path + '.1')
+        self.file = open(self.path, 'ab')
+        self.write_names()
+
+    def write(self):
+        if self.file is None:
+            self.open()
+        if sorted(self.metrics.histograms) != self.names:
+            self.write_names()
+        data = ['S', SNAPSHOT_TIME.pack(time.time()), struct.pack('<H', len(self.names))]
+        for index, name in enumerate(self.names):
+            current = self.metrics.histograms[name].copy()
+            histogram = current.since(self.last.get(name) or Histogram())
+            self.last[name] = current
+            data.append(SNAPSHOT_ENTRY.pack(index, histogram.count,
+                histogram.percentile(.5), histogram.percentile(.9),
+                histogram.percentile(.99), min(histogram.max, 0xffffffff)))
+        self.file.write(''.join(data))
+        self.file.flush()
+        if self.file.tell() >= self.max_bytes:
+            self.rotate()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+
+
+def read_log(path):
+    """
+        Yield (time, {name: (count, p50, p90, p99, max)}) from a metrics log.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    names = []
+    offset = 0
+    while offset < len(data):
+        kind = data[offset]
+        if kind == 'N':
+            count, = struct.unpack_from('<H', data, offset + 1)
+            offset += RECORD.size
+            names = []
+            for _ in range(count):
+                length = ord(data[offset])
+                names.append(data[offset + 1:offset + 1 + length].decode('utf-8'))
+                offset += 1 + length
+        elif kind == 'S':
+            when, = SNAPSHOT_TIME.unpack_from(data, offset + 1)
+            count, = struct.unpack_from('<H', data, offset + 1 + SNAPSHOT_TIME.size)
+            offset += 1 + SNAPSHOT_TIME.size + 2
+            entries = {}
+            for _ in range(count):
+                entry = SNAPSHOT_ENTRY.unpack_from(data, offset)
+                entries[names[entry[0]]] = entry[1:]
+                offset += SNAPSHOT_ENTRY.size
+            yield when, entries
+        else:
+            raise ValueError('%s: bad record at byte %d' % (path, offset))
+
+
+def dump(path):
+    for when, entries in read_log(path):
+        print time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(when))
+        for name in sorted(entries):
+            print '    %-20s count %-8d p50 %-6d p90 %-6d p99 %-6d max %d us' % ((name,) + entries[name])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3 or sys.argv[1] != 'dump':
+        print 'usage: python metrics.py dump <metrics log>'
+        sys.exit(1)
+    dump(sys.argv[2])
@@ -0,0 +1,114 @@
+"""
+motion.py
+
+Timer queue for multi-step lamp movements.
+
+The Space Cannon has to be slowed down below 50% speed before its rotation
+direction can be changed safely. Rather than sleeping in the calling (OSC
+handler) thread, the steps of a movement are scheduled on a MotionController
+and run from its own thread. Scheduling a new movement replaces whatever was
+still pending from the previous one.
+"""
+import heapq
+import itertools
+import threading
+import time
+import traceback
+
+
+class MotionController(object):
+    """
+        Runs scheduled steps, each a (delay_seconds, function, args) tuple, from
+        a single worker thread in due-time order.
+    """
+
+    def __init__(self):
+        self.queue = []
+        self.counter = itertools.count()
+        self.generation = 0
+        self.running = False
+        self.die = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name='MotionController')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def schedule(self, steps):
+        """
+            Add steps to the queue without touching those already pending.
+        """
+        now = time.time()
+        with self.condition:
+            for delay, function, args in steps:
+                heapq.heappush(self.queue,
+                    (now + delay, next(self.counter), self.generation, function, args))
+            self.condition.notify()
+
+    def replace(self, steps):
+        """
+            Cancel pending steps and schedule these instead.
+        """
+        with self.condition:
+            self.cancel()
+            self.schedule(steps)
+
+    def cancel(self):
+        with self.condition:
+            # Bumping the generation invalidates a step that the worker has
+            # already popped but not yet run.
+            self.generation += 1
+            del self.queue[:]
+            self.condition.notify_all()
+
+    def pending(self):
+        with self.condition:
+            return len(self.queue) + int(self.running)
+
+    def wait(self, timeout=None):
+        """
+            Block until every pending step has run, or timeout expires.
+            Returns True when the queue drained.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self.condition:
+            while self.queue or self.running:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.condition.wait(remaining)
+        return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.die:
+                    if not self.queue:
+                        self.condition.wait()
+                        continue
+                    delay = self.queue[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self.condition.wait(delay)
+                if self.die:
+                    return
+                due, _, generation, function, args = heapq.heappop(self.queue)
+                self.running = True
+
+            try:
+                # A cancel() between the pop and here bumps the generation.
+                if generation == self.generation:
+                    function(*args)
+            except Exception:
+                # One failed step, say a write during a reconnect, mustn't
+                # stop every later one
+                traceback.print_exc()
+            finally:
+                with self.condition:
+                    self.running = False
+                    self.condition.notify_all()
+
+    def close(self, timeout=None):
+        with self.condition:
+            self.die = True
+            self.condition.notify_all()
+        self.thread.join(timeout)
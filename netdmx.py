@@ -0,0 +1,451 @@
+"""
+netdmx.py
+
+DMX over Ethernet: Art-Net and sACN (E1.31) alongside the Enttec widget.
+
+Ports named after a protocol open a NetworkPort instead of a serial device:
+
+    artnet:<host>[:port]      Art-Net to a node, or broadcast with no host
+    sacn[:<host>[:port]]      sACN to a node, or to each universe's multicast
+                              group with no host
+
+A NetworkPort hands out one NetworkOutput per universe, each with the Dmx
+setChannel/render surface, so fixtures can be patched onto a network port
+like any Enttec one. Art-Net universes count from 0 and sACN ones from 1:
+universe n of a patch is Art-Net universe n and sACN universe n + 1.
+
+A Receiver takes ArtDmx or E1.31 data packets off a non-blocking socket from
+the EventLoop and copies their slots into the matching universes in one slice
+assignment, straight out of a preallocated receive buffer. Packets older than
+the last one from their source are dropped, and a universe follows only its
+highest priority sources. Art-Net has no priority and counts as the sACN
+default. Sources going quiet for SOURCE_TIMEOUT are forgotten, and between
+sources of the same priority the latest packet wins, there is no HTP merge.
+"""
+import errno
+import os
+import socket
+import struct
+import time
+
+ARTNET = 'artnet'
+SACN = 'sacn'
+ARTNET_PORT = 6454
+SACN_PORT = 5568
+SLOTS = 512
+DEFAULT_PRIORITY = 100
+MAX_PRIORITY = 200
+# E1.31's network data loss timeout
+SOURCE_TIMEOUT = 2.5
+# A packet up to this far behind the last one from its source is out of order
+SEQUENCE_WINDOW = 20
+SOURCE_NAME = 'Black Rock Lighthouse'
+# Datagrams read in one go before handing the loop back
+MAX_BATCH = 256
+
+# id, opcode, protocol version hi/lo, sequence, physical, 15 bit universe,
+# data length hi/lo. The opcode and universe are little-endian, the length is
+# big-endian.
+ARTDMX_HEADER = struct.Struct('<8sHBBBBHBB')
+ARTNET_ID = 'Art-Net\0'
+OP_DMX = 0x5000
+ARTNET_VERSION = 14
+ARTNET_SEQUENCE_OFFSET = 12
+
+# Root layer: preamble size, postamble size, ACN id, flags and length,
+# vector, CID. Framing layer: flags and length, vector, source name,
+# priority, sync address, sequence, options, universe. DMP layer: flags and
+# length, vector, address type, first address, increment, value count, start
+# code.
+E131_HEADER = struct.Struct('>HH12sHI16sHI64sBHBBHHBBHHHB')
+ACN_ID = 'ASC-E1.17\0\0\0'
+VECTOR_ROOT_DATA = 4
+VECTOR_FRAMING_DATA = 2
+VECTOR_DMP_SET_PROPERTY = 2
+ADDRESS_TYPE = 0xa1
+E131_SEQUENCE_OFFSET = 111
+OPTION_PREVIEW = 0x80
+OPTION_TERMINATED = 0x40
+ROOT_LAYER_OFFSET = 16
+FRAMING_LAYER_OFFSET = 38
+DMP_LAYER_OFFSET = 115
+FLAGS = 0x7000
+
+MAX_PACKET = E131_HEADER.size + SLOTS
+
+
+def is_network_port(port):
+    return isinstance(port, basestring) and port.split(':', 1)[0] in (ARTNET, SACN)
+
+
+def parse_port(port):
+    """
+        "artnet:host:port" to (protocol, host or None, port)
+    """
+    parts = port.split(':')
+    protocol = parts[0]
+    host = parts[1] if len(parts) > 1 and parts[1] else None
+    number = int(parts[2]) if len(parts) > 2 else (ARTNET_PORT if protocol == ARTNET else SACN_PORT)
+    return protocol, host, number
+
+
+def network_universe(protocol, universe):
+    return universe + 1 if protocol == SACN else universe
+
+
+def sacn_group(universe):
+    return '239.255.%d.%d' % (universe >> 8, universe & 0xff)
+
+
+def artdmx_header(universe):
+    return ARTDMX_HEADER.pack(ARTNET_ID, OP_DMX, 0, ARTNET_VERSION, 0, 0, universe,
+                              SLOTS >> 8, SLOTS & 0xff)
+
+
+def e131_header(universe, cid, priority=DEFAULT_PRIORITY, name=SOURCE_NAME):
+    length = E131_HEADER.size + SLOTS
+    return E131_HEADER.pack(
+        0x10, 0, ACN_ID, FLAGS | (length - ROOT_LAYER_OFFSET), VECTOR_ROOT_DATA, cid,
+        FLAGS | (length - FRAMING_LAYER_OFFSET), VECTOR_FRAMING_DATA, name, priority, 0, 0, 0,
+        universe,
+        FLAGS | (length - DMP_LAYER_OFFSET), VECTOR_DMP_SET_PROPERTY, ADDRESS_TYPE, 0, 1,
+        SLOTS + 1, 0)
+
+
+class NetworkOutput(object):
+    """
+        One universe sent to the network, with the Dmx surface. The packet is
+        built once; setChannel writes into its data and render() stamps the
+        next sequence number and sends it.
+    """
+
+    def __init__(self, sock, address, header, sequence_offset):
+        self.sock = sock
+        self.address = address
+        self.packet = bytearray(header) + bytearray(SLOTS)
+        self.view = memoryview(self.packet)
+        self.data_offset = len(header)
+        self.sequence_offset = sequence_offset
+        self.sequence = 0
+        self.packets_sent = 0
+        self.errors = 0
+
+    def setPort(self, port, baud=None):
+        pass
+
+    def connect(self):
+        pass
+
+    def setChannel(self, channel, value, autoRender=True):
+        if not 1 <= channel <= SLOTS:
+            raise ValueError('DMX channel %s out of range' % channel)
+        self.packet[self.data_offset + channel - 1] = value
+        if autoRender:
+            self.render()
+
+    def set_data(self, data, channel=1):
+        """
+            Set len(data) channels from channel on at once.
+        """
+        start = self.data_offset + channel - 1
+        self.view[start:start + len(data)] = data
+
+    def render(self, render_till=None):
+        # Sequence 0 means none, so count 1 to 255
+        self.sequence = self.sequence % 255 + 1
+        self.packet[self.sequence_offset] = self.sequence
+        try:
+            self.sock.sendto(self.view, self.address)
+        except socket.error as e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED):
+                print 'Sending DMX to', self.address, 'failed:', e
+            self.errors += 1
+            return
+        self.packets_sent += 1
+
+    def blackOut(self):
+        self.view[self.data_offset:] = bytearray(SLOTS)
+        self.render()
+
+    def disconnect(self):
+        pass
+
+
+class NetworkPort(object):
+    """
+        A socket for one protocol and destination, and its universes.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.protocol, self.host, self.number = parse_port(port)
+        if self.protocol not in (ARTNET, SACN):
+            raise ValueError('Unknown DMX protocol in %s' % port)
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setblocking(False)
+        if self.protocol == ARTNET and self.host is None:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        if self.protocol == SACN and self.host is None:
+            self.sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, 1)
+        # Our sACN component id, the same for every universe
+        self.cid = os.urandom(16)
+        self.outputs = {}
+
+    def output(self, universe):
+        """
+            The NetworkOutput for universe n of a patch.
+        """
+        output = self.outputs.get(universe)
+        if output is None:
+            number = network_universe(self.protocol, universe)
+            if self.protocol == ARTNET:
+                host = self.host or '255.255.255.255'
+                output = NetworkOutput(self.sock, (host, self.number), artdmx_header(number),
+                                       ARTNET_SEQUENCE_OFFSET)
+            else:
+                host = self.host or sacn_group(number)
+                output = NetworkOutput(self.sock, (host, self.number), e131_header(number, self.cid),
+                                       E131_SEQUENCE_OFFSET)
+            self.outputs[universe] = output
+        return output
+
+    def render(self, render_till=None):
+        for output in self.outputs.values():
+            output.render()
+
+    def blackOut(self):
+        for output in self.outputs.values():
+            output.blackOut()
+
+    def stats(self):
+        return dict((universe, (output.packets_sent, output.errors))
+            for universe, output in self.outputs.iteritems())
+
+    def disconnect(self):
+        self.sock.close()
+
+
+def open_port(port, baud=None):
+    return NetworkPort(port)
+
+
+def parse_artdmx(view, length):
+    """
+        (universe, priority, sequence, slots, options) of an ArtDmx packet,
+        or None for anything else.
+    """
+    if length < ARTDMX_HEADER.size:
+        return None
+    artnet_id, opcode, _, _, sequence, _, universe, length_hi, length_lo = \
+        ARTDMX_HEADER.unpack_from(view)
+    if artnet_id != ARTNET_ID or opcode != OP_DMX:
+        return None
+    slots = min((length_hi << 8) | length_lo, length - ARTDMX_HEADER.size, SLOTS)
+    return universe, DEFAULT_PRIORITY, sequence, slots, 0
+
+
+def parse_e131(view, length):
+    """
+        (universe, priority, sequence, slots, options) of an E1.31 data packet
+        with DMX slots, or None for anything else.
+    """
+    if length < E131_HEADER.size:
+        return None
+    (_, _, acn_id, _, root_vector, _, _, framing_vector, _, priority, _, sequence, options,
+     universe, _, dmp_vector, _, _, _, count, start_code) = E131_HEADER.unpack_from(view)
+    if (acn_id != ACN_ID or root_vector != VECTOR_ROOT_DATA or
+            framing_vector != VECTOR_FRAMING_DATA or dmp_vector != VECTOR_DMP_SET_PROPERTY or
+            start_code != 0):
+        return None
+    slots = min(count - 1, length - E131_HEADER.size, SLOTS)
+    return universe, min(priority, MAX_PRIORITY), sequence, slots, options
+
+
+class Source(object):
+    __slots__ = ('priority', 'sequence', 'seen')
+
+    def __init__(self, priority, sequence, seen):
+        self.priority = priority
+        self.sequence = sequence
+        self.seen = seen
+
+
+class Receiver(object):
+    """
+        Copies one protocol's DMX packets from sock into universe.Universe
+        buffers. targets maps a network universe number to a list of them.
+        on_frame() is called after each batch of packets that changed one.
+    """
+
+    def __init__(self, protocol, sock, targets, on_frame=None):
+        self.protocol = protocol
+        self.parse = parse_artdmx if protocol == ARTNET else parse_e131
+        self.header_size = ARTDMX_HEADER.size if protocol == ARTNET else E131_HEADER.size
+        self.sock = sock
+        self.targets = targets
+        self.on_frame = on_frame
+        self.buffer = bytearray(MAX_PACKET)
+        self.view = memoryview(self.buffer)
+        # universe: {source: Source}
+        self.sources = dict((universe, {}) for universe in targets)
+        self.packets = 0
+        self.applied = 0
+        self.ignored = 0
+        self.out_of_order = 0
+        self.outranked = 0
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def handle(self):
+        """
+            Read every datagram waiting, from the EventLoop.
+        """
+        changed = False
+        now = time.time()
+        for _ in xrange(MAX_BATCH):
+            try:
+                length, address = self.sock.recvfrom_into(self.buffer)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
+            changed = self.receive(length, address, now) or changed
+        if changed and self.on_frame is not None:
+            self.on_frame()
+
+    def receive(self, length, address, now):
+        """
+            Apply one packet. Returns True if it changed a universe.
+        """
+        self.packets += 1
+        packet = self.parse(self.view, length)
+        if packet is None or packet[0] not in self.sources:
+            self.ignored += 1
+            return False
+        universe, priority, sequence, slots, options = packet
+        if options & OPTION_PREVIEW:
+            self.ignored += 1
+            return False
+        sources = self.sources[universe]
+        # sACN sources are told apart by CID, Art-Net ones by address
+        key = str(self.buffer[22:38]) if self.protocol == SACN else address[0]
+        if options & OPTION_TERMINATED:
+            sources.pop(key, None)
+            return False
+        if not self.accept(sources, key, priority, sequence, now):
+            return False
+        data = self.view[self.header_size:self.header_size + slots]
+        changed = False
+        for target in self.targets[universe]:
+            changed = target.write_block(1, data[:len(target.buffer) - 1]) or changed
+        self.applied += 1
+        return changed
+
+    def accept(self, sources, key, priority, sequence, now):
+        source = sources.get(key)
+        if source is None:
+            source = sources[key] = Source(priority, sequence, now)
+        elif sequence and source.sequence:
+            behind = (source.sequence - sequence) & 0xff
+            if behind < SEQUENCE_WINDOW and now - source.seen < SOURCE_TIMEOUT:
+                self.out_of_order += 1
+                return False
+        source.priority = priority
+        source.sequence = sequence
+        source.seen = now
+        for other_key, other in sources.items():
+            if now - other.seen >= SOURCE_TIMEOUT:
+                del sources[other_key]
+            elif other.priority > priority:
+                self.outranked += 1
+                return False
+        return True
+
+    def stats(self):
+        return {
+            'packets': self.packets,
+            'applied': self.applied,
+            'ignored': self.ignored,
+            'out_of_order': self.out_of_order,
+            'outranked': self.outranked,
+        }
+
+    def close(self):
+        self.sock.close()
+
+
+def open_receiver(protocol, universes, on_frame=None, address='', port=None, multicast=True):
+    """
+        A Receiver bound to the protocol's port, feeding universes, a list of
+        universe.Universe, from the network universes numbered like them.
+        sACN joins their multicast groups unless multicast is False.
+    """
+    if protocol not in (ARTNET, SACN):
+        raise ValueError('Unknown DMX protocol %s' % protocol)
+    targets = {}
+    for universe in universes:
+        targets.setdefault(network_universe(protocol, universe.universe), []).append(universe)
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((address, port if port is not None else (ARTNET_PORT if protocol == ARTNET else SACN_PORT)))
+    sock.setblocking(False)
+    if protocol == SACN and multicast:
+        for number in targets:
+            membership = struct.pack('4s4s', socket.inet_aton(sacn_group(number)),
+                                     socket.inet_aton('0.0.0.0'))
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+            except socket.error as e:
+                print 'Joining sACN universe', number, 'failed:', e
+    return Receiver(protocol, sock, targets, on_frame)
+
+
+def mirror_numbers(universes):
+    """
+        The network universe each of universes is mirrored to: its own number,
+        unless an earlier one on another port has it, say two Enttecs on
+        universe 0, and then the next number no universe uses.
+    """
+    spare = max([universe.universe for universe in universes] or [-1]) + 1
+    numbers = []
+    for universe in universes:
+        number = universe.universe
+        if number in numbers:
+            number = spare
+            spare += 1
+            print 'Mirroring %s universe %d as network universe %d' % (
+                universe.port, universe.universe, number)
+        numbers.append(number)
+    return numbers
+
+
+class Mirror(object):
+    """
+        Frame hook sending copies of universes out of network ports, every
+        frame they change and at least every KEEPALIVE seconds, so nodes
+        don't time them out. Each (port, universe) goes out on a network
+        universe of its own, see mirror_numbers.
+    """
+    KEEPALIVE = 1.0
+
+    def __init__(self, universes, ports):
+        self.outputs = [(universe, port.output(number))
+            for universe, number in zip(universes, mirror_numbers(universes)) for port in ports]
+        self.ports = ports
+        self.last_buffers = [None] * len(self.outputs)
+        self.last_sent = 0
+
+    def __call__(self, now):
+        keepalive = now - self.last_sent >= self.KEEPALIVE
+        for index, (universe, output) in enumerate(self.outputs):
+            if keepalive or universe.buffer != self.last_buffers[index]:
+                self.last_buffers[index] = bytearray(universe.buffer)
+                output.set_data(memoryview(self.last_buffers[index])[1:])
+                output.render()
+        if keepalive:
+            self.last_sent = now
+
+    def close(self):
+        for port in self.ports:
+            port.disconnect()
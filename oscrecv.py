@@ -5,7 +5,9 @@ oscrecv.py
 Run an OSCServer to control the lamp from touchOSC.
 """
 # Stdlib
-import platform
+import functools
+import json
+import os
 import sys
 import threading
 import time
@@ -15,17 +17,51 @@ import OSC
 from OSC import OSCServer
 
 # Local libraries
+from arbitration import Arbiter, make_policy
+from event_loop import EventLoop
+from inbox import CoalescingInbox
+from journal import Journal, DEFAULT_PATH as DEFAULT_JOURNAL_PATH
 from lighthouse import Lighthouse
-import util
+from metrics import Metrics, MetricsLog, LOG_INTERVAL
+from presence import PresenceTracker
+from routing import Router, parse_routes
+from state import StateFile, DEFAULT_PATH as DEFAULT_STATE_PATH
+from status import StatusPublisher, reply_port
+from universe import UniverseManager
+import fixture
+import netdmx
 
 IDLE_TIME_BEFORE_AUTOMATIC = 60 * 3
 TIME_TO_CONSIDER_CLIENT_GONE = 61
+STATUS_INTERVAL = 1
+# Full status resend to cover lost UDP packets
+STATUS_RESYNC_INTERVAL = 15
+DMX_FRAME_RATE = 40
+# Applied in arrival order; every other handle_event address only keeps its
+# newest pending value. /admin/take_control has its own handler and is applied
+# as soon as it arrives.
+DISCRETE_ADDRESSES = ['/admin/idle_now']
 
 default_recv_port = 8000
 
+# What the web panel may send, by address prefix, see web/index.html. Other
+# addresses from browsers are dropped, and /admin/take_control is only taken
+# with LIGHTHOUSE_ADMINS set, since anyone who can reach the panel can send it.
+WEB_ADDRESSES = ('/staticLight/', '/show/', '/admin/idle_now')
+
+LIGHT_FUNCTIONS = {
+    '/staticLight/pan': 'set_pan_position',
+    '/staticLight/tilt': 'set_tilt',
+    '/staticLight/speed': 'set_speed',
+    '/staticLight/lightControl': 'set_lamp',
+    '/staticLight/brightness': 'set_lamp',
+    '/staticLight/strobe': 'set_strobe',
+    '/admin/idle_now': 'set_idle',
+}
+
 def avahi_publisher(server):
     # Cribbed from https://github.com/ArdentHeavyIndustries/amcp-rpi/blob/master/server.py
-    if platform.system() == "Darwin":
+    if sys.platform == "darwin":
         service = None
     else:
         # Avahi announce so it's findable on the controller by name
@@ -33,20 +69,77 @@ def avahi_publisher(server):
         service = ZeroconfService(
             name="BRLS TouchOSC Server", port=server.server_address[1], stype="_osc._udp")
         service.publish()
+    return service
+
+def publish_after_first_frame(server):
+    """
+        Announce the server from a background thread once the lamp has shown
+        its first frame, so importing dbus and talking to avahi stay off the
+        startup path.
+    """
+    def publish():
+        first_frame = getattr(server.dmx, 'first_frame', None)
+        if first_frame is not None:
+            first_frame.wait()
+        try:
+            avahi_publisher(server)
+        except Exception as e:
+            print 'Zeroconf publishing failed:', e
+
+    thread = threading.Thread(target=publish, name='avahi')
+    thread.daemon = True
+    thread.start()
+    return thread
 
-class ServerLighthouse(OSC.ThreadingOSCServer):
+class ServerLighthouse(OSCServer):
     """
     OSCServer for lighthouse.
 
     Turns OSC messages into reality functions.
+
+    Datagrams are handled one at a time from an EventLoop, which also runs the
+    presence deadlines and status updates as timers, instead of a thread per
+    datagram.
     """
 
-    def __init__(self, address=None, recv_port=default_recv_port):
+    def __init__(self, address=None, recv_port=default_recv_port, loop=None):
         if address is None:
             address = '0.0.0.0'
         OSCServer.__init__(self, (address, recv_port))
+        self.loop = loop if loop is not None else EventLoop()
+        # LIGHTHOUSE_METRICS=1 times the hot path, see metrics.py
+        self.metrics = Metrics(enabled=bool(os.environ.get('LIGHTHOUSE_METRICS')))
+        # Control owner and per-client rate limits, see arbitration.py
+        self.arbiter = Arbiter(make_policy(
+            os.environ.get('LIGHTHOUSE_CONTROL_POLICY', 'admin'),
+            os.environ.get('LIGHTHOUSE_ADMINS', '').split()))
+        # Pages for other boards are relayed as they come, see routing.py
+        self.router = Router(parse_routes(os.environ.get('LIGHTHOUSE_ROUTES', '')))
+        # Every datagram is recorded if there is a journal, see journal.py
+        self.journal = None
+        self.loop.add_reader(self.socket, self._handle_request_noblock)
+        self.inbox = CoalescingInbox(DISCRETE_ADDRESSES)
+        self.inbox_timer = self.loop.call_every(1.0 / DMX_FRAME_RATE, self.drain_inbox)
         print('Starting OSC Server at %s on port %s' % (address, recv_port))
 
+    def serve_forever(self):
+        self.loop.run_forever()
+
+    @property
+    def enabled(self):
+        # The client in control, or None
+        return self.arbiter.owner
+
+    def drain_inbox(self):
+        self.inbox.drain()
+
+    def close(self):
+        self.inbox_timer.cancel()
+        self.router.close()
+        self.loop.remove_reader(self.socket)
+        self.loop.stop()
+        OSCServer.close(self)
+
     def am_idle(self):
         print 'Running idle...'
         self.set_idle(None)
@@ -55,21 +148,19 @@ class ServerLighthouse(OSC.ThreadingOSCServer):
         """
         Whenever an OSCMessage is passed from the Client to the Server, do a thing with it.
 
-        The internal function is used by the MsgHandler to take all arguments from the source,
-        parse them into integers and pass them off to the desired function. The appropriate function
-        for a touch event can also be passed in as well.
+        The internal function is used by the MsgHandler to check that the source may control
+        the lamp, parse the arguments into integers and post them to the inbox for the desired
+        function, which applies the newest value once per frame. The appropriate function for
+        a touch event can also be passed in as well.
         """
         def internal_function(path, tags, args, source):
-            args = [int(arg) for arg in args]
-            if source[0] != self.enabled:
-                if self.enabled is None:
-                    self.enabled = source[0]
-                else:
-                    print 'Ignoring command from', source[0], 'because', self.enabled, 'has control.'
-
-            if source[0] == self.enabled: # re-check if enabled was None
-                function(*args)
+            if not self.arbiter.command(source[0]):
+                print 'Ignoring command from', source[0], 'because', self.enabled, 'has control.'
+                return
+            self.inbox.post(path, function, [int(arg) for arg in args])
 
+        if self.metrics.enabled:
+            internal_function = self.metrics.timed('osc.dispatch', internal_function)
         self.addMsgHandler(address, internal_function)
         self.handle_touch(address, touchFunction)
 
@@ -95,35 +186,29 @@ class ClientPingHandler(object):
         Listen for /ping/ messages and update last seen timestamps
     """
     def __init__(self):
-        self.ping_dict = {}
-        self.die = False
-        self.sleep = 1
         self.addMsgHandler('/ping/', self.osc_ping_handler)
-        self.thread = threading.Thread(target=self.worker)
-        self.thread.start()
+        self.presence = PresenceTracker(self.loop,
+            TIME_TO_CONSIDER_CLIENT_GONE, IDLE_TIME_BEFORE_AUTOMATIC,
+            self.client_gone, self.system_idle)
 
         class InterceptingRequestHandler(OSC.OSCRequestHandler):
             def handle(local_self):
+                if self.journal is not None:
+                    self.journal.osc(local_self.client_address, local_self.packet)
+                # Over its rate limit, drop the datagram without decoding it
+                if not self.arbiter.allow(local_self.client_address[0]):
+                    return
                 self.add_ping(local_self.client_address[0])
+                if self.router.forward(local_self.packet, self.callbacks):
+                    return
                 return OSC.OSCRequestHandler.handle(local_self)
         self.RequestHandlerClass = InterceptingRequestHandler
 
-    def worker(self):
-        while not self.die:
-            self.check_pings()
-            time.sleep(self.sleep)
-
-    def check_pings(self):
-        gone_time = TIME_TO_CONSIDER_CLIENT_GONE
-        now = time.time()
-        for address, v in self.ping_dict.items():
-            delta = now - v
-            if delta > gone_time:
-                print "ping - Haven't seen", address, "for", delta, "seconds, removing."
-                del self.ping_dict[address]
-                if self.enabled == address:
-                    self.enabled = None
-                self.send_status(address)
+    def client_gone(self, address, delta):
+        print "ping - Haven't seen", address, "for", delta, "seconds, removing."
+        self.arbiter.gone(address)
+        self.send_status(address)
+        self.status.forget(address)
 
     def osc_ping_handler(self, path, tags, args, message_source):
         """
@@ -135,107 +220,202 @@ class ClientPingHandler(object):
         self.send_status(address)
 
     def add_ping(self, address):
-        self.ping_dict[address] = time.time()
+        self.presence.ping(address)
 
     def close(self):
-        self.die = True
-        self.thread.join()
+        self.presence.close()
 
 class IdleChecker(object):
     """
-        Send a message to the server every X seconds.
-        Check when the last request from a client was sent.
-        If it was more than Y seconds, run idle command.
+        Run the idle command once no client has sent anything for
+        IDLE_TIME_BEFORE_AUTOMATIC seconds. The presence tracker calls
+        system_idle when that happens.
     """
     def __init__(self):
-        self.die = False
-        self.sleep = 1
-        self.idle = False
         self.idle_enabled = 1
-        self.last = time.time()
         self.addMsgHandler('/admin/idle_enable', self.idle_toggle)
-        self.thread = threading.Thread(target=self.run)
-        self.thread.start()
-
-    def run(self):
-        # Wait for IDLE_TIME_BEFORE_AUTOMATIC seconds after startup before
-        # running idle pattern.
-        time.sleep(IDLE_TIME_BEFORE_AUTOMATIC)
-        while not self.die:
-            self.idle_check()
-            self.update_clients()
-            time.sleep(self.sleep)
-
-    def idle_check(self):
-        # check when last req from client was sent
-        now = time.time()
-        client = None
-        for client, timestamp in self.ping_dict.iteritems():
-            if (now - timestamp) <= IDLE_TIME_BEFORE_AUTOMATIC:
-                self.idle = False
-                break
-        else:
-            # fires if break not run, so only when idle
-            self.enabled = None # system is idle, no one has control
-            if not self.idle:
-                self.idle = True
-                if self.idle_enabled:
-                # idle animation is disabled via touchosc admin page
-                    self.am_idle()
-            return
 
-        # break was hit - system still being used.
-        print 'System still being used by', self.ping_dict.keys()
-        pass
+    @property
+    def idle(self):
+        return self.presence.idle
+
+    def system_idle(self):
+        self.arbiter.reset() # system is idle, no one has control
+        if self.idle_enabled:
+            # idle animation is disabled via touchosc admin page
+            self.am_idle()
 
     def idle_toggle(self, path, data_types, raw_data, sender_port_tuple):
         data = int(raw_data[0])
         self.idle_enabled = data
         self.send_status(sender_port_tuple[0])
 
-    def close(self):
-        self.die = True
-        self.thread.join()
-
 class SendServerStatus(object):
+    """
+        Push status changes to clients, see status.StatusPublisher.
+    """
     def __init__(self):
         self.client = OSC.OSCClient()
+        self.status = StatusPublisher(self.client, STATUS_RESYNC_INTERVAL)
+        self.status_timer = self.loop.call_every(STATUS_INTERVAL, self.update_clients)
 
     def send_status(self, client_address):
         statuses = [
             ('/admin/idle_enable', int(self.idle_enabled)),
             ('/staticLight/lightControl', int(self.enabled == client_address)),
             ]
-        for path, variable in statuses:
-            self.send_message(client_address, path, variable)
-
-    def send_message(self, client_address, path, variable):
-        msg = OSC.OSCMessage(path)
-        msg.append(variable, typehint='f')
-        port = 8000 if client_address != '127.0.0.1' else 4000
-        try:
-            self.client.sendto(msg, (client_address, port))
-        except OSC.OSCClientError:
-            pass
+        self.status.publish(client_address, statuses)
 
     def update_clients(self):
-        for client in self.ping_dict.iterkeys():
+        # Timeslice control changes hands here
+        self.arbiter.expire()
+        for client in self.presence.clients():
             self.send_status(client)
 
+    def close(self):
+        self.status_timer.cancel()
+
 class LighthouseOSCCallbacks(Lighthouse, ServerLighthouse, ClientPingHandler, IdleChecker, SendServerStatus):
-    def __init__(self, light_func_dict=None):
-        ServerLighthouse.__init__(self)
-        Lighthouse.__init__(self)
+    def __init__(self, light_func_dict=None, fixtures=None, recv_port=default_recv_port, universes=None,
+                 state=None, journal=None):
+        ServerLighthouse.__init__(self, recv_port=recv_port)
+        Lighthouse.__init__(self, frame_rate=DMX_FRAME_RATE, fixtures=fixtures, universes=universes,
+                            state=state)
         ClientPingHandler.__init__(self)
         IdleChecker.__init__(self)
         SendServerStatus.__init__(self)
 
         self.set_functions(light_func_dict)
+        self.load_shows()
+        self.set_show_functions()
         self.addMsgHandler('default', self.print_msg)
         self.addMsgHandler('/staticLight/lightControl', self.request_control)
         self.addMsgHandler('/admin/take_control', self.take_control)
 
-        self.enabled = None
+        self.restore_state(self.restored)
+        self.set_network_dmx()
+        self.web_panel = None
+        if os.environ.get('LIGHTHOUSE_WEB_PORT'):
+            self.open_web_panel(int(os.environ['LIGHTHOUSE_WEB_PORT']))
+        if journal is not None and self.player is not None:
+            journal.watch(self.patched_universes(), self.describe_state)
+            self.dmx.add_frame_hook(journal)
+            self.journal = journal
+        self.metrics_log = None
+        self.metrics_timer = None
+        if self.metrics.enabled:
+            self.set_metrics()
+
+    def set_network_dmx(self):
+        # Art-Net or sACN in from a console, and copies of the universes out to
+        # network nodes, see netdmx.py
+        self.dmx_receiver = None
+        self.dmx_mirror = None
+        universes = self.patched_universes()
+        if os.environ.get('LIGHTHOUSE_DMX_INPUT'):
+            self.dmx_receiver = netdmx.open_receiver(
+                os.environ['LIGHTHOUSE_DMX_INPUT'], universes, on_frame=self.network_input)
+            self.loop.add_reader(self.dmx_receiver.sock, self.dmx_receiver.handle)
+        mirror = os.environ.get('LIGHTHOUSE_DMX_MIRROR', '').split()
+        if mirror and self.player is not None:
+            self.dmx_mirror = netdmx.Mirror(universes, [netdmx.open_port(port) for port in mirror])
+            self.dmx.add_frame_hook(self.dmx_mirror)
+
+    def open_web_panel(self, port):
+        # A map of the beam and the controls in a browser, see webpanel.py
+        from webpanel import WebPanel
+        self.web_panel = WebPanel(self.web_state, self.web_command, sorted(self.shows), port=port)
+        self.web_panel.start()
+
+    def web_state(self):
+        """
+            The first lamp as webpanel.FIELDS, from the web panel's thread,
+            and the address in control.
+        """
+        fixture, universe = self.outputs[0]
+        buffer = universe.buffer
+
+        def channel(name):
+            number = getattr(fixture, 'channel_' + name)
+            return buffer[number] if number is not None else 0
+        lamp = fixture.channel_master_control is None or \
+            buffer[fixture.channel_master_control] == fixture.master_lamp_on
+        movement = channel('pan_movement')
+        rotation = 1 if movement == fixture.pan_cw else -1 if movement == fixture.pan_ccw else 0
+        playing = self.player.playing() if self.player is not None else None
+        names = sorted(self.shows)
+        owner = self.enabled
+        return (fixture.calibration.pan_from_dmx(channel('pan_location')),
+                fixture.calibration.tilt_from_dmx(channel('tilt')),
+                fixture.calibration.brightness_from_dmx(channel('brightness')), int(lamp),
+                channel('strobe'), channel('speed'), rotation,
+                names.index(playing) + 1 if playing in names else 0,
+                int(bool(self.idle)), int(owner is not None)), owner
+
+    def web_command(self, address, args, source):
+        # From the web panel's thread; applied on this loop like an OSC
+        # message from source, under the same rate limit and control rules
+        self.loop.call_soon_threadsafe(self.apply_web_command, address, args, source)
+
+    def apply_web_command(self, address, args, source):
+        if self.journal is not None:
+            # As the OSC datagram it stands for, so it replays like one
+            message = OSC.OSCMessage(address)
+            for arg in args:
+                message.append(arg)
+            self.journal.osc(source, message.getBinary())
+        if not self.arbiter.allow(source[0]):
+            return
+        self.add_ping(source[0])
+        # Browsers get their status from the state stream, not over OSC
+        if address == '/ping':
+            return
+        if not self.web_allowed(address):
+            print 'Ignoring', address, 'from web panel at', source[0]
+            return
+        handler = self.callbacks.get(address)
+        if handler is not None:
+            handler(address, ',' + 'f' * len(args), args, source)
+
+    def web_allowed(self, address):
+        if address == '/admin/take_control':
+            return getattr(self.arbiter.policy, 'admins', None) is not None
+        return address.startswith(WEB_ADDRESSES)
+
+    def set_metrics(self):
+        # Time the OSC apply, DMX render, ping and status paths and export them
+        metrics = self.metrics
+        metrics.instrument(self.inbox, 'drain', 'osc.apply')
+        metrics.instrument(self, 'add_ping', 'osc.ping')
+        metrics.instrument(self.status, 'publish', 'status.publish')
+        for device in self.universes.devices.values():
+            metrics.instrument(device, 'render', 'dmx.render')
+        if hasattr(self.dmx, 'stats'):
+            metrics.add_gauge('frames', self.dmx.stats)
+        metrics.add_gauge('osc_messages', self.inbox.stats)
+        metrics.add_gauge('status_packets', lambda: self.status.packets_sent)
+        metrics.add_gauge('routes', self.router.stats)
+        if self.journal is not None:
+            metrics.add_gauge('journal', self.journal.stats)
+        if self.dmx_receiver is not None:
+            metrics.add_gauge('dmx_input', self.dmx_receiver.stats)
+        if self.web_panel is not None:
+            metrics.add_gauge('web_panel', self.web_panel.stats)
+        self.addMsgHandler('/admin/metrics', self.send_metrics)
+        metrics.serve_http()
+        if os.environ.get('LIGHTHOUSE_METRICS_LOG'):
+            self.metrics_log = MetricsLog(metrics, os.environ['LIGHTHOUSE_METRICS_LOG'])
+            self.metrics_timer = self.loop.call_every(LOG_INTERVAL, self.metrics_log.write)
+
+    def send_metrics(self, path, data_types, raw_data, sender_port_tuple):
+        # Answers /admin/metrics with the snapshot as a JSON string
+        sender = sender_port_tuple[0]
+        msg = OSC.OSCMessage(path)
+        msg.append(json.dumps(self.metrics.snapshot(), sort_keys=True))
+        try:
+            self.client.sendto(msg, (sender, reply_port(sender)))
+        except OSC.OSCClientError:
+            pass
 
     def print_msg(self, *args):
         print 'Unknown message: ', args
@@ -245,74 +425,122 @@ class LighthouseOSCCallbacks(Lighthouse, ServerLighthouse, ClientPingHandler, Id
         for address, functionName in funcDict.iteritems():
             self.handle_event(address, getattr(self, functionName))
 
+    def set_show_functions(self):
+        # /show/<name> 1 starts a show and 0 stops it, /show/seek jumps to a
+        # number of seconds into the one playing.
+        for name in self.shows:
+            address = '/show/%s' % name
+            self.inbox.discrete_addresses.add(address)
+            self.handle_event(address, functools.partial(self.toggle_show, name))
+        self.handle_event('/show/seek', self.seek_show)
+        self.handle_event('/show/stop', self.stop_show)
+
+    def describe_state(self):
+        owner, idle, show, show_started = Lighthouse.describe_state(self)
+        return (self.enabled, self.idle, show, show_started)
+
+    def restore_state(self, snapshot):
+        # Pick up where the last run left off instead of waiting
+        # IDLE_TIME_BEFORE_AUTOMATIC for the idle pattern.
+        if snapshot is not None:
+            print 'Restoring state from', time.ctime(snapshot.time)
+            self.arbiter.reset(snapshot.owner)
+            if snapshot.owner is not None:
+                # Loses control like any client if it doesn't come back
+                self.add_ping(snapshot.owner)
+            if snapshot.idle:
+                # The idle look itself is back with the universes
+                self.presence.assume_idle()
+        Lighthouse.restore_state(self, snapshot)
+
+    def toggle_show(self, name, start):
+        if start:
+            self.play_show(name)
+        elif self.player.playing() == name:
+            self.stop_show()
+
     def close(self):
+        print 'OSC messages (received, applied):', self.inbox.stats()
+        if hasattr(self.dmx, 'stats'):
+            print 'DMX frames:', self.dmx.stats()
+        if self.router.routes:
+            print 'OSC routes (endpoint, packets, bytes, errors):', self.router.stats()
+        if self.dmx_receiver is not None:
+            print 'DMX input:', self.dmx_receiver.stats()
+            self.loop.remove_reader(self.dmx_receiver.sock)
+            self.dmx_receiver.close()
+        if self.dmx_mirror is not None:
+            self.dmx_mirror.close()
+        if self.web_panel is not None:
+            print 'Web panel:', self.web_panel.stats()
+            self.web_panel.close()
+        if self.journal is not None:
+            print 'Journal:', self.journal.stats()
+            self.journal.close()
+        if self.metrics_log is not None:
+            self.metrics_timer.cancel()
+            self.metrics_log.write()
+            self.metrics_log.close()
         ServerLighthouse.close(self)
         ClientPingHandler.close(self)
-        IdleChecker.close(self)
+        SendServerStatus.close(self)
 
     def request_control(self, path, data_types, raw_data, sender_port_tuple):
         sender = sender_port_tuple[0]
-        if sender_port_tuple[0] == '127.0.0.1':
-            return_port = 4000
-        else:
-            return_port = 8000
-
         data = int(raw_data[0])
 
-        msg = OSC.OSCMessage(path)
         if data:
-            print 'IP requesting control:', sender,
-            if self.enabled:
-                if sender == self.enabled:
-                    # Already in control, but might have been issue on client side.
-                    print 'already in control.'
-                    msg.append(1, typehint='f')
-                else:
-                    # sender is not already in control. 2 cases: old controller still in control
-                    if self.enabled in self.ping_dict:
-                        print 'saw ping from previous controller recently.'
-                        msg.append(0, typehint='f')
-                    else:
-                        print "haven't seen previous controller recently, transferring control."
-                        msg.append(1, typehint='f')
-                        self.enabled = sender
-            else: # ! self.enabled
-                print 'access granted.'
-                msg.append(1, typehint='f')
-                self.enabled = sender
-        else: # data == 0
-            print 'IP releasing control:', sender,
-            if self.enabled == sender:
-                print sender, 'released control'
-                self.enabled = None
-            else:
-                print sender, "wasn't actually in control."
-            msg.append(0, typehint='f')
-
-        client = OSC.OSCClient()
-        client.connect((sender, return_port))
-        client.send(msg)
-        client.close()
+            granted = int(self.arbiter.request(sender, self.presence.is_present))
+            print 'IP requesting control:', sender, 'granted.' if granted else 'refused, %s has control.' % self.enabled
+        else:
+            print 'IP releasing control:', sender
+            self.arbiter.release(sender)
+            granted = 0
+
+        # Always answer, the client's button may be out of step with the server.
+        self.status.publish(sender, [(path, granted)], force=True)
 
     def take_control(self, path, data_types, raw_data, sender_port_tuple):
         sender = sender_port_tuple[0]
-        self.enabled = sender
+        if not self.arbiter.take(sender):
+            print 'Refusing take control from', sender, 'who is not an admin.'
+            return
         self.update_clients()
 
 if __name__ == "__main__":
 
-    lightFunctions = {
-        '/staticLight/pan': 'set_pan_position',
-        '/staticLight/tilt': 'set_tilt',
-        '/staticLight/speed': 'set_speed',
-        '/staticLight/lightControl': 'set_lamp',
-        '/staticLight/brightness': 'set_lamp',
-        '/staticLight/strobe': 'set_strobe',
-        '/admin/idle_now': 'set_idle',
-    }
-
-    light = LighthouseOSCCallbacks(lightFunctions)
-    avahi_publisher(light)
+    # With LIGHTHOUSE_OUTPUT_PROCESS=1 a child process owns the Enttec ports,
+    # see output_process.py. It forks here, before any thread is started.
+    output = None
+    universes = None
+    if os.environ.get('LIGHTHOUSE_OUTPUT_PROCESS'):
+        from output_process import OutputProcess
+        output = OutputProcess(DMX_FRAME_RATE)
+        output.start()
+        universes = UniverseManager(output.open_device)
+
+    # A patch file places several fixtures on several Enttec ports, see
+    # fixture.load_patch. Without one a single lamp is driven on the default port.
+    fixtures = None
+    if os.environ.get('LIGHTHOUSE_PATCH'):
+        fixtures = fixture.load_patch(os.environ['LIGHTHOUSE_PATCH'])
+
+    # Warm restart from the last look, see state.py
+    state = None
+    try:
+        state = StateFile(os.environ.get('LIGHTHOUSE_STATE', DEFAULT_STATE_PATH))
+    except EnvironmentError as e:
+        print 'No warm restart, the state file failed to open:', e
+
+    # Always on unless set to nothing, see journal.py
+    journal_path = os.environ.get('LIGHTHOUSE_JOURNAL', DEFAULT_JOURNAL_PATH)
+    journal = Journal(journal_path) if journal_path else None
+
+    light = LighthouseOSCCallbacks(LIGHT_FUNCTIONS, fixtures, universes=universes, state=state,
+                                   journal=journal)
+    if output is not None:
+        light.metrics.add_gauge('output_process', output.stats)
+    publish_after_first_frame(light)
 
     while True:
         try:
@@ -321,4 +549,7 @@ if __name__ == "__main__":
             light.shutdown_light()
         finally:
             light.close()
+            if output is not None:
+                output.stop()
+                print 'DMX output process:', output.stats()
             sys.exit()
@@ -0,0 +1,280 @@
+"""
+output_process.py
+
+DMX output from a process of its own.
+
+In oscrecv the OSC handling, the timers and the render loop share one
+interpreter and its GIL, so a burst of OSC or a slow print to the console can
+hold up a serial write and the beam stutters. With an OutputProcess, a forked
+child owns the Enttec ports and runs its own RenderLoop at a raised priority.
+The control process patches its universes onto SharedDevices, whose render()
+copies the 513 byte frame into a shared memory slot, with no round trip to
+the child. Each tick, the child sends every slot that changed. Art-Net and
+sACN ports stay in the control process, a UDP send doesn't wait on the wire.
+A serial port carries universe 0 only, so each has one slot.
+
+Memory is an anonymous shared mmap made before the fork, with one slot per
+port:
+
+    uint32 sequence, 64 byte port name, 513 bytes of frame
+
+and a stats block the child fills in once a second. The slots are guarded by
+a multiprocessing.Lock, a POSIX semaphore whose acquire and release are full
+memory barriers, so neither side sees half a frame on ARM boards either. The
+writer copies a frame and bumps its sequence under it; the child copies the
+slots whose sequence changed. Each copy is one 513 byte slice, and a child
+that can't get the lock within LOCK_TIMEOUT sends the frames it has.
+
+The child stops when the control process says so, or when it's gone, so a
+crashed control process doesn't leave a port open.
+
+Start it before any threads, so the fork only copies the main one:
+
+    output = OutputProcess(frame_rate=40)
+    output.start()
+    universes = UniverseManager(output.open_device)
+"""
+import mmap
+import multiprocessing
+import os
+import signal
+import struct
+
+import dmx
+import netdmx
+from render_loop import RenderLoop, DEFAULT_FRAME_RATE
+
+MAX_PORTS = 4
+FRAME_SIZE = 513
+# How much nicer than normal the child asks to be, so negative is sooner
+OUTPUT_NICE = -10
+STATS_INTERVAL = 1
+# How long the child waits for the control process to finish a copy
+LOCK_TIMEOUT = .005
+
+# The stop flag, set by the control process
+STOP = struct.Struct('<I')
+# The child's frames sent, skipped and dropped, and its jitter p50, p90, p99
+# and max in microseconds
+STATS = struct.Struct('<QQQIIII')
+SEQUENCE = struct.Struct('<I')
+SLOT_HEADER = struct.Struct('<I64s')
+# Keep slots 4 byte aligned
+SLOT_SIZE = (SLOT_HEADER.size + FRAME_SIZE + 3) & ~3
+HEADER_SIZE = STOP.size + STATS.size
+MAP_SIZE = HEADER_SIZE + MAX_PORTS * SLOT_SIZE
+
+
+def slot_offset(slot):
+    return HEADER_SIZE + slot * SLOT_SIZE
+
+
+class SharedFrames(object):
+    """
+        The shared map, from either side of the fork.
+    """
+
+    def __init__(self):
+        self.map = mmap.mmap(-1, MAP_SIZE)
+        self.lock = multiprocessing.Lock()
+        self.sequences = [0] * MAX_PORTS
+
+    def claim(self, port):
+        """
+            A free slot for port, from the control process.
+        """
+        with self.lock:
+            for slot in range(MAX_PORTS):
+                offset = slot_offset(slot)
+                if not SLOT_HEADER.unpack_from(self.map, offset)[1].rstrip('\0'):
+                    SLOT_HEADER.pack_into(self.map, offset, self.sequences[slot], str(port))
+                    return slot
+        raise ValueError('No output slot left for %s, at most %d ports' % (port, MAX_PORTS))
+
+    def port(self, slot):
+        with self.lock:
+            return SLOT_HEADER.unpack_from(self.map, slot_offset(slot))[1].rstrip('\0')
+
+    def write(self, slot, frame):
+        offset = slot_offset(slot)
+        data = offset + SLOT_HEADER.size
+        with self.lock:
+            self.map[data:data + FRAME_SIZE] = str(frame)
+            self.sequences[slot] = (self.sequences[slot] + 1) & 0xffffffff
+            SEQUENCE.pack_into(self.map, offset, self.sequences[slot])
+
+    def read(self, slot, last_sequence):
+        """
+            (sequence, frame) of a slot, or None if it is still last_sequence
+            or the writer held the lock for LOCK_TIMEOUT.
+        """
+        offset = slot_offset(slot)
+        data = offset + SLOT_HEADER.size
+        if not self.lock.acquire(True, LOCK_TIMEOUT):
+            return None
+        try:
+            sequence, = SEQUENCE.unpack_from(self.map, offset)
+            if sequence == last_sequence:
+                return None
+            return sequence, self.map[data:data + FRAME_SIZE]
+        finally:
+            self.lock.release()
+
+    def stopping(self):
+        return STOP.unpack_from(self.map, 0)[0] != 0
+
+    def stop(self):
+        STOP.pack_into(self.map, 0, 1)
+
+    def write_stats(self, stats):
+        jitter = stats['jitter']
+        STATS.pack_into(self.map, STOP.size, stats['sent'], stats['skipped'], stats['dropped'],
+                        jitter['p50_us'], jitter['p90_us'], jitter['p99_us'],
+                        min(jitter['max_us'], 0xffffffff))
+
+    def read_stats(self):
+        sent, skipped, dropped, p50, p90, p99, most = STATS.unpack_from(self.map, STOP.size)
+        return {
+            'sent': sent,
+            'skipped': skipped,
+            'dropped': dropped,
+            'jitter': {'p50_us': p50, 'p90_us': p90, 'p99_us': p99, 'max_us': most},
+        }
+
+
+class SharedDevice(object):
+    """
+        Dmx surface in the control process for one port of the child.
+    """
+
+    def __init__(self, frames, port):
+        self.frames = frames
+        self.port = port
+        self.slot = frames.claim(port)
+        self.buffer = bytearray(FRAME_SIZE)
+
+    def setPort(self, port, baud=None):
+        pass
+
+    def connect(self):
+        pass
+
+    def setChannel(self, channel, value, autoRender=True):
+        self.buffer[channel] = value
+        if autoRender:
+            self.render()
+
+    def render(self, render_till=None):
+        self.frames.write(self.slot, self.buffer)
+
+    def blackOut(self):
+        self.buffer[:] = bytearray(FRAME_SIZE)
+        self.render()
+
+    def disconnect(self):
+        # The child sends the last frame and closes the port when stopped
+        pass
+
+
+class SlotReader(object):
+    """
+        The child's side: the universes surface a RenderLoop flushes, copying
+        changed slots to devices it opens by the slots' port names.
+    """
+
+    def __init__(self, frames, open_device):
+        self.frames = frames
+        self.open_device = open_device
+        # slot: (port, device, last sequence, last frame)
+        self.outputs = {}
+        self.universes = {}
+
+    def flush(self):
+        written = 0
+        for slot in range(MAX_PORTS):
+            output = self.outputs.get(slot)
+            if output is None:
+                port = self.frames.port(slot)
+                if not port:
+                    continue
+                output = self.outputs[slot] = (port, self.open_device(port), 0, bytearray(FRAME_SIZE))
+            port, device, last_sequence, last_frame = output
+            result = self.frames.read(slot, last_sequence)
+            if result is None:
+                continue
+            sequence, frame = result
+            frame = bytearray(frame)
+            for channel in range(1, FRAME_SIZE):
+                if frame[channel] != last_frame[channel]:
+                    device.setChannel(channel, frame[channel], autoRender=False)
+            device.render()
+            self.outputs[slot] = (port, device, sequence, frame)
+            written += 1
+        return written
+
+    def disconnect(self):
+        for port, device, _, _ in self.outputs.values():
+            device.disconnect()
+        self.outputs.clear()
+
+
+def run_output(frames, open_device, frame_rate, parent):
+    """
+        The child process. It ignores ^C, the control process shuts the lamp
+        down through it and then stops it. It stops by itself once parent,
+        the control process's pid, has gone.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        os.nice(OUTPUT_NICE)
+    except OSError as e:
+        print 'DMX output process could not raise its priority:', e
+    loop = RenderLoop(SlotReader(frames, open_device), frame_rate)
+    state = {'stats_due': 0}
+
+    def check(now):
+        if frames.stopping() or os.getppid() != parent:
+            loop.die = True
+        if now >= state['stats_due']:
+            frames.write_stats(loop.stats())
+            state['stats_due'] = now + STATS_INTERVAL
+    loop.add_frame_hook(check)
+    try:
+        loop.run()
+    finally:
+        # Whatever was written last, the lamp going off on shutdown
+        loop.universes.flush()
+        frames.write_stats(loop.stats())
+        loop.universes.disconnect()
+
+
+class OutputProcess(object):
+
+    def __init__(self, frame_rate=DEFAULT_FRAME_RATE, open_device=dmx.open_device):
+        self.frame_rate = frame_rate
+        self.frames = SharedFrames()
+        self.process = multiprocessing.Process(
+            target=run_output, args=(self.frames, open_device, frame_rate, os.getpid()),
+            name='DMX output')
+        self.process.daemon = True
+
+    def start(self):
+        self.process.start()
+
+    def open_device(self, port, baud=None):
+        """
+            For universe.UniverseManager, a SharedDevice for a serial port,
+            or the network port itself, sent from the control process.
+        """
+        if netdmx.is_network_port(port):
+            return netdmx.open_port(port, baud)
+        return SharedDevice(self.frames, port)
+
+    def stats(self):
+        return self.frames.read_stats()
+
+    def stop(self, timeout=2):
+        self.frames.stop()
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.terminate()
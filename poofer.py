@@ -0,0 +1,247 @@
+#!/usr/bin/env python
+"""
+poofer.py
+
+Fire control: OSC fire pages to the poofer Arduino.
+
+The Arduino (arduino/pooferController) runs 13 poofers, each switched by one
+character on its 115200 baud serial port: 'A' opens poofer 0 and 'a' closes
+it, 'B'/'b' poofer 1 and so on up to 'M'/'m'. It closes a poofer by itself
+after its poofDuration of 2 seconds, whatever it is sent.
+
+The fire page has 4 sets of 3 buttons, a slider for the delay till the poof
+and one for its duration:
+
+    /fire/delay f        seconds between the button and the poof
+    /fire/duration f     seconds the poofers stay open, at most MAX_DURATION
+    /fire/set/<n> 1      poof set n (0-3) after the delay
+    /fire/poofer/<n> 1   poof a single poofer (0-12)
+    /fire/stop 1         close everything now and drop what is scheduled
+
+Opens and closes are scheduled on the EventLoop by their due time, and all
+the commands due within BATCH_WINDOW of each other go out in one serial
+write. A poof that opens a poofer before its last close drops that close, so
+the new poof runs its full duration rather than being cut short. Each write
+is timed against the button press it came from; the report shows how late
+bytes reached the wire.
+
+    python poofer.py [serial port]
+"""
+import os
+import sys
+import time
+
+from OSC import OSCServer
+
+from event_loop import EventLoop
+from metrics import Histogram
+
+POOFERS = 13
+FIRE_SETS = [(0, 1, 2), (3, 4, 5), (6, 7, 8), (9, 10, 11)]
+# The Arduino's poofDuration, it closes poofers by itself after this
+MAX_DURATION = 2.0
+DEFAULT_DELAY = 0
+DEFAULT_DURATION = 1.0
+# Commands due this close together are written together
+BATCH_WINDOW = .002
+BAUD = 115200
+DEFAULT_SERIAL_PORT = '/dev/ttyACM0'
+default_recv_port = 8000
+
+
+def open_char(poofer):
+    return chr(ord('A') + poofer)
+
+
+def close_char(poofer):
+    return chr(ord('a') + poofer)
+
+
+class FakeSerial(object):
+    """
+        Stands in for the Arduino's serial port, keeping every write.
+        writes is a list of (time.time(), bytes) pairs.
+    """
+    def __init__(self, port=None, baudrate=BAUD):
+        self.port = port
+        self.writes = []
+
+    def write(self, data):
+        self.writes.append((time.time(), bytes(data)))
+        return len(data)
+
+    def close(self):
+        pass
+
+
+def open_serial(port=DEFAULT_SERIAL_PORT, baud=BAUD):
+    """
+        The Arduino's serial port, or a FakeSerial if it isn't plugged in.
+    """
+    if not os.path.exists(port):
+        print 'Poofer controller', port, 'not found. Using a fake serial port.'
+        return FakeSerial(port, baud)
+    import serial
+    return serial.Serial(port, baud)
+
+
+class PooferController(object):
+
+    def __init__(self, serial, loop):
+        self.serial = serial
+        self.loop = loop
+        # due time: [(command, pressed at), ...]
+        self.batches = {}
+        self.timers = {}
+        # poofer: due time of its pending close
+        self.closes = {}
+        self.writes = 0
+        # Microseconds from due time to the write, and from the button press to
+        # the write opening the poofers, delay included
+        self.lateness = Histogram()
+        self.press_to_wire = Histogram()
+
+    def poof(self, poofers, delay, duration, pressed=None):
+        """
+            Open poofers after delay seconds, for duration seconds.
+        """
+        if pressed is None:
+            pressed = time.time()
+        duration = max(0, min(MAX_DURATION, duration))
+        start = pressed + max(0, delay)
+        for poofer in poofers:
+            self.schedule(start, open_char(poofer), pressed)
+            previous = self.closes.get(poofer)
+            if previous is not None and previous >= start:
+                self.unschedule(previous, close_char(poofer))
+            self.closes[poofer] = start + duration
+            self.schedule(start + duration, close_char(poofer), pressed)
+
+    def schedule(self, due, command, pressed):
+        batch = self.batches.get(due)
+        if batch is None:
+            batch = self.batches[due] = []
+            self.timers[due] = self.loop.call_at(due, self.write_due)
+        batch.append((command, pressed))
+
+    def unschedule(self, due, command):
+        batch = self.batches.get(due)
+        if batch is None:
+            return
+        batch[:] = [entry for entry in batch if entry[0] != command]
+        if not batch:
+            del self.batches[due]
+            self.timers.pop(due).cancel()
+
+    def write_due(self):
+        now = time.time()
+        due = sorted(when for when in self.batches if when <= now + BATCH_WINDOW)
+        if not due:
+            return
+        commands = []
+        for when in due:
+            self.timers.pop(when).cancel()
+            commands.extend((when, command, pressed) for command, pressed in self.batches.pop(when))
+        for when, command, _ in commands:
+            poofer = ord(command.upper()) - ord('A')
+            if command.islower() and self.closes.get(poofer) == when:
+                del self.closes[poofer]
+        self.serial.write(''.join(command for _, command, _ in commands))
+        written = time.time()
+        self.writes += 1
+        for when, command, pressed in commands:
+            self.lateness.record(max(0, int((written - when) * 1000000)))
+            if command.isupper():
+                self.press_to_wire.record(int((written - pressed) * 1000000))
+
+    def stop(self):
+        """
+            Drop everything scheduled and close every poofer.
+        """
+        for timer in self.timers.values():
+            timer.cancel()
+        self.timers.clear()
+        self.batches.clear()
+        self.closes.clear()
+        self.serial.write(''.join(close_char(poofer) for poofer in range(POOFERS)))
+        self.writes += 1
+
+    def report(self):
+        lines = ['serial writes        %d' % self.writes]
+        for name, histogram in (('late after due', self.lateness),
+                                ('press to open', self.press_to_wire)):
+            summary = histogram.summary()
+            lines.append('%-20s count %d  p50 %.2f  p90 %.2f  p99 %.2f  max %.2f ms' % (
+                name, summary['count'], summary['p50_us'] / 1000.0, summary['p90_us'] / 1000.0,
+                summary['p99_us'] / 1000.0, summary['max_us'] / 1000.0))
+        return '\n'.join(lines)
+
+
+class FireControl(object):
+    """
+        OSC handlers for the fire page, mixed into an OSCServer with a loop.
+    """
+    def __init__(self, serial):
+        self.poofers = PooferController(serial, self.loop)
+        self.fire_delay = DEFAULT_DELAY
+        self.fire_duration = DEFAULT_DURATION
+        self.addMsgHandler('/fire/delay', self.set_fire_delay)
+        self.addMsgHandler('/fire/duration', self.set_fire_duration)
+        self.addMsgHandler('/fire/stop', self.stop_fire)
+        for index in range(len(FIRE_SETS)):
+            self.addMsgHandler('/fire/set/%d' % index, self.fire_set)
+        for poofer in range(POOFERS):
+            self.addMsgHandler('/fire/poofer/%d' % poofer, self.fire_poofer)
+
+    def set_fire_delay(self, path, tags, args, source):
+        self.fire_delay = max(0, float(args[0]))
+
+    def set_fire_duration(self, path, tags, args, source):
+        self.fire_duration = max(0, min(MAX_DURATION, float(args[0])))
+
+    def fire_set(self, path, tags, args, source):
+        # Buttons send 1 when pressed and 0 when let go
+        if args and args[0]:
+            poofers = FIRE_SETS[int(path.rsplit('/', 1)[1])]
+            self.poofers.poof(poofers, self.fire_delay, self.fire_duration)
+
+    def fire_poofer(self, path, tags, args, source):
+        if args and args[0]:
+            poofer = int(path.rsplit('/', 1)[1])
+            self.poofers.poof([poofer], self.fire_delay, self.fire_duration)
+
+    def stop_fire(self, path, tags, args, source):
+        if args and args[0]:
+            self.poofers.stop()
+
+
+class PooferServer(OSCServer, FireControl):
+    """
+        Stand-alone fire control server for the depot board.
+    """
+    def __init__(self, serial, address='0.0.0.0', recv_port=default_recv_port, loop=None):
+        OSCServer.__init__(self, (address, recv_port))
+        self.loop = loop if loop is not None else EventLoop()
+        self.loop.add_reader(self.socket, self._handle_request_noblock)
+        FireControl.__init__(self, serial)
+        print('Starting poofer OSC Server at %s on port %s' % (address, recv_port))
+
+    def serve_forever(self):
+        self.loop.run_forever()
+
+    def close(self):
+        self.poofers.stop()
+        self.loop.remove_reader(self.socket)
+        self.loop.stop()
+        OSCServer.close(self)
+
+
+if __name__ == "__main__":
+    server = PooferServer(open_serial(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_SERIAL_PORT))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        print server.poofers.report()
@@ -0,0 +1,106 @@
+"""
+presence.py
+
+Deadline-driven client presence and idle tracking.
+
+Every datagram from a client counts as a ping. Rather than scanning every
+known client once a second, a PresenceTracker keeps one deadline per client in
+a heap and a single idle deadline for the whole system, and asks the event
+loop to wake it exactly when the earliest one passes.
+
+A ping only updates the client's last-seen time. Its heap entry is left where
+it is and pushed back to the new deadline when it comes up, so a known client
+costs O(1) per ping and O(log n) per timeout.
+"""
+import heapq
+import threading
+import time
+
+
+class PresenceTracker(object):
+    """
+        on_gone(address, seconds_unseen) fires when a client hasn't been seen for
+        gone_after seconds. on_idle() fires once when no client has been seen
+        for idle_after seconds, and again only after another ping.
+
+        ping() may be called from any thread; callbacks run on the loop.
+    """
+
+    def __init__(self, loop, gone_after, idle_after, on_gone, on_idle):
+        self.loop = loop
+        self.gone_after = gone_after
+        self.idle_after = idle_after
+        self.on_gone = on_gone
+        self.on_idle = on_idle
+        self.lock = threading.Lock()
+        self.last_seen = {}
+        self.deadlines = []
+        self.gone_timer = None
+        # Count startup as activity, so the idle pattern waits idle_after
+        # seconds before it first runs.
+        self.last_any = time.time()
+        self.idle = False
+        self.idle_timer = loop.call_at(self.last_any + idle_after, self.check_idle)
+
+    def ping(self, address):
+        now = time.time()
+        with self.lock:
+            self.last_any = now
+            if address not in self.last_seen:
+                heapq.heappush(self.deadlines, (now + self.gone_after, address))
+                if self.gone_timer is None:
+                    self.gone_timer = self.loop.call_at(now + self.gone_after, self.check_gone)
+            self.last_seen[address] = now
+            if self.idle:
+                self.idle = False
+                self.idle_timer = self.loop.call_at(now + self.idle_after, self.check_idle)
+
+    def assume_idle(self):
+        """
+            Start out idle, e.g. when restarting a lamp that was idle, without
+            firing on_idle.
+        """
+        with self.lock:
+            self.idle_timer.cancel()
+            self.idle = True
+
+    def is_present(self, address):
+        return address in self.last_seen
+
+    def clients(self):
+        with self.lock:
+            return list(self.last_seen)
+
+    def check_gone(self):
+        now = time.time()
+        gone = []
+        with self.lock:
+            self.gone_timer = None
+            while self.deadlines and self.deadlines[0][0] <= now:
+                _, address = heapq.heappop(self.deadlines)
+                deadline = self.last_seen[address] + self.gone_after
+                if deadline > now:
+                    # Pinged since this entry was pushed
+                    heapq.heappush(self.deadlines, (deadline, address))
+                else:
+                    gone.append((address, now - self.last_seen.pop(address)))
+            if self.deadlines:
+                self.gone_timer = self.loop.call_at(self.deadlines[0][0], self.check_gone)
+        for address, seconds_unseen in gone:
+            self.on_gone(address, seconds_unseen)
+
+    def check_idle(self):
+        now = time.time()
+        with self.lock:
+            deadline = self.last_any + self.idle_after
+            if deadline > now:
+                self.idle_timer = self.loop.call_at(deadline, self.check_idle)
+                return
+            self.idle = True
+        self.on_idle()
+
+    def close(self):
+        with self.lock:
+            if self.gone_timer is not None:
+                self.gone_timer.cancel()
+            self.idle_timer.cancel()
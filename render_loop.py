@@ -0,0 +1,135 @@
+"""
+render_loop.py
+
+Fixed-rate DMX frame engine.
+
+Instead of pushing a full frame to the Enttec widget on every render call, a
+RenderLoop flushes the universes of a UniverseManager from a single background
+thread at a fixed frame rate. Any number of writes between two ticks are merged
+into one frame, and ticks where nothing changed are skipped.
+
+Frame hooks, such as a show player, run at the start of every tick to update
+the universes for that frame.
+
+The jitter histogram records how far each interval between ticks strayed from
+the frame period, in microseconds.
+"""
+import threading
+import time
+import traceback
+
+from metrics import Histogram
+
+DEFAULT_FRAME_RATE = 40
+
+
+class RenderLoop(object):
+    """
+        Drives a universe.UniverseManager with the same render surface, but
+        renders from a background thread at frame_rate Hz.
+
+        render() only requests a frame, so callers never wait on the serial port.
+    """
+
+    def __init__(self, universes, frame_rate=DEFAULT_FRAME_RATE):
+        self.universes = universes
+        self.frame_rate = frame_rate
+        self.period = 1.0 / frame_rate
+        self.lock = threading.Lock()
+        self.die = False
+
+        # Counters, see stats()
+        self.frames_sent = 0
+        self.frames_merged = 0
+        self.frames_skipped = 0
+        self.frames_dropped = 0
+        self.pending_render = False
+        self.frame_hooks = []
+        self.jitter = Histogram()
+        # Set once the first frame has been written, for work that can wait
+        # until the lamp is showing something
+        self.first_frame = threading.Event()
+
+        self.thread = threading.Thread(target=self.run, name='RenderLoop')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def render(self, render_till=None):
+        """
+            Request a frame. Renders requested while one is already pending are
+            merged into it.
+        """
+        with self.lock:
+            if self.pending_render:
+                self.frames_merged += 1
+            self.pending_render = True
+
+    def blackOut(self):
+        for universe in self.universes.universes.values():
+            universe.blackOut()
+        self.render()
+
+    def run(self):
+        next_tick = time.time()
+        last_tick = None
+        while not self.die:
+            now = time.time()
+            if last_tick is not None:
+                self.jitter.record(int(abs(now - last_tick - self.period) * 1000000))
+            last_tick = now
+            self.tick()
+            next_tick += self.period
+            delay = next_tick - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # The device write overran one or more frame slots, don't try
+                # to catch up by sending bursts.
+                missed = int(-delay / self.period)
+                self.frames_dropped += missed
+                next_tick += missed * self.period
+
+    def add_frame_hook(self, hook):
+        """
+            hook(now) is called from the render thread before every frame.
+        """
+        self.frame_hooks.append(hook)
+
+    def tick(self):
+        now = time.time()
+        for hook in self.frame_hooks:
+            try:
+                hook(now)
+            except Exception:
+                traceback.print_exc()
+        with self.lock:
+            self.pending_render = False
+        if not self.universes.flush():
+            self.frames_skipped += 1
+            return False
+        self.frames_sent += 1
+        if self.frames_sent == 1:
+            self.first_frame.set()
+        return True
+
+    def stats(self):
+        return {
+            'frame_rate': self.frame_rate,
+            'sent': self.frames_sent,
+            'merged': self.frames_merged,
+            'skipped': self.frames_skipped,
+            'dropped': self.frames_dropped,
+            'jitter': self.jitter.summary(),
+        }
+
+    def disconnect(self):
+        """
+            Stop the loop, flush anything still pending and disconnect the devices.
+        """
+        self.die = True
+        if self.thread.is_alive():
+            self.thread.join()
+        self.tick()
+        self.universes.disconnect()
@@ -0,0 +1,137 @@
+"""
+routing.py
+
+Forward OSC messages to other servers by address prefix.
+
+TouchOSC only talks to one host, so the lamp's server relays the pages meant
+for other boards, for example the fire page to the depot's poofer.py:
+
+    LIGHTHOUSE_ROUTES="/fire=192.168.1.20:8000"
+
+Routes map an address prefix to a host:port, or to "local" to keep a part of
+a forwarded prefix here. The longest matching prefix wins, and an address
+with a handler of its own on this server is always handled here. A forwarded
+datagram is passed on as it came, without being decoded, through one
+connected socket per endpoint. Bundles are always handled locally.
+"""
+import errno
+import socket
+
+LOCAL = 'local'
+# Addresses whose route is remembered; cleared when it grows past this
+CACHE_SIZE = 1024
+
+
+def parse_routes(text):
+    """
+        "/fire=host:port /fire/stop=local" to [(prefix, (host, port) or None)]
+    """
+    routes = []
+    for entry in text.split():
+        prefix, target = entry.split('=', 1)
+        if target == LOCAL:
+            routes.append((prefix, None))
+        else:
+            host, port = target.rsplit(':', 1)
+            routes.append((prefix, (host, int(port))))
+    return routes
+
+
+def osc_address(packet):
+    end = packet.find('\0')
+    return packet[:end] if end > 0 else None
+
+
+class Route(object):
+
+    def __init__(self, prefix, endpoint):
+        self.prefix = prefix.rstrip('/') or '/'
+        self.endpoint = endpoint
+        self.packets = 0
+        self.bytes = 0
+        self.errors = 0
+
+    def matches(self, address):
+        return (address == self.prefix or self.prefix == '/' or
+                address.startswith(self.prefix + '/'))
+
+
+class Router(object):
+
+    def __init__(self, routes=()):
+        self.routes = []
+        self.remote = False
+        self.sockets = {}
+        self.cache = {}
+        for prefix, endpoint in routes:
+            self.add_route(prefix, endpoint)
+
+    def add_route(self, prefix, endpoint=None):
+        """
+            Send addresses under prefix to endpoint, (host, port), or keep them
+            here if endpoint is None.
+        """
+        self.routes.append(Route(prefix, endpoint))
+        self.routes.sort(key=lambda route: -len(route.prefix))
+        self.remote = any(route.endpoint is not None for route in self.routes)
+        self.cache.clear()
+
+    def match(self, address):
+        route = self.cache.get(address)
+        if route is None:
+            for route in self.routes:
+                if route.matches(address):
+                    break
+            else:
+                route = False
+            if len(self.cache) >= CACHE_SIZE:
+                self.cache.clear()
+            self.cache[address] = route
+        return route or None
+
+    def socket(self, endpoint):
+        sock = self.sockets.get(endpoint)
+        if sock is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setblocking(False)
+            sock.connect(endpoint)
+            self.sockets[endpoint] = sock
+        return sock
+
+    def forward(self, packet, local_addresses=()):
+        """
+            Send packet on if its address routes to another server. Returns
+            False if it should be handled here.
+        """
+        if not self.remote or packet.startswith('#bundle'):
+            return False
+        address = osc_address(packet)
+        if address is None or address in local_addresses:
+            return False
+        route = self.match(address)
+        if route is None or route.endpoint is None:
+            return False
+        try:
+            self.socket(route.endpoint).send(packet)
+        except socket.error as e:
+            # Full buffers or an unreachable board drop the message, like UDP
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNREFUSED):
+                print 'Forwarding', address, 'to', route.endpoint, 'failed:', e
+            route.errors += 1
+            return True
+        route.packets += 1
+        route.bytes += len(packet)
+        return True
+
+    def stats(self):
+        """
+            {prefix: (endpoint, packets, bytes, errors)}
+        """
+        return dict((route.prefix, ('%s:%d' % route.endpoint if route.endpoint else LOCAL,
+                                    route.packets, route.bytes, route.errors))
+            for route in self.routes)
+
+    def close(self):
+        for sock in self.sockets.values():
+            sock.close()
+        self.sockets.clear()
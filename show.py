@@ -0,0 +1,268 @@
+"""
+show.py
+
+Precompiled, time-indexed lamp shows.
+
+A show is a JSON file in shows/ with keyframes per lamp attribute:
+
+    {
+        "name": "idle",
+        "duration": 1.5,
+        "loop": false,
+        "tracks": {
+            "tilt": [[0, -30], [2, 45, "ease_in_out"]],
+            "movement": [[1, "cw"]]
+        }
+    }
+
+Each keyframe is [seconds, value] or [seconds, value, easing], where easing is
+how the value moves from the previous keyframe to this one (linear by default).
+A track leaves its channels alone before its first keyframe and holds its last
+value after the last one. Tracks are lamp, strobe, tilt, pan and speed in the
+same units as the Lighthouse set_* methods, and movement, one of "cw", "ccw"
+or "goto". Mind the Space Cannon's rule that speed must be under 50% when the
+movement direction changes.
+
+compile_show() evaluates every frame once, through the fixtures' own encoders,
+and keeps only the channels that change from frame to frame. A ShowPlayer runs
+as a RenderLoop frame hook and applies the frames due by the wall clock, so
+playback costs a few setChannel calls per frame and doesn't drift.
+"""
+import json
+import os
+import threading
+import time
+
+SHOW_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'shows')
+# A full channel snapshot is kept this often, for seeking
+SNAPSHOT_SECONDS = 5
+
+
+def step(t):
+    return 0
+
+
+def linear(t):
+    return t
+
+
+def ease_in(t):
+    return t * t
+
+
+def ease_out(t):
+    return t * (2 - t)
+
+
+def ease_in_out(t):
+    return t * t * (3 - 2 * t)
+
+
+EASINGS = {
+    'step': step,
+    'linear': linear,
+    'ease_in': ease_in,
+    'ease_out': ease_out,
+    'ease_in_out': ease_in_out,
+}
+
+
+def set_movement(fixture, dmx, direction):
+    if direction == 'goto':
+        fixture.set_rotation_direction(dmx, None)
+    else:
+        fixture.set_rotation_direction(dmx, direction == 'cw')
+
+
+# In the order they are applied, so that movement wins over the pan
+# location's goto.
+TRACKS = (
+    ('lamp', lambda fixture, dmx, value: fixture.set_lamp(dmx, value)),
+    ('strobe', lambda fixture, dmx, value: fixture.set_strobe(dmx, value)),
+    ('tilt', lambda fixture, dmx, value: fixture.set_tilt(dmx, value)),
+    ('pan', lambda fixture, dmx, value: fixture.set_pan_position(dmx, value)),
+    ('speed', lambda fixture, dmx, value: fixture.set_speed(dmx, value)),
+    ('movement', set_movement),
+)
+
+
+def load_show(path):
+    with open(path) as f:
+        show = json.load(f)
+    names = set(name for name, _ in TRACKS)
+    for name, keyframes in show['tracks'].items():
+        if name not in names:
+            raise ValueError('%s: unknown track %r' % (path, name))
+        for keyframe in keyframes:
+            if len(keyframe) == 3 and keyframe[2] not in EASINGS:
+                raise ValueError('%s: unknown easing %r' % (path, keyframe[2]))
+    return show
+
+
+def load_shows(directory=SHOW_DIR):
+    shows = {}
+    for filename in sorted(os.listdir(directory)):
+        if filename.endswith('.json'):
+            show = load_show(os.path.join(directory, filename))
+            shows[show['name']] = show
+    return shows
+
+
+def evaluate(keyframes, t):
+    """
+        Value of a track at t seconds, None before its first keyframe.
+    """
+    previous = keyframes[0]
+    if t < previous[0]:
+        return None
+    for keyframe in keyframes[1:]:
+        if t < keyframe[0]:
+            start, value = previous[0], previous[1]
+            if isinstance(value, basestring):
+                return value
+            easing = EASINGS[keyframe[2] if len(keyframe) == 3 else 'linear']
+            fraction = easing((t - start) / float(keyframe[0] - start))
+            return value + (keyframe[1] - value) * fraction
+        previous = keyframe
+    return previous[1]
+
+
+class Recorder(object):
+    """
+        Stands in for a Universe while compiling, collecting channel writes.
+    """
+
+    def __init__(self):
+        self.channels = {}
+
+    def setChannel(self, channel, value, autoRender=False):
+        self.channels[channel] = max(0, min(255, int(value)))
+
+
+class CompiledShow(object):
+    """
+        deltas[i] is a list of (universe, [(channel, value), ...]) to apply to go
+        from frame i-1 to frame i; deltas[0] holds all of frame 0.
+        snapshots maps a frame index to its full state in the same form.
+    """
+
+    def __init__(self, name, frame_rate, loop, deltas, snapshots):
+        self.name = name
+        self.frame_rate = frame_rate
+        self.loop = loop
+        self.deltas = deltas
+        self.snapshots = snapshots
+
+    def __len__(self):
+        return len(self.deltas)
+
+
+def compile_show(show, outputs, frame_rate):
+    """
+        Compile a loaded show for (fixture, universe) outputs at frame_rate.
+    """
+    frame_count = max(1, int(round(show['duration'] * frame_rate)))
+    tracks = [(name, setter, show['tracks'][name])
+        for name, setter in TRACKS if name in show['tracks']]
+    snapshot_every = max(1, int(SNAPSHOT_SECONDS * frame_rate))
+
+    recorders = [(fixture, universe, Recorder()) for fixture, universe in outputs]
+    previous = [None] * len(tracks)
+    state = {}
+    deltas = []
+    snapshots = {}
+    for frame in range(frame_count):
+        t = frame / float(frame_rate)
+        for index, (name, setter, keyframes) in enumerate(tracks):
+            value = evaluate(keyframes, t)
+            if value is None:
+                continue
+            if not isinstance(value, basestring):
+                value = int(round(value))
+            if value == previous[index]:
+                continue
+            previous[index] = value
+            for fixture, universe, recorder in recorders:
+                setter(fixture, recorder, value)
+
+        changes = {}
+        for fixture, universe, recorder in recorders:
+            current = state.setdefault(universe, {})
+            for channel, value in recorder.channels.iteritems():
+                if current.get(channel) != value:
+                    current[channel] = value
+                    changes.setdefault(universe, []).append((channel, value))
+            recorder.channels.clear()
+        deltas.append(changes.items())
+        if frame % snapshot_every == 0:
+            snapshots[frame] = [(universe, sorted(channels.items()))
+                for universe, channels in state.iteritems()]
+    return CompiledShow(show['name'], frame_rate, show.get('loop', False), deltas, snapshots)
+
+
+class ShowPlayer(object):
+    """
+        Plays a CompiledShow. Call it once per frame with the current time,
+        e.g. as a RenderLoop frame hook.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.show = None
+        self.start_time = 0
+        self.frame = -1
+
+    def play(self, show, seconds=0):
+        with self.lock:
+            self.show = show
+            self.start_time = time.time() - seconds
+            self.frame = -1
+
+    def stop(self):
+        with self.lock:
+            self.show = None
+
+    def seek(self, seconds):
+        with self.lock:
+            if self.show is not None:
+                self.start_time = time.time() - seconds
+                self.frame = -1
+
+    def playing(self):
+        show = self.show
+        return show.name if show is not None else None
+
+    def __call__(self, now):
+        with self.lock:
+            show = self.show
+            if show is None:
+                return
+            target = int((now - self.start_time) * show.frame_rate)
+            finished = False
+            if target >= len(show):
+                if show.loop:
+                    wraps = target // len(show)
+                    self.start_time += wraps * len(show) / float(show.frame_rate)
+                    target -= wraps * len(show)
+                    # Carry on from frame 0, which restores the whole look
+                    self.frame = -1
+                else:
+                    target = len(show) - 1
+                    finished = True
+            if target == self.frame:
+                return
+
+            if target < self.frame or self.frame < 0:
+                start = max(frame for frame in show.snapshots if frame <= target)
+                self.apply(show.snapshots[start])
+            else:
+                start = self.frame
+            for frame in range(start + 1, target + 1):
+                self.apply(show.deltas[frame])
+            self.frame = target
+            if finished:
+                self.show = None
+
+    def apply(self, changes):
+        for universe, channels in changes:
+            universe.apply_changes(channels)
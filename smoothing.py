@@ -0,0 +1,180 @@
+"""
+smoothing.py
+
+Velocity and acceleration limited pan and tilt.
+
+A slider sends a stream of positions, each a little off from the last, and
+written straight to the lamp every one of them is a step the motors jerk to.
+A MotionSmoother is a RenderLoop frame hook that takes them as targets
+instead, and moves every fixture's pan and tilt towards its target by a
+trapezoidal profile: speeding up by at most max_acceleration, cruising at
+max_velocity, and slowing down in time to stop on the target.
+
+Pan moves along the calibration's track, the usable arcs laid end to end, so
+it never stops in a dead zone: it steps over one in a single frame.
+
+The channels are only written when their DMX value changes. Pan moving at
+any speed changes its channel nearly every frame, so while it moves it is
+only written once it is PAN_MIN_STEP values off, and settling writes the
+exact value; the lamp's own motor fills in between. A settled axis
+whose channel was changed by something else, a show or a warm restart, picks
+up from the channel's value when it gets its next target.
+"""
+import math
+import threading
+
+# Degrees per second, and degrees per second per second
+PAN_MAX_VELOCITY = 180
+PAN_MAX_ACCELERATION = 360
+TILT_MAX_VELOCITY = 90
+TILT_MAX_ACCELERATION = 180
+# Closer than this to the target, and slow enough to stop, is there. Finer
+# than a DMX step of either channel.
+SETTLE_DEGREES = .25
+# DMX values a moving pan has to be off before it is written
+PAN_MIN_STEP = 2
+# Longest frame integrated in one step, so a stalled render thread doesn't
+# throw the lamp across the sky when it comes back
+MAX_STEP = .1
+
+
+class Axis(object):
+    """
+        One channel's position, velocity and target, in its own units.
+    """
+    __slots__ = ('position', 'velocity', 'target', 'max_velocity', 'max_acceleration')
+
+    def __init__(self, position, max_velocity, max_acceleration):
+        self.position = position
+        self.velocity = 0.0
+        self.target = position
+        self.max_velocity = max_velocity
+        self.max_acceleration = max_acceleration
+
+    def settled(self):
+        return self.velocity == 0 and self.position == self.target
+
+    def hold(self):
+        self.velocity = 0.0
+        self.target = self.position
+
+    def step(self, dt):
+        """
+            Move dt seconds towards the target. Returns False once settled.
+        """
+        distance = self.target - self.position
+        max_change = self.max_acceleration * dt
+        if abs(distance) < SETTLE_DEGREES and abs(self.velocity) <= max_change:
+            self.position = self.target
+            self.velocity = 0.0
+            return False
+        # The fastest we can go and still stop at the target
+        speed = min(self.max_velocity, math.sqrt(2 * self.max_acceleration * abs(distance)))
+        desired = math.copysign(speed, distance)
+        self.velocity += max(-max_change, min(max_change, desired - self.velocity))
+        travel = self.velocity * dt
+        if travel and (travel > 0) == (distance > 0) and abs(travel) >= abs(distance):
+            self.position = self.target
+            self.velocity = 0.0
+            return False
+        self.position += travel
+        return True
+
+
+class MotionSmoother(object):
+    """
+        Frame hook easing the pan and tilt of every (fixture, universe) output
+        to their targets.
+    """
+
+    def __init__(self, outputs,
+                 pan_limits=(PAN_MAX_VELOCITY, PAN_MAX_ACCELERATION),
+                 tilt_limits=(TILT_MAX_VELOCITY, TILT_MAX_ACCELERATION)):
+        self.lock = threading.Lock()
+        # [(fixture, universe, pan axis, tilt axis)]
+        self.axes = []
+        for fixture, universe in outputs:
+            pan = tilt = None
+            if fixture.channel_pan_location is not None:
+                pan = Axis(self.read_pan(fixture, universe), *pan_limits)
+            if fixture.channel_tilt is not None:
+                tilt = Axis(self.read_tilt(fixture, universe), *tilt_limits)
+            self.axes.append((fixture, universe, pan, tilt))
+        self.last = None
+        self.moving = False
+        # Channel writes that changed a value
+        self.writes = 0
+
+    def read_pan(self, fixture, universe):
+        calibration = fixture.calibration
+        degrees = calibration.pan_from_dmx(universe.getChannel(fixture.channel_pan_location))
+        return float(calibration.pan_to_track(degrees))
+
+    def read_tilt(self, fixture, universe):
+        return float(fixture.calibration.tilt_from_dmx(universe.getChannel(fixture.channel_tilt)))
+
+    def pan_value(self, fixture, position):
+        return fixture.calibration.pan(int(round(fixture.calibration.track_to_pan(position))))
+
+    def tilt_value(self, fixture, position):
+        return fixture.calibration.tilt(int(round(position)))
+
+    def set_pan(self, position_degrees):
+        with self.lock:
+            for fixture, universe, pan, _ in self.axes:
+                if pan is None:
+                    continue
+                if pan.settled() and universe.getChannel(fixture.channel_pan_location) != \
+                        self.pan_value(fixture, pan.position):
+                    pan.position = self.read_pan(fixture, universe)
+                pan.target = float(fixture.calibration.pan_to_track(position_degrees))
+            self.moving = True
+
+    def set_tilt(self, tilt_degrees):
+        with self.lock:
+            for fixture, universe, _, tilt in self.axes:
+                if tilt is None:
+                    continue
+                if tilt.settled() and universe.getChannel(fixture.channel_tilt) != \
+                        self.tilt_value(fixture, tilt.position):
+                    tilt.position = self.read_tilt(fixture, universe)
+                calibration = fixture.calibration
+                tilt.target = float(max(calibration.tilt_limit_low,
+                                        min(calibration.tilt_limit_high, tilt_degrees)))
+            self.moving = True
+
+    def hold(self):
+        """
+            Stop every axis where it is, for when something else takes over
+            the channels.
+        """
+        with self.lock:
+            for _, _, pan, tilt in self.axes:
+                for axis in (pan, tilt):
+                    if axis is not None:
+                        axis.hold()
+            self.moving = False
+
+    def __call__(self, now):
+        with self.lock:
+            last, self.last = self.last, now
+            if not self.moving:
+                return
+            dt = min(MAX_STEP, now - last) if last is not None else 0
+            moving = False
+            for fixture, universe, pan, tilt in self.axes:
+                if pan is not None:
+                    moved = pan.step(dt)
+                    moving = moved or moving
+                    self.write(universe, fixture.channel_pan_location,
+                               self.pan_value(fixture, pan.position), PAN_MIN_STEP if moved else 1)
+                if tilt is not None:
+                    moving = tilt.step(dt) or moving
+                    self.write(universe, fixture.channel_tilt,
+                               self.tilt_value(fixture, tilt.position))
+            self.moving = moving
+
+    def write(self, universe, channel, value, min_step=1):
+        if abs(universe.getChannel(channel) - value) >= min_step:
+            universe.setChannel(channel, value)
+            self.writes += 1
@@ -0,0 +1,207 @@
+"""
+state.py
+
+Warm restart: the last look of the lamp, kept in a small memory-mapped file.
+
+A StateSaver runs as a RenderLoop frame hook and writes the universes, the
+client in control, the idle flag and the playing show to a StateFile whenever
+any of them change. On boot the Lighthouse puts the saved universes back
+before its first frame instead of homing the lamp.
+
+The file holds two slots, each with a sequence number and a CRC32 of its
+contents, and a save goes to the older one. A write torn by a crash or a power
+cut leaves the other slot to load, so there is no rename on the frame path.
+A thread of the StateFile's own flushes the map to the disk at most every
+SYNC_INTERVAL, so a slow SD card never holds up a frame.
+
+The file has to outlive a power cut, so the default is under /var/lib. On a
+board running overlayroot that is a ramdisk too: mount a writable partition
+there or point LIGHTHOUSE_STATE at one. A state file on tmpfs or an overlay
+is warned about at startup.
+"""
+import collections
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+DEFAULT_PATH = '/var/lib/lighthouse/lighthouse.state'
+# Filesystems whose files are gone after a power cut
+VOLATILE_FILESYSTEMS = ('tmpfs', 'ramfs', 'overlay')
+MAGIC = 'LHSTATE2'
+MAX_UNIVERSES = 4
+UNIVERSE_SIZE = 512
+# The map is flushed to the disk at most this often
+SYNC_INTERVAL = 1
+
+# seq, crc32 of the body
+SLOT_HEADER = struct.Struct('<II')
+# time, owner, idle, show, show start time, universe count
+BODY_HEADER = struct.Struct('<d16s?32sdB')
+# port, universe, then the values of channels 1 to UNIVERSE_SIZE
+UNIVERSE_HEADER = struct.Struct('<64sB')
+UNIVERSE_ENTRY_SIZE = UNIVERSE_HEADER.size + UNIVERSE_SIZE
+BODY_SIZE = BODY_HEADER.size + MAX_UNIVERSES * UNIVERSE_ENTRY_SIZE
+SLOT_SIZE = SLOT_HEADER.size + BODY_SIZE
+FILE_SIZE = len(MAGIC) + 2 * SLOT_SIZE
+
+# universes maps (port, universe) to a bytearray of channels 1 to 512
+Snapshot = collections.namedtuple('Snapshot',
+    'time owner idle show show_started universes')
+
+
+def filesystem_type(path):
+    """
+        The type of the filesystem path is on, from /proc/mounts, or None.
+    """
+    path = os.path.realpath(path)
+    mount_point, kind = '', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount = fields[1]
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and \
+                        len(mount) >= len(mount_point):
+                    mount_point, kind = mount, fields[2]
+    except IOError:
+        return None
+    return kind
+
+
+class StateFile(object):
+
+    def __init__(self, path=DEFAULT_PATH, sync_interval=SYNC_INTERVAL):
+        self.path = path
+        directory = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        kind = filesystem_type(path)
+        if kind in VOLATILE_FILESYSTEMS:
+            print 'State file %s is on %s and will not survive a power cut,' % (path, kind), \
+                'set LIGHTHOUSE_STATE to a path on a persistent partition.'
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+        try:
+            if os.fstat(fd).st_size != FILE_SIZE:
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, FILE_SIZE)
+                os.write(fd, MAGIC)
+            self.map = mmap.mmap(fd, FILE_SIZE)
+        finally:
+            os.close(fd)
+        if self.map[:len(MAGIC)] != MAGIC:
+            self.map[:] = '\0' * FILE_SIZE
+            self.map[:len(MAGIC)] = MAGIC
+        self.body = bytearray(BODY_SIZE)
+        self.seq = max(seq for seq, _ in self.slots())
+        self.sync_interval = sync_interval
+        self.dirty = False
+        self.die = False
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='StateSync')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def slot_offset(self, index):
+        return len(MAGIC) + index * SLOT_SIZE
+
+    def slots(self):
+        """
+            (seq, body) for each slot, seq 0 where the body doesn't check out.
+        """
+        result = []
+        for index in range(2):
+            offset = self.slot_offset(index)
+            seq, crc = SLOT_HEADER.unpack_from(self.map, offset)
+            body = self.map[offset + SLOT_HEADER.size:offset + SLOT_SIZE]
+            if zlib.crc32(body) & 0xffffffff != crc:
+                seq = 0
+            result.append((seq, body))
+        return result
+
+    def load(self):
+        """
+            The newest complete Snapshot, or None if nothing was saved.
+        """
+        seq, body = max(self.slots())
+        if not seq:
+            return None
+        saved, owner, idle, show, show_started, count = BODY_HEADER.unpack_from(body)
+        universes = {}
+        for index in range(count):
+            offset = BODY_HEADER.size + index * UNIVERSE_ENTRY_SIZE
+            port, universe = UNIVERSE_HEADER.unpack_from(body, offset)
+            offset += UNIVERSE_HEADER.size
+            universes[(port.rstrip('\0'), universe)] = bytearray(body[offset:offset + UNIVERSE_SIZE])
+        return Snapshot(saved, owner.rstrip('\0') or None, idle, show.rstrip('\0') or None,
+            show_started, universes)
+
+    def save(self, owner, idle, show, show_started, universes):
+        """
+            universes is a list of Universe, at most MAX_UNIVERSES.
+        """
+        body = self.body
+        BODY_HEADER.pack_into(body, 0, time.time(), str(owner or ''), idle,
+            (show or u'').encode('utf-8'), show_started or 0, len(universes))
+        for index, universe in enumerate(universes):
+            offset = BODY_HEADER.size + index * UNIVERSE_ENTRY_SIZE
+            UNIVERSE_HEADER.pack_into(body, offset, universe.port, universe.universe)
+            offset += UNIVERSE_HEADER.size
+            with universe.lock:
+                body[offset:offset + UNIVERSE_SIZE] = universe.buffer[1:]
+
+        data = str(body)
+        self.seq += 1
+        offset = self.slot_offset(self.seq % 2)
+        self.map[offset + SLOT_HEADER.size:offset + SLOT_SIZE] = data
+        self.map[offset:offset + SLOT_HEADER.size] = SLOT_HEADER.pack(
+            self.seq, zlib.crc32(data) & 0xffffffff)
+        self.dirty = True
+
+    def run(self):
+        while not self.die:
+            self.wake.wait(self.sync_interval)
+            if self.dirty:
+                self.dirty = False
+                try:
+                    self.map.flush()
+                except (EnvironmentError, ValueError) as e:
+                    print 'State file', self.path, 'flush failed:', e
+
+    def close(self):
+        self.die = True
+        self.wake.set()
+        self.thread.join()
+        self.map.flush()
+        self.map.close()
+
+
+class StateSaver(object):
+    """
+        Frame hook saving to state_file when describe() or a universe changes.
+        describe() returns (owner, idle, show, show_started).
+    """
+
+    def __init__(self, state_file, universes, describe):
+        self.state_file = state_file
+        self.universes = universes[:MAX_UNIVERSES]
+        self.describe = describe
+        self.last_description = None
+        self.last_buffers = [None] * len(self.universes)
+        self.saves = 0
+
+    def __call__(self, now):
+        description = self.describe()
+        changed = description != self.last_description
+        for index, universe in enumerate(self.universes):
+            if universe.buffer != self.last_buffers[index]:
+                self.last_buffers[index] = bytearray(universe.buffer)
+                changed = True
+        if changed:
+            self.last_description = description
+            self.state_file.save(*(description + (self.universes,)))
+            self.saves += 1
@@ -0,0 +1,78 @@
+"""
+status.py
+
+Delta-only status updates to TouchOSC clients.
+
+The server used to resend every status value to every client once a second.
+A StatusPublisher remembers the last value sent for each (client, path) and
+only sends what changed, as one OSC bundle per client through a single
+long-lived OSCClient socket. Since UDP can lose packets, each client still gets
+a full resync every resync_interval seconds.
+"""
+import time
+
+import OSC
+
+TOUCHOSC_PORT = 8000
+# The TouchOSC editor/simulator on the same machine listens on another port
+LOCAL_TOUCHOSC_PORT = 4000
+
+
+def reply_port(client_address):
+    return TOUCHOSC_PORT if client_address != '127.0.0.1' else LOCAL_TOUCHOSC_PORT
+
+
+class StatusPublisher(object):
+
+    def __init__(self, client, resync_interval):
+        self.client = client
+        self.resync_interval = resync_interval
+        self.last_sent = {}
+        self.last_resync = {}
+        self.packets_sent = 0
+
+    def publish(self, client_address, statuses, force=False):
+        """
+            Send the (path, value) pairs in statuses that changed since the last
+            publish to this client, or all of them if force is set or a resync
+            is due. Returns how many values were sent.
+        """
+        now = time.time()
+        if now - self.last_resync.get(client_address, 0) >= self.resync_interval:
+            force = True
+            self.last_resync[client_address] = now
+
+        changed = [(path, value) for path, value in statuses
+            if force or self.last_sent.get((client_address, path)) != value]
+        if not changed:
+            return 0
+
+        if len(changed) == 1:
+            packet = self.message(*changed[0])
+        else:
+            packet = OSC.OSCBundle()
+            for path, value in changed:
+                packet.append(self.message(path, value))
+        try:
+            self.client.sendto(packet, (client_address, reply_port(client_address)))
+        except OSC.OSCClientError:
+            # Try again on the next resync
+            self.last_resync.pop(client_address, None)
+            return 0
+        self.packets_sent += 1
+        for path, value in changed:
+            self.last_sent[(client_address, path)] = value
+        return len(changed)
+
+    def message(self, path, value):
+        msg = OSC.OSCMessage(path)
+        msg.append(value, typehint='f')
+        return msg
+
+    def forget(self, client_address):
+        """
+            Drop what was sent to a client, so it gets everything next time.
+        """
+        self.last_resync.pop(client_address, None)
+        for key in [key for key in self.last_sent if key[0] == client_address]:
+            del self.last_sent[key]
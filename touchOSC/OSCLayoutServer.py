@@ -1,25 +1,26 @@
 #!/usr/bin/env python
-"""Simple HTTP Server.
+"""TouchOSC layout server.
 
-This module builds on BaseHTTPServer by implementing the standard GET
-and HEAD requests in a fairly straightforward manner.
+Serves the .touchosc layouts next to this file to TouchOSC's "sync" button.
+Every layout is unzipped once and kept in memory, and only read again when
+its file's mtime changes. GET / serves the default layout, GET /samson or
+/samson.touchosc any other one. Responses carry Content-Length, ETag and
+Last-Modified, conditional requests get a 304, and each request has its own
+thread, so a crowd of phones syncing at once don't queue behind each other.
 
 """
 
 
-__version__ = "0.6"
+__version__ = "0.7"
 
 import os
-import posixpath
 import BaseHTTPServer
-from SimpleHTTPServer import SimpleHTTPRequestHandler
-import urllib
-import cgi
-import platform
+import SocketServer
+import email.utils
+import gzip
+import hashlib
 import sys
-import shutil
-import time
-import mimetypes
+import threading
 import zipfile
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -30,47 +31,195 @@ except ImportError:
     from StringIO import StringIO
 
 PORT = 9658
+LAYOUT_DIR = os.path.dirname(os.path.abspath(__file__))
+EXTENSION = '.touchosc'
+
+
+class Layout(object):
+    """
+        One layout's index.xml, as served and gzipped, with its validators.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.filename = os.path.basename(path)
+        self.mtime = os.stat(path).st_mtime
+        z = zipfile.ZipFile(path)
+        try:
+            self.body = z.read('index.xml')
+        finally:
+            z.close()
+        compressed = StringIO()
+        f = gzip.GzipFile(fileobj=compressed, mode='wb', mtime=0)
+        f.write(self.body)
+        f.close()
+        self.gzipped = compressed.getvalue()
+        digest = hashlib.md5(self.body).hexdigest()
+        # The two bodies are different representations, each with its own tag
+        self.etag = '"%s"' % digest
+        self.gzip_etag = '"%s-gzip"' % digest
+        self.last_modified = email.utils.formatdate(self.mtime, usegmt=True)
+
+
+def accepts_gzip(accept_encoding):
+    """
+        Whether an Accept-Encoding header allows gzip, by its q values:
+        "gzip;q=0" refuses it and "*" allows it unless gzip is listed.
+    """
+    qualities = {}
+    for token in accept_encoding.split(','):
+        parts = token.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding] = quality
+    for coding in ('gzip', 'x-gzip', '*'):
+        if coding in qualities:
+            return qualities[coding] > 0
+    return False
+
+
+class LayoutCache(object):
+    """
+        The layouts in a directory by name, reloaded when their mtime changes.
+    """
+
+    def __init__(self, directory=LAYOUT_DIR):
+        self.directory = directory
+        self.lock = threading.Lock()
+        self.layouts = {}
+        for filename in sorted(os.listdir(directory)):
+            if filename.endswith(EXTENSION):
+                self.get(filename[:-len(EXTENSION)])
+
+    def get(self, name):
+        """
+            The Layout called name, or None if there is no such file.
+        """
+        if name.endswith(EXTENSION):
+            name = name[:-len(EXTENSION)]
+        if not name or '/' in name or name.startswith('.'):
+            return None
+        path = os.path.join(self.directory, name + EXTENSION)
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            return None
+        layout = self.layouts.get(name)
+        if layout is None or layout.mtime != mtime:
+            with self.lock:
+                layout = self.layouts.get(name)
+                if layout is None or layout.mtime != mtime:
+                    layout = self.layouts[name] = Layout(path)
+        return layout
 
-def doit(filename):
-    class OSCRequestHandler(SimpleHTTPRequestHandler):
+
+class ThreadedHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def make_handler(cache, default_layout):
+    class OSCRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         """OSCRequestHandler
 
-        Hardcode the information necessary for TouchOSC to download the supplied
-        layout file.
+        Hardcode the information necessary for TouchOSC to download a layout.
 
         """
 
-        def send_head(self):
-            """Hard coded single-file server.
-            """
+        server_version = "OSCLayoutServer/" + __version__
+
+        def do_GET(self):
+            self.send_layout(head=False)
+
+        def do_HEAD(self):
+            self.send_layout(head=True)
+
+        def not_modified(self, layout, etag):
+            etags = self.headers.get('If-None-Match')
+            if etags is not None:
+                # Weak comparison, as for GET
+                tags = [tag.strip() for tag in etags.split(',')]
+                return etag in [tag[2:] if tag.startswith('W/') else tag for tag in tags] or \
+                    etags.strip() == '*'
+            since = self.headers.get('If-Modified-Since')
+            if since is not None:
+                since = email.utils.parsedate_tz(since)
+                if since is not None:
+                    return int(layout.mtime) <= email.utils.mktime_tz(since)
+            return False
+
+        def send_layout(self, head):
+            name = self.path.split('?', 1)[0].strip('/') or default_layout
+            layout = cache.get(name)
+            if layout is None:
+                self.send_error(404, 'No layout %s' % name)
+                return
+
+            gzipped = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+            body = layout.gzipped if gzipped else layout.body
+            etag = layout.gzip_etag if gzipped else layout.etag
+            if self.not_modified(layout, etag):
+                self.send_response(304)
+                self.send_header("ETag", etag)
+                self.send_header("Vary", "Accept-Encoding")
+                self.end_headers()
+                return
             self.send_response(200)
             self.send_header("Content-type", 'application/touchosc')
-            self.send_header("Date", self.date_time_string(time.time()))
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", layout.last_modified)
+            self.send_header("Vary", "Accept-Encoding")
+            if gzipped:
+                self.send_header("Content-Encoding", "gzip")
             self.send_header("Content-Disposition", 'attachment; filename="%s"' %
-                (filename, ))
+                (layout.filename, ))
             self.end_headers()
-            full_filename = os.path.join(os.path.dirname(__file__), filename)
-            z = zipfile.ZipFile(full_filename)
-            return z.open('index.xml', 'r')
-
-    service = None
-    if platform.system() == 'Linux':
-        from avahi_announce import ZeroconfService
-        service = ZeroconfService(
-            name="BRLS touchOSC layout", port=PORT, stype="_touchosceditor._tcp")
-        service.publish()
+            if not head:
+                self.wfile.write(body)
+
+    return OSCRequestHandler
+
+
+def doit(filename):
+    cache = LayoutCache()
+    default_layout = os.path.basename(filename)
     server_address = ('', PORT)
-    httpd = BaseHTTPServer.HTTPServer(server_address, OSCRequestHandler)
+    httpd = ThreadedHTTPServer(server_address, make_handler(cache, default_layout))
+    # Announce from the side, the layout can be served meanwhile
+    services = []
+    if sys.platform.startswith('linux'):
+        def publish():
+            try:
+                from avahi_announce import ZeroconfService
+                service = ZeroconfService(
+                    name="BRLS touchOSC layout", port=PORT, stype="_touchosceditor._tcp")
+                service.publish()
+            except Exception as e:
+                print 'Zeroconf publishing failed:', e
+                return
+            services.append(service)
+        thread = threading.Thread(target=publish, name='avahi')
+        thread.daemon = True
+        thread.start()
     try:
         httpd.serve_forever()
     finally:
-        if service:
+        for service in services:
             service.unpublish()
 
 if __name__ == '__main__':
     filename = sys.argv[1] if len(sys.argv) == 2 else 'mainLight.touchosc'
-    if not os.path.exists(filename):
-        print 'Layout file {0} not found, please try again.'
+    if LayoutCache().get(os.path.basename(filename)) is None:
+        print 'Layout file {0} not found, please try again.'.format(filename)
         sys.exit(1)
     doit(filename)
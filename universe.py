@@ -0,0 +1,214 @@
+"""
+universe.py
+
+DMX universes across one or more output ports.
+
+Each fixture is patched onto a (port, universe) pair at its start address. A
+Universe keeps a bytearray of the channel values and the set of channels that
+changed since the last flush; the UniverseManager flushes every dirty universe
+in one pass, with one writer thread per port so several Enttec widgets are
+written in parallel rather than one after another.
+"""
+import threading
+
+import dmx
+from netdmx import is_network_port
+from util import get_default_port
+
+# Channels 1 to 512; the buffer's slot 0 is the start code and stays 0
+UNIVERSE_SIZE = 512
+
+
+class Universe(object):
+    """
+        One 512 channel universe on a port, with the Dmx setChannel surface.
+        buffer is indexed by channel number, like the Enttec's.
+    """
+
+    def __init__(self, device, port, universe=0):
+        self.device = device
+        self.port = port
+        self.universe = universe
+        self.buffer = bytearray(UNIVERSE_SIZE + 1)
+        self.dirty = set()
+        self.lock = threading.Lock()
+
+    def setChannel(self, channel, value, autoRender=False):
+        if not 1 <= channel <= UNIVERSE_SIZE:
+            raise ValueError('DMX channel %s out of range' % channel)
+        value = max(0, min(255, int(value)))
+        with self.lock:
+            if self.buffer[channel] != value:
+                self.buffer[channel] = value
+                self.dirty.add(channel)
+        if autoRender:
+            self.flush()
+
+    def apply_changes(self, changes):
+        """
+            Set several (channel, value) pairs under one lock.
+        """
+        with self.lock:
+            for channel, value in changes:
+                if self.buffer[channel] != value:
+                    self.buffer[channel] = value
+                    self.dirty.add(channel)
+
+    def write_block(self, channel, data):
+        """
+            Set len(data) channels from channel on in one slice, for whole
+            frames from the network. Returns True if any of them changed.
+        """
+        end = channel + len(data)
+        if not 1 <= channel <= end <= UNIVERSE_SIZE + 1:
+            raise ValueError('DMX channels %s to %s out of range' % (channel, end - 1))
+        with self.lock:
+            if self.buffer[channel:end] == data:
+                return False
+            self.buffer[channel:end] = data
+            self.dirty.update(xrange(channel, end))
+        return True
+
+    def getChannel(self, channel):
+        return self.buffer[channel]
+
+    def blackOut(self):
+        with self.lock:
+            for channel in range(1, UNIVERSE_SIZE + 1):
+                if self.buffer[channel]:
+                    self.buffer[channel] = 0
+                    self.dirty.add(channel)
+
+    def flush(self):
+        """
+            Write changed channels to the device. Returns False if there were none.
+        """
+        with self.lock:
+            if not self.dirty:
+                return False
+            changes = [(channel, self.buffer[channel]) for channel in self.dirty]
+            self.dirty.clear()
+        for channel, value in changes:
+            self.device.setChannel(channel, value, autoRender=False)
+        self.device.render()
+        return True
+
+
+class PortWriter(object):
+    """
+        Flushes the universes of one port from its own thread when told to.
+    """
+
+    def __init__(self, port):
+        self.port = port
+        self.universes = []
+        self.flushed = 0
+        self.die = False
+        self.go = threading.Event()
+        self.done = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='PortWriter %s' % port)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            self.go.wait()
+            self.go.clear()
+            if self.die:
+                return
+            try:
+                self.flushed = self.flush()
+            finally:
+                self.done.set()
+
+    def flush(self):
+        return sum(universe.flush() for universe in self.universes)
+
+    def close(self):
+        self.die = True
+        self.go.set()
+        self.thread.join()
+
+
+class UniverseManager(object):
+    """
+        Owns the output devices and universes, and patches fixtures onto them.
+
+        Has the render/blackOut/disconnect part of the Dmx surface so it can be
+        driven directly or by a RenderLoop.
+    """
+
+    def __init__(self, open_device=dmx.open_device):
+        self.open_device = open_device
+        self.devices = {}
+        self.universes = {}
+        self.writers = {}
+        self.patched = {}
+        self.flush_lock = threading.Lock()
+
+    def universe(self, port=None, universe=0):
+        if port is None:
+            port = get_default_port()
+        if universe != 0 and not is_network_port(port):
+            raise ValueError('%s carries a single universe, not universe %s' % (port, universe))
+        key = (port, universe)
+        if key not in self.universes:
+            if port not in self.devices:
+                self.devices[port] = self.open_device(port)
+                self.writers[port] = PortWriter(port)
+            device = self.devices[port]
+            if is_network_port(port):
+                # A network port sends each universe on its own
+                device = device.output(universe)
+            self.universes[key] = Universe(device, port, universe)
+            self.writers[port].universes.append(self.universes[key])
+        return self.universes[key]
+
+    def patch(self, fixtures):
+        """
+            Place fixtures on their (port, universe). Returns (fixture, Universe)
+            pairs, refusing fixtures that overlap in the same universe.
+        """
+        outputs = []
+        for fixture in fixtures:
+            universe = self.universe(fixture.port, fixture.universe)
+            used = self.patched.setdefault((universe.port, universe.universe), {})
+            for channel in fixture.channels:
+                if channel in used:
+                    raise ValueError('%s at address %s overlaps %s on %s universe %s channel %s' %
+                        (fixture.name, fixture.start_address, used[channel],
+                         universe.port, universe.universe, channel))
+            for channel in fixture.channels:
+                used[channel] = '%s at address %s' % (fixture.name, fixture.start_address)
+            outputs.append((fixture, universe))
+        return outputs
+
+    def flush(self):
+        """
+            Flush every dirty universe, ports in parallel. Returns how many
+            universes were written.
+        """
+        with self.flush_lock:
+            writers = self.writers.values()
+            if len(writers) == 1:
+                return writers[0].flush()
+            for writer in writers:
+                writer.done.clear()
+                writer.go.set()
+            for writer in writers:
+                writer.done.wait()
+            return sum(writer.flushed for writer in writers)
+
+    def render(self, render_till=None):
+        self.flush()
+
+    def blackOut(self):
+        for universe in self.universes.values():
+            universe.blackOut()
+        self.flush()
+
+    def disconnect(self):
+        for writer in self.writers.values():
+            writer.close()
+        for device in self.devices.values():
+            device.disconnect()
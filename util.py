@@ -1,12 +1,14 @@
 from __future__ import division
-import platform
-
-from netifaces import interfaces, ifaddresses, AF_INET
+import os
+import sys
 
 def get_default_port():
-    if platform.system() == 'Linux':
+    if os.environ.get('LIGHTHOUSE_DMX_PORT'):
+        return os.environ['LIGHTHOUSE_DMX_PORT']
+    # sys.platform rather than the platform module, which is slow to import
+    if sys.platform.startswith('linux'):
         return '/dev/ttyUSB0'
-    elif platform.system() == 'Darwin':
+    elif sys.platform == 'darwin':
         return '/dev/tty.usbserial-ENSML0W9'
 
 def percent_to_dmx(int_percent):
@@ -38,6 +40,8 @@ def filter_out_ipv6_and_local_addresses(addresses):
         yield x
 
 def get_ip():
+    # netifaces is slow to import on the board and only needed here
+    from netifaces import interfaces, ifaddresses
     d_all_addresses = {}
     for interface_name in interfaces():
         addr = ifaddresses(interface_name)
@@ -0,0 +1,407 @@
+"""
+webpanel.py
+
+Web control panel: a map of where the beam points, streamed live over a
+WebSocket, with the same controls as the TouchOSC page.
+
+A WebPanel is an HTTP and WebSocket server on an EventLoop of its own, in its
+own thread, so browsers never hold up the OSC loop. GET / serves web/index.html
+and GET /ws upgrades to a WebSocket (RFC 6455, written here since the board
+has no library for it).
+
+Browsers send text messages in OSC terms, "/staticLight/pan 120" or
+"/staticLight/lightControl 1". They go to command(address, args, client) on
+the OSC loop, which runs them through the same handlers, rate limits and
+control arbitration as OSC from TouchOSC. A browser that isn't in control
+can watch but not steer. A WebSocket upgrade whose Origin isn't the panel's
+own Host is refused, so another site's page can't steer through a browser.
+
+The lamp's state is a short tuple of integers, see FIELDS. STREAM_RATE times
+a second the panel reads it once and sends each browser a binary message with
+only the fields that changed since the last one it was sent:
+
+    (uint8 field, int16 value) for every changed field
+
+The first message after connecting has every field, after a text message
+with the field and show names as JSON. A browser whose socket is still
+backed up with more than MAX_BACKLOG bytes is skipped, and catches up with
+one diff once it drains, so a slow phone costs memory for one backlog and
+nothing else.
+"""
+import base64
+import errno
+import hashlib
+import json
+import os
+import socket
+import struct
+import threading
+import time
+
+from event_loop import EventLoop
+
+DEFAULT_PORT = 8080
+PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'web', 'index.html')
+# Per browser, in order; brightness is a percent, lamp whether it is on and
+# control whether the browser's address has it
+FIELDS = ('pan', 'tilt', 'brightness', 'lamp', 'strobe', 'speed', 'rotation', 'show',
+          'idle', 'owned', 'control')
+STREAM_RATE = 10
+MAX_BACKLOG = 8 * 1024
+# Kernel send buffer per browser, so one that stops reading backs up soon
+SEND_BUFFER = 16 * 1024
+# select() can't watch more than FD_SETSIZE, 1024, descriptors
+MAX_CLIENTS = 768
+MAX_REQUEST = 8 * 1024
+MAX_MESSAGE = 1024
+# Connections that haven't finished their HTTP request by then are closed
+REQUEST_TIMEOUT = 10
+
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xa
+FIELD = struct.Struct('<Bh')
+
+
+def accept_key(key):
+    return base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+
+def frame(opcode, payload):
+    """
+        An unmasked, unfragmented server frame.
+    """
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('>BB', 0x80 | opcode, length)
+    elif length < 0x10000:
+        header = struct.pack('>BBH', 0x80 | opcode, 126, length)
+    else:
+        header = struct.pack('>BBQ', 0x80 | opcode, 127, length)
+    return header + payload
+
+
+def parse_frame(data):
+    """
+        (fin, opcode, payload, length used) of the first frame in data, or
+        None if it hasn't all arrived.
+    """
+    if len(data) < 2:
+        return None
+    first, second = ord(data[0]), ord(data[1])
+    length = second & 0x7f
+    offset = 2
+    if length == 126:
+        if len(data) < 4:
+            return None
+        length, = struct.unpack_from('>H', data, 2)
+        offset = 4
+    elif length == 127:
+        if len(data) < 10:
+            return None
+        length, = struct.unpack_from('>Q', data, 2)
+        offset = 10
+    if length > MAX_MESSAGE:
+        raise ValueError('WebSocket message of %d bytes' % length)
+    masked = second & 0x80
+    if masked:
+        if len(data) < offset + 4:
+            return None
+        mask = bytearray(data[offset:offset + 4])
+        offset += 4
+    if len(data) < offset + length:
+        return None
+    payload = bytearray(data[offset:offset + length])
+    if masked:
+        for index in range(length):
+            payload[index] ^= mask[index & 3]
+    return bool(first & 0x80), first & 0x0f, str(payload), offset + length
+
+
+def diff(old, new):
+    return ''.join(FIELD.pack(index, value)
+        for index, value in enumerate(new) if old is None or old[index] != value)
+
+
+class Connection(object):
+
+    def __init__(self, panel, sock, address):
+        self.panel = panel
+        self.sock = sock
+        self.address = address
+        self.opened = time.time()
+        self.websocket = False
+        self.closing = False
+        self.inbuf = ''
+        self.outbuf = bytearray()
+        self.state = None
+        self.sent = 0
+        self.skipped = 0
+
+    def readable(self):
+        try:
+            data = self.sock.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self.close()
+            return
+        if not data:
+            self.close()
+            return
+        self.inbuf += data
+        try:
+            if self.websocket:
+                self.read_messages()
+            else:
+                self.read_request()
+        except ValueError as e:
+            print 'Web panel: closing', self.address[0], '-', e
+            self.close()
+
+    def read_request(self):
+        end = self.inbuf.find('\r\n\r\n')
+        if end < 0:
+            if len(self.inbuf) > MAX_REQUEST:
+                raise ValueError('request too long')
+            return
+        lines = self.inbuf[:end].split('\r\n')
+        self.inbuf = self.inbuf[end + 4:]
+        parts = lines[0].split()
+        if len(parts) != 3 or parts[0] not in ('GET', 'HEAD'):
+            self.respond('405 Method Not Allowed', 'text/plain', 'GET only\n')
+            return
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        path = parts[1].split('?', 1)[0]
+        if path == '/ws' and 'websocket' in headers.get('upgrade', '').lower():
+            self.upgrade(headers)
+        elif path in ('/', '/index.html'):
+            self.respond('200 OK', 'text/html; charset=utf-8', self.panel.page,
+                         head=parts[0] == 'HEAD')
+        else:
+            self.respond('404 Not Found', 'text/plain', 'Not found\n')
+
+    def respond(self, status, content_type, body, head=False):
+        self.send('HTTP/1.1 %s\r\nContent-Type: %s\r\nContent-Length: %d\r\n'
+                  'Cache-Control: no-cache\r\nConnection: close\r\n\r\n%s' % (
+                      status, content_type, len(body), '' if head else body))
+        self.closing = True
+        if not self.outbuf:
+            self.close()
+
+    def upgrade(self, headers):
+        key = headers.get('sec-websocket-key')
+        if key is None:
+            raise ValueError('no Sec-WebSocket-Key')
+        origin = headers.get('origin')
+        if origin is not None and origin.partition('://')[2].lower() != headers.get('host', '').lower():
+            self.respond('403 Forbidden', 'text/plain', 'Origin %s is not this panel\n' % origin)
+            return
+        self.send('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                  'Connection: Upgrade\r\nSec-WebSocket-Accept: %s\r\n\r\n' % accept_key(key))
+        self.websocket = True
+        self.send(frame(OP_TEXT, self.panel.hello))
+        self.panel.joined(self)
+
+    def read_messages(self):
+        while self.inbuf:
+            parsed = parse_frame(self.inbuf)
+            if parsed is None:
+                return
+            fin, opcode, payload, used = parsed
+            self.inbuf = self.inbuf[used:]
+            if not fin or opcode == OP_CONTINUATION:
+                raise ValueError('fragmented message')
+            if opcode == OP_TEXT:
+                self.panel.message(self, payload)
+            elif opcode == OP_PING:
+                self.send(frame(OP_PONG, payload))
+            elif opcode == OP_CLOSE:
+                self.send(frame(OP_CLOSE, payload[:2]))
+                self.closing = True
+                if not self.outbuf:
+                    self.close()
+                return
+
+    def send(self, data):
+        if not self.outbuf:
+            # Nearly always, straight to the socket without a copy or the loop
+            try:
+                sent = self.sock.send(data)
+            except socket.error as e:
+                if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self.close()
+                    return
+                sent = 0
+            if sent == len(data):
+                if self.closing:
+                    self.close()
+                return
+            data = data[sent:]
+        self.outbuf += data
+        self.flush()
+
+    def flush(self):
+        if self.outbuf:
+            try:
+                sent = self.sock.send(self.outbuf)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    sent = 0
+                else:
+                    self.close()
+                    return
+            del self.outbuf[:sent]
+        if self.outbuf:
+            self.panel.loop.add_writer(self.sock, self.flush)
+        else:
+            self.panel.loop.remove_writer(self.sock)
+            if self.closing:
+                self.close()
+
+    def stream(self, state, frames):
+        """
+            Send what changed since the last state sent, unless still backed up.
+            frames caches the message for each (last, new) pair, most browsers
+            are sent the same one.
+        """
+        if len(self.outbuf) > MAX_BACKLOG:
+            self.skipped += 1
+            return
+        if state == self.state:
+            return
+        key = (self.state, state)
+        message = frames.get(key)
+        if message is None:
+            message = frames[key] = frame(OP_BINARY, diff(self.state, state))
+        self.state = state
+        self.sent += 1
+        self.send(message)
+
+    def close(self):
+        self.panel.drop(self)
+
+
+class WebPanel(object):
+    """
+        state() returns (the lamp's FIELDS but control, the address in
+        control). command(address, args, (ip, port)) applies a browser's
+        command; it is called on this panel's loop.
+    """
+
+    def __init__(self, state, command, shows=(), address='0.0.0.0', port=DEFAULT_PORT,
+                 stream_rate=STREAM_RATE):
+        self.state = state
+        self.command = command
+        self.loop = EventLoop()
+        with open(PAGE) as f:
+            self.page = f.read()
+        self.hello = json.dumps({'fields': FIELDS, 'shows': list(shows)})
+        self.connections = {}
+        self.websockets = set()
+        self.rejected = 0
+        self.streamed = 0
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((address, port))
+        self.listener.listen(128)
+        self.listener.setblocking(False)
+        self.loop.add_reader(self.listener, self.accept)
+        self.loop.call_every(1.0 / stream_rate, self.stream)
+        self.loop.call_every(1, self.expire)
+        self.thread = threading.Thread(target=self.loop.run_forever, name='WebPanel')
+        self.thread.daemon = True
+        print 'Starting web panel at http://%s:%d/' % (address, self.listener.getsockname()[1])
+
+    def start(self):
+        self.thread.start()
+
+    def accept(self):
+        while True:
+            try:
+                sock, address = self.listener.accept()
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            if len(self.connections) >= MAX_CLIENTS:
+                self.rejected += 1
+                sock.close()
+                continue
+            sock.setblocking(False)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SEND_BUFFER)
+            connection = Connection(self, sock, address)
+            self.connections[sock.fileno()] = connection
+            self.loop.add_reader(sock, connection.readable)
+
+    def joined(self, connection):
+        self.websockets.add(connection)
+        fields, owner = self.state()
+        connection.stream(fields + (int(self.in_control(connection, owner)),), {})
+
+    def message(self, connection, text):
+        parts = text.split()
+        if not parts or not parts[0].startswith('/'):
+            return
+        try:
+            args = [float(part) for part in parts[1:]]
+        except ValueError:
+            return
+        self.command(parts[0], args, connection.address)
+
+    def in_control(self, connection, owner):
+        return owner is not None and owner == connection.address[0]
+
+    def stream(self):
+        if not self.websockets:
+            return
+        fields, owner = self.state()
+        self.streamed += 1
+        states = (fields + (0,), fields + (1,))
+        frames = {}
+        for connection in list(self.websockets):
+            connection.stream(states[owner is not None and connection.address[0] == owner], frames)
+
+    def expire(self):
+        limit = time.time() - REQUEST_TIMEOUT
+        for connection in self.connections.values():
+            if not connection.websocket and connection.opened < limit:
+                connection.close()
+
+    def drop(self, connection):
+        fd = connection.sock.fileno()
+        if self.connections.pop(fd, None) is None:
+            return
+        self.websockets.discard(connection)
+        self.loop.remove_reader(fd)
+        self.loop.remove_writer(fd)
+        connection.sock.close()
+
+    def stats(self):
+        websockets = list(self.websockets)
+        return {
+            'connections': len(self.connections),
+            'websockets': len(websockets),
+            'streamed': self.streamed,
+            'sent': sum(connection.sent for connection in websockets),
+            'skipped': sum(connection.skipped for connection in websockets),
+            'backlog': sum(len(connection.outbuf) for connection in websockets),
+            'rejected': self.rejected,
+        }
+
+    def close(self):
+        def shut():
+            for connection in self.connections.values():
+                connection.close()
+            self.loop.remove_reader(self.listener)
+            self.listener.close()
+            self.loop.stop()
+        self.loop.call_soon_threadsafe(shut)
+        self.thread.join(2)